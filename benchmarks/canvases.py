@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""Usage:
+   canvases.py [--pages=<n>] [--repeat=<n>]
+
+Time building the canvases of a manifest, per canvas, with the page table
+and with the list of (width, height) tuples it replaced. No network access
+is needed; page sizes are made up.
+
+Options:
+  --pages=<n>    Pages in the manifest [default: 10000].
+  --repeat=<n>   Runs of each, keeping the fastest [default: 5].
+"""
+
+import os
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'iiif_tools'))
+
+from classes import IIIFManifest
+from docopt import docopt
+from provider import LOGO_URL, set_logo
+
+ARK = 'ark:61001/b2hd4d25q389'
+
+
+class TupleListManifest(IIIFManifest):
+    """Builds canvases the way IIIFManifest did before the page table: a
+       tuple per page, and the image server URL quoted each time it is
+       used."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tuple_sizes = []
+
+    def _url(self, n):
+        if len(self.tuple_sizes) == 1:
+            return 'https://iiif-server.lib.uchicago.edu/{}'.format(
+                urllib.parse.quote(self.ark, safe='')
+            )
+        return 'https://iiif-server.lib.uchicago.edu/{}'.format(
+            urllib.parse.quote('{}/{:08}'.format(self.ark, n+1), safe='')
+        )
+
+    def _iter_canvases(self):
+        for n in range(len(self.tuple_sizes)):
+            canvas_id = self._get_id(n, 'canvas')
+            yield {
+                'height': self.tuple_sizes[n][1],
+                'id': canvas_id,
+                'items': [ {
+                    'id': self._get_id(n, 'annotation-page'),
+                    'type': 'AnnotationPage',
+                    'items': [ {
+                        'id': self._get_id(n, 'annotation'),
+                        'type': 'Annotation',
+                        'motivation': 'Painting',
+                        'target': canvas_id,
+                        'body': {
+                            'format': 'image/jpeg',
+                            'height': self.tuple_sizes[0][1],
+                            'id': self._get_id(n, 'image'),
+                            'service': [ {
+                                '@id': self._url(n),
+                                '@type': 'ImageService2',
+                                'profile': 'http://iiif.io/api/image/2/level2.json'
+                            } ],
+                            'type': 'Image',
+                            'width': self.tuple_sizes[0][0]
+                        }
+                    } ]
+                } ],
+                'label': { 'en': [ 'Image {:03d}'.format(n+1) ] },
+                'thumbnail': [ {
+                    'id': '{}/full/{},/0/default.jpg'.format(self._url(n), 200),
+                    'service': [ {
+                        '@id': self._url(n),
+                        '@type': 'ImageService2',
+                        'profile': 'http://iiif.io/api/image/2/level2.json'
+                    } ],
+                    'type': 'Image'
+                } ],
+                'type': 'Canvas',
+                'width': self.tuple_sizes[n][0]
+            }
+
+
+def make_manifest(cls, pages):
+    manifest = cls('https://iiif-manifest.lib.uchicago.edu', 'gms-0019', ARK, '', '', '')
+    for n in range(pages):
+        size = (3000 + n % 100, 4000 + n % 100)
+        manifest.pages.append(*size)
+        if isinstance(manifest, TupleListManifest):
+            manifest.tuple_sizes.append(size)
+    return manifest
+
+
+def time_canvases(manifest, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for canvas in manifest._iter_canvases():
+            pass
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    options = docopt(__doc__)
+    pages = int(options['--pages'])
+    repeat = int(options['--repeat'])
+
+    # don't download the logo.
+    set_logo(LOGO_URL, 1, 1)
+
+    for label, cls in (('tuple list', TupleListManifest), ('page table', IIIFManifest)):
+        seconds = time_canvases(make_manifest(cls, pages), repeat)
+        sys.stdout.write('{:12} {:8.2f} us/canvas\n'.format(
+            label,
+            seconds / pages * 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main()
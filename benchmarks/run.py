@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+"""Usage:
+   run.py [--sizes=<sizes>] [--cases=<cases>] [--repeat=<n>] [--output=<path>] [--no-limits]
+
+Time manifest, collection and link-check building on synthetic fixtures,
+and measure peak memory with tracemalloc. No network access is needed.
+
+Each case runs at each size: canvases in a manifest, maps in the ssmaps
+listings, issues in an mvol year, or manifests in a crawled collection.
+The fastest of --repeat runs is reported, and then one more run is traced
+for peak memory. Results are printed as a table. With --output they are
+also written as JSON, along with the commit they were measured at, so
+runs on different commits can be compared.
+
+Cases: manifest_data, manifest_write, validate_manifest, ssmaps_list_date,
+ssmaps_browse_subject, ssmaps_all, mvol_manifest, mvol_year_collection,
+mvol_month_collection, webdav_listing, check_urls, collection_browse.
+
+Options:
+  --sizes=<sizes>   Comma-separated sizes [default: 10,1000,50000].
+  --cases=<cases>   Comma-separated cases to run, or all [default: all].
+  --repeat=<n>      Timed runs of each case [default: 3].
+  --output=<path>   Write results as JSON.
+  --no-limits       Run cases at sizes above their limits.
+"""
+
+import asyncio
+import collections
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import xml.etree.ElementTree as ElementTree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'iiif_tools'))
+
+# never fetch the logo.
+os.environ['IIIF_TOOLS_OFFLINE'] = '1'
+
+from docopt import docopt
+
+DOMAIN = 'https://iiif-collection.lib.uchicago.edu'
+ARK = 'ark:61001/b2hd4d25q389'
+
+Case = collections.namedtuple('Case', ['name', 'setup', 'max_size'])
+CASES = collections.OrderedDict()
+
+
+def case(max_size=None):
+    """Register a benchmark. The decorated function takes (size, tmp,
+       stack), does any setup, and returns the function to time. Cleanup
+       can be pushed onto stack, an ExitStack."""
+    def register(setup):
+        CASES[setup.__name__] = Case(setup.__name__, setup, max_size)
+        return setup
+    return register
+
+
+def make_manifest(size):
+    from classes import IIIFManifest
+    from provider import LOGO_URL, set_logo
+
+    # builders supply the metadata; keep it out of the timing.
+    class Manifest(IIIFManifest):
+        def _get_metadata(self):
+            return []
+
+    set_logo(LOGO_URL, 600, 120)
+    manifest = Manifest(DOMAIN, 'gms-0019', ARK, 'Title', 'Summary', 'Attribution')
+    for n in range(size):
+        manifest.pages.append(3000 + n % 1000, 4000 + n % 1000)
+    return manifest
+
+
+def make_ssmaps_records(size):
+    from fixtures import dc_xml, make_ark, make_size
+
+    records = []
+    for n in range(size):
+        identifier = 'G4104-C6-{}-B{}'.format(1900 + n % 60, n)
+        ark = make_ark(identifier)
+        records.append((
+            ark,
+            ElementTree.fromstring(dc_xml(identifier, ark)),
+            tuple(make_size(identifier))
+        ))
+    return records
+
+
+def load_script(name):
+    from build import load_script
+    return load_script(name)
+
+
+def serve_collection(size, tmp, stack):
+    """Serve a v2 collection of one v3 collection of size manifests from a
+       fixture server on a free port; returns the top collection's URL."""
+    from fixtures import FixtureServer
+
+    with open(os.path.join(tmp, 'objects.json'), 'w') as f:
+        json.dump({}, f)
+    directory = os.path.join(tmp, 'manifests', 'bench')
+    os.makedirs(directory)
+    for n in range(size):
+        with open(os.path.join(directory, '{:06d}.json'.format(n)), 'w') as f:
+            json.dump({'id': n, 'type': 'Manifest'}, f)
+
+    server = FixtureServer(tmp, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stack.callback(server.server_close)
+    stack.callback(server.shutdown)
+    return '{}/collections/top.json'.format(server.base_url)
+
+
+@case()
+def manifest_data(size, tmp, stack):
+    manifest = make_manifest(size)
+    return manifest.data
+
+
+@case()
+def manifest_write(size, tmp, stack):
+    manifest = make_manifest(size)
+
+    def write():
+        for chunk in manifest.iterencode():
+            pass
+    return write
+
+
+@case()
+def validate_manifest(size, tmp, stack):
+    from json_writer import dumps
+    from validate import get_validator, validate
+
+    get_validator()
+    data = json.loads(dumps(make_manifest(size).data()))
+    return lambda: validate(data)
+
+
+@case()
+def ssmaps_list_date(size, tmp, stack):
+    module = load_script('ssmaps_build_collection')
+    records = make_ssmaps_records(size)
+    return lambda: module.list_date(DOMAIN, records)
+
+
+@case()
+def ssmaps_browse_subject(size, tmp, stack):
+    module = load_script('ssmaps_build_collection')
+    records = make_ssmaps_records(size)
+    return lambda: module.browse_subject(DOMAIN, records)
+
+
+@case()
+def ssmaps_all(size, tmp, stack):
+    module = load_script('ssmaps_build_collection')
+    records = make_ssmaps_records(size)
+    return lambda: module.all_collections(DOMAIN, records)
+
+
+@case()
+def mvol_manifest(size, tmp, stack):
+    from fixtures import write_mvol_issue
+
+    module = load_script('mvol_build_manifest')
+    identifier = 'mvol-0004-1930-0103'
+    write_mvol_issue(tmp, identifier, size)
+
+    def build():
+        manifest = module.MvolIIIFManifest(None, 'Daily Maroon', identifier, '', '')
+        manifest.directory = tmp
+        return manifest.data()
+    return build
+
+
+@case()
+def mvol_year_collection(size, tmp, stack):
+    from fixtures import MvolListing
+
+    module = load_script('mvol_build_year_collection')
+    directory = '/IIIF_Files/mvol/0004/1930'
+    listing = MvolListing(directory, size)
+    return lambda: module.IIIFCollectionYear(
+        listing, 'Daily Maroon', 'mvol-0004-1930', '', '', directory
+    ).data()
+
+
+@case()
+def mvol_month_collection(size, tmp, stack):
+    from fixtures import MvolListing
+
+    module = load_script('mvol_build_month_collection')
+    directory = '/IIIF_Files/mvol/0004/1930'
+    listing = MvolListing(directory, size)
+    return lambda: module.IIIFCollectionMonth(
+        listing, 'Daily Maroon', 'mvol-0004-1930-01', '', '', directory
+    ).data()
+
+
+@case()
+def webdav_listing(size, tmp, stack):
+    from fixtures import MvolListing
+    from webdav_listing import WebDavListing
+
+    directory = '/IIIF_Files/mvol/0004/1930'
+    client = MvolListing(directory, size, pages=4)
+
+    def walk():
+        listing = WebDavListing(client, directory, cache_dir=tmp)
+        for issue in listing.list(directory):
+            listing.list(issue.path + 'TIFF')
+    return walk
+
+
+# one HTTP request per manifest.
+@case(max_size=1000)
+def check_urls(size, tmp, stack):
+    from check_iiif_urls import crawl
+
+    url = serve_collection(size, tmp, stack)
+    return lambda: asyncio.run(crawl(url, match='127.0.0.1'))
+
+
+@case(max_size=1000)
+def collection_browse(size, tmp, stack):
+    from cli_collection_browse import Browser
+
+    url = serve_collection(size, tmp, stack)
+    return lambda: Browser().browse(url, depth=2, out=io.StringIO())
+
+
+def measure(fn, repeat):
+    """Returns (fastest time in seconds, peak traced memory in bytes)."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run(cases, sizes, repeat, limits=True):
+    """Run each case at each size, yielding a result dict for each."""
+    for c in cases:
+        for size in sizes:
+            result = {'case': c.name, 'size': size}
+            if limits and c.max_size is not None and size > c.max_size:
+                result['skipped'] = 'above limit of {}'.format(c.max_size)
+                yield result
+                continue
+            with contextlib.ExitStack() as stack:
+                tmp = stack.enter_context(tempfile.TemporaryDirectory())
+                try:
+                    fn = c.setup(size, tmp, stack)
+                except ImportError as e:
+                    result['skipped'] = str(e)
+                    yield result
+                    continue
+                seconds, peak = measure(fn, repeat)
+            result['seconds'] = seconds
+            result['us_per_item'] = seconds / size * 1e6
+            result['peak_bytes'] = peak
+            yield result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=HERE,
+            stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    options = docopt(__doc__)
+    sizes = [int(s) for s in options['--sizes'].split(',')]
+    if options['--cases'] == 'all':
+        cases = list(CASES.values())
+    else:
+        cases = [CASES[name] for name in options['--cases'].split(',')]
+
+    results = []
+    sys.stdout.write('{:24} {:>8} {:>12} {:>14} {:>12}\n'.format(
+        'case', 'size', 'seconds', 'us/item', 'peak MiB'
+    ))
+    for result in run(cases, sizes, int(options['--repeat']), not options['--no-limits']):
+        results.append(result)
+        if 'skipped' in result:
+            sys.stdout.write('{:24} {:>8} skipped: {}\n'.format(
+                result['case'],
+                result['size'],
+                result['skipped']
+            ))
+        else:
+            sys.stdout.write('{:24} {:>8} {:>12.4f} {:>14.2f} {:>12.2f}\n'.format(
+                result['case'],
+                result['size'],
+                result['seconds'],
+                result['us_per_item'],
+                result['peak_bytes'] / 1024 / 1024
+            ))
+        sys.stdout.flush()
+
+    if options['--output']:
+        with open(options['--output'], 'w') as f:
+            json.dump({
+                'commit': get_commit(),
+                'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results
+            }, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
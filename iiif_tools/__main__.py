@@ -2,6 +2,9 @@
 """Usage:
     iiif_tools -
     iiif_tools -f <path>
+    iiif_tools build (<ark>... | --collection=<collection>) [options]
+    iiif_tools validate <path>... [options]
+    iiif_tools publish <output-dir> [<file>...] [options]
 
 Options:
   -h --help     Show this screen.
@@ -10,14 +13,33 @@ Options:
 """
 
 
-import sys
 import json
+import os
+import sys
 from docopt import docopt
-from maps_manifest import MapsIIIFManifest
 
-if __name__=="__main__":
+# the scripts in this package import each other as top-level modules.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def main():
+  if sys.argv[1:2] == ['build']:
+    from build import main as build_main
+    build_main()
+    return
+  if sys.argv[1:2] == ['publish']:
+    from publish import main as publish_main
+    publish_main()
+    return
+  if sys.argv[1:2] == ['validate']:
+    from validate import main as validate_main
+    validate_main()
+    return
+
   options = docopt(__doc__)
 
+  from json_writer import dump
+  from maps_manifest import MapsIIIFManifest
+
   if options['--file']:
   	with open(options['<path>'], 'r') as file:
   		dcxml = file.read()
@@ -26,8 +48,15 @@ if __name__=="__main__":
   else:
   	sys.exit()
   manifest = MapsIIIFManifest(dcxml)
-  # Converting manifest into a json dictionary from the manifest string
-  manifest = json.loads(str(manifest))
-  # Printing out the beautified json string
-  sys.stdout.write(json.dumps(manifest, sort_keys=True, indent=4))
-  sys.exit()
\ No newline at end of file
+  # Stream the manifest to stdout instead of round-tripping it through
+  # a string and a dict first, where the manifest can give us its dict;
+  # otherwise all it promises is __str__.
+  if hasattr(manifest, 'data'):
+    data = manifest.data()
+  else:
+    data = json.loads(str(manifest))
+  dump(data, sys.stdout)
+  sys.exit()
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Look up ARKs and original identifiers in the ARK database.
+
+The database maps original identifiers (e.g. gms-0019,
+G4104-C6-1933-U5-a) to ARKs (e.g. ark:61001/b2hd4d25q389). Builders look
+these up constantly, so one read-only connection is kept per process and
+recent lookups are remembered.
+
+The database path comes from the ARK_DATA_DB environment variable, or can
+be set with set_database() so tests can point at a local fixture.
+"""
+
+import collections
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+from instrumentation import count, span
+
+ARK_DATA_DB = os.environ.get('ARK_DATA_DB', '/data/s4/jej/ark_data.db')
+
+# SQLite's default limit on host parameters in a single statement.
+MAX_PARAMETERS = 999
+
+
+class _LRU:
+    def __init__(self, size):
+        self.size = size
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            self.data.move_to_end(key)
+            return self.data[key]
+        except KeyError:
+            return None
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+class ArkResolver:
+    """Read-only access to the arks table.
+
+    Args:
+      path (str): path to the SQLite database.
+      immutable (bool): tell SQLite the file won't change while it's open,
+        which skips file locking entirely. Only use this on a snapshot.
+      cache_size (int): number of recent lookups to remember.
+    """
+
+    def __init__(self, path=ARK_DATA_DB, immutable=False, cache_size=4096):
+        self.path = path
+        uri = 'file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(path)))
+        if immutable:
+            uri += '&immutable=1'
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.arks = _LRU(cache_size)
+        self.identifiers = _LRU(cache_size)
+
+    def _fetchall(self, sql, parameters):
+        with self.lock, span('sqlite'):
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def get_ark(self, identifier):
+        """e.g. 'gms-0019' -> 'ark:61001/b2hd4d25q389'"""
+        ark = self.arks.get(identifier)
+        if ark is None:
+            count('ark_cache.miss')
+            rows = self._fetchall(
+                'SELECT ark FROM arks WHERE original_identifier = ?',
+                (identifier,)
+            )
+            if not rows:
+                raise KeyError(identifier)
+            ark = rows[0][0]
+            self.arks.set(identifier, ark)
+            self.identifiers.set(ark, identifier)
+        else:
+            count('ark_cache.hit')
+        return ark
+
+    def get_original_identifier(self, ark):
+        """e.g. 'ark:61001/b2hd4d25q389' -> 'gms-0019'"""
+        identifier = self.identifiers.get(ark)
+        if identifier is None:
+            count('ark_cache.miss')
+            rows = self._fetchall(
+                'SELECT original_identifier FROM arks WHERE ark = ?',
+                (ark,)
+            )
+            if not rows:
+                raise KeyError(ark)
+            identifier = rows[0][0]
+            self.identifiers.set(ark, identifier)
+            self.arks.set(identifier, ark)
+        else:
+            count('ark_cache.hit')
+        return identifier
+
+    def resolve_many(self, identifiers):
+        """Look up ARKs for many original identifiers at once.
+
+        Returns:
+          dict: ARKs by original identifier. Identifiers that aren't in the
+            database are left out.
+        """
+        results = {}
+        missing = []
+        for identifier in identifiers:
+            ark = self.arks.get(identifier)
+            if ark is None:
+                missing.append(identifier)
+            else:
+                results[identifier] = ark
+        count('ark_cache.hit', len(results))
+        count('ark_cache.miss', len(missing))
+
+        for i in range(0, len(missing), MAX_PARAMETERS):
+            chunk = missing[i:i + MAX_PARAMETERS]
+            rows = self._fetchall(
+                'SELECT original_identifier, ark FROM arks WHERE original_identifier IN ({})'.format(
+                    ', '.join('?' * len(chunk))
+                ),
+                chunk
+            )
+            for identifier, ark in rows:
+                results[identifier] = ark
+                self.arks.set(identifier, ark)
+                self.identifiers.set(ark, identifier)
+        return results
+
+    def get_arks_with_prefix(self, prefix):
+        """ARKs for every original identifier that starts with prefix,
+           ordered by original identifier."""
+        rows = self._fetchall(
+            '''SELECT original_identifier, ark FROM arks
+               WHERE original_identifier LIKE ? ESCAPE '\\'
+               ORDER BY original_identifier''',
+            (prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%',)
+        )
+        for identifier, ark in rows:
+            self.arks.set(identifier, ark)
+            self.identifiers.set(ark, identifier)
+        return [ark for identifier, ark in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+_resolver = None
+_resolver_pid = None
+_database = ARK_DATA_DB
+
+
+def set_database(path):
+    """Point the shared resolver at a different database."""
+    global _database, _resolver
+    _database = path
+    _resolver = None
+
+
+def get_database():
+    return _database
+
+
+def get_resolver():
+    """Returns the ArkResolver for this process. Connections aren't shared
+       across fork(), so worker processes get their own."""
+    global _resolver, _resolver_pid
+    if _resolver is None or _resolver_pid != os.getpid():
+        _resolver = ArkResolver(_database)
+        _resolver_pid = os.getpid()
+    return _resolver
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""Usage:
+   iiif_tools build (<ark>... | --collection=<collection>) [--output-dir=<output-dir>] [--domain=<domain>] [--processes=<processes>] [--ark-db=<ark-db>] [--pairtree-root=<path>] [--compact] [--no-compress] [--force] [--validate] [--profile] [--pstats=<path>] [--metrics-json=<path>]
+
+Build IIIF manifests for a list of ARKs, or for every object in a
+collection (gms, rac, speculum or ssmaps), in a single process pool.
+Each manifest is written below the output directory at the path of its
+URL, e.g. <output-dir>/gms/0019/gms-0019.json.
+
+The inputs of each manifest are recorded in <output-dir>/.build_state.db.
+Manifests whose inputs haven't changed since the last build are skipped,
+and files are only rewritten when their contents change. Each manifest is
+published with precompressed .gz and .br copies and a .etag file; see
+publish.py.
+
+With --profile, the time spent in each phase of the build- SQLite, HTTP,
+image headers, XML, JSON- is added up across all workers and printed,
+along with cache hits and misses and bytes downloaded. --metrics-json
+writes the same numbers as JSON, and --pstats writes a cProfile profile
+of the parent and every worker, for pstats or snakeviz.
+
+With --validate, or with IIIF_TOOLS_VALIDATE set, each manifest is checked
+against the IIIF Presentation 3 schema before it is written, and invalid
+manifests are reported as failures instead. This needs jsonschema.
+
+Options:
+  --collection=<collection>  gms, rac, speculum or ssmaps.
+  --output-dir=<output-dir>  Directory to write manifests to [default: .].
+  --domain=<domain>          Manifest domain [default: https://iiif-manifest.lib.uchicago.edu].
+  --processes=<processes>    Number of worker processes [default: 4].
+  --compact                  Write manifests without indentation.
+  --no-compress              Don't write .gz, .br or .etag files.
+  --force                    Rebuild every manifest, even if its inputs haven't changed.
+  --validate                 Check manifests against the IIIF schema before writing them.
+  --ark-db=<ark-db>          ARK database, instead of $ARK_DATA_DB.
+  --pairtree-root=<path>     OCFL pairtree, instead of $IIIF_TOOLS_PAIRTREE_ROOT.
+  --profile                  Print a per-phase timing breakdown.
+  --pstats=<path>            Write a cProfile/pstats file.
+  --metrics-json=<path>      Write timings and counters as JSON.
+"""
+
+import importlib.machinery
+import importlib.util
+import os
+import sys
+import time
+import traceback
+
+from ark_resolver import get_database, get_resolver, set_database
+from build_state import BuildState, code_version, hash_inputs
+from classes import get_original_identifier_from_ark
+from classes import get_arks_from_original_identifier_prefix
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from docopt import docopt
+from instrumentation import collect, count, merge, profile, profile_task, span
+from ocfl_inventory import get_pairtree_root, set_pairtree_root
+from provider import get_logo
+from publish import get_output_path, has_sidecars, publish_file, write_sidecars
+
+BUILDERS = {
+    'gms': 'gms_build_manifest',
+    'rac': 'rac_build_manifest',
+    'speculum': 'speculum_build_manifest',
+    'ssmaps': 'ssmaps_build_manifest'
+}
+
+_builders = {}
+_code_versions = {}
+_settings = {}
+
+
+def load_script(name):
+    """Import one of the extensionless scripts in this directory as a
+       module, e.g. load_script('gms_build_manifest')."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def get_collection_for_identifier(identifier):
+    # e.g. "gms-0019" -> "gms", "G4104-C6-1933-U5-a" -> "ssmaps"
+    if identifier.startswith('G4104-'):
+        return 'ssmaps'
+    return identifier.split('-')[0]
+
+
+def get_arks_for_collection(collection):
+    if collection == 'ssmaps':
+        identifiers = load_script('ssmaps_build_collection').socsci_identifiers()
+        arks = get_resolver().resolve_many(identifiers)
+        return [arks[i] for i in identifiers]
+    elif collection in BUILDERS:
+        return get_arks_from_original_identifier_prefix(collection + '-')
+    else:
+        raise ValueError('unknown collection: {}'.format(collection))
+
+
+def _init_worker(domain, output_dir, force, compact, ark_db, pairtree_root,
+                 pstats_path=None, validate=False, compress=True):
+    """Do the setup every manifest shares once per worker process, instead
+       of once per manifest."""
+    set_database(ark_db)
+    set_pairtree_root(pairtree_root)
+    _settings['domain'] = domain
+    _settings['output_dir'] = output_dir
+    _settings['force'] = force
+    _settings['compact'] = compact
+    _settings['pstats_path'] = pstats_path
+    _settings['validate'] = validate
+    _settings['compress'] = compress
+    _settings['state'] = BuildState(os.path.join(output_dir, '.build_state.db'))
+    here = os.path.dirname(os.path.abspath(__file__))
+    for collection, script in BUILDERS.items():
+        _builders[collection] = load_script(script)
+        _code_versions[collection] = code_version(
+            os.path.join(here, script),
+            os.path.join(here, 'classes.py'),
+            os.path.join(here, 'image_probe.py'),
+            os.path.join(here, 'json_writer.py'),
+            os.path.join(here, 'ocfl_inventory.py'),
+            os.path.join(here, 'provider.py'),
+            os.path.join(here, 'publish.py'),
+            os.path.join(here, 'thumbnails.py')
+        )
+    get_logo()
+
+
+def _build(ark):
+    """Returns (output path, status, metrics), where status is 'skipped',
+       'unchanged' or 'written' and metrics are this worker's spans and
+       counters since its last build."""
+    with profile_task(_settings['pstats_path']):
+        path, status = _build_manifest(ark)
+    return path, status, collect()
+
+
+def _build_manifest(ark):
+    identifier = get_original_identifier_from_ark(ark)
+    collection = get_collection_for_identifier(identifier)
+    builder = _builders[collection]
+    state = _settings['state']
+
+    input_hash = hash_inputs(
+        _code_versions[collection],
+        _settings['domain'],
+        *builder.get_inputs(ark)
+    )
+    if not _settings['force']:
+        path = state.is_fresh(ark, input_hash)
+        if path is not None:
+            # e.g. brotli was installed since the manifest was built.
+            if _settings['compress'] and not has_sidecars(path):
+                write_sidecars(path)
+            return path, 'skipped'
+
+    manifest = builder.build_manifest(ark, _settings['domain'])
+
+    path = get_output_path(_settings['output_dir'], manifest._get_manifest_url())
+    with span('json'):
+        written = publish_file(
+            path,
+            manifest.iterencode(_settings['compact'], _settings['validate'] or None),
+            _settings['compress']
+        )
+    state.record(ark, input_hash, path)
+    return path, 'written' if written else 'unchanged'
+
+
+def build(arks, output_dir, domain, processes, force=False, compact=False,
+          pstats_path=None, validate=False, compress=True):
+    """Build manifests for a list of ARKs. Metrics from the workers are
+       merged into this process's; see instrumentation.py.
+
+    Returns:
+      tuple: (dict of output paths by status, dict of failures by ARK)
+    """
+    results = {'skipped': [], 'unchanged': [], 'written': []}
+    failures = {}
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_worker,
+        initargs=(
+            domain,
+            output_dir,
+            force,
+            compact,
+            get_database(),
+            get_pairtree_root(),
+            pstats_path,
+            validate,
+            compress
+        )
+    ) as executor:
+        futures = {executor.submit(_build, ark): ark for ark in arks}
+        for future in as_completed(futures):
+            ark = futures[future]
+            try:
+                path, status, metrics = future.result()
+                results[status].append(path)
+                merge(metrics)
+                count('manifests.' + status)
+            except Exception:
+                failures[ark] = traceback.format_exc()
+                count('manifests.failed')
+    return results, failures
+
+
+def main():
+    options = docopt(__doc__)
+    if options['--ark-db']:
+        set_database(options['--ark-db'])
+    if options['--pairtree-root']:
+        set_pairtree_root(options['--pairtree-root'])
+
+    if options['--collection']:
+        arks = get_arks_for_collection(options['--collection'])
+    else:
+        arks = options['<ark>']
+
+    start = time.perf_counter()
+    with profile(
+        options['--profile'],
+        options['--pstats'],
+        options['--metrics-json']
+    ):
+        results, failures = build(
+            arks,
+            options['--output-dir'],
+            options['--domain'],
+            int(options['--processes']),
+            options['--force'],
+            options['--compact'],
+            options['--pstats'],
+            options['--validate'],
+            not options['--no-compress']
+        )
+    seconds = time.perf_counter() - start
+    total = sum(len(paths) for paths in results.values())
+
+    for ark, error in sorted(failures.items()):
+        sys.stderr.write('FAILED {}\n{}\n'.format(ark, error))
+    sys.stderr.write(
+        '{} manifests in {:.1f}s ({:.2f} manifests/sec): '
+        '{} written, {} unchanged, {} skipped, {} failures\n'.format(
+            total,
+            seconds,
+            total / seconds if seconds else 0.0,
+            len(results['written']),
+            len(results['unchanged']),
+            len(results['skipped']),
+            len(failures)
+        )
+    )
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
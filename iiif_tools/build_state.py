@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Record what each output file was built from, so rebuilds can skip it.
+
+For every output the build state stores a hash of its inputs- OCFL head
+versions, metadata records, the builder's own source code- and the path it
+was written to. If the inputs hash the same on the next run, and the file
+is still there, the output doesn't need to be built again.
+"""
+
+import filecmp
+import hashlib
+import os
+import sqlite3
+import threading
+
+from instrumentation import span
+
+
+def hash_inputs(*parts):
+    """Hash a sequence of inputs (str, bytes or None) into a hex digest.
+
+    Returns None if any part is None, meaning that input couldn't be
+    determined and the output should always be rebuilt.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            return None
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(str(len(part)).encode('ascii') + b':')
+        h.update(part)
+    return h.hexdigest()
+
+
+def code_version(*paths):
+    """Hash the source of a builder and the modules it depends on."""
+    parts = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            parts.append(f.read())
+    return hash_inputs(*parts)
+
+
+def write_if_changed(path, text):
+    """Write text to path, unless the file already holds exactly these
+       bytes. text can be a str or bytes, or an iterable of chunks of
+       either, e.g. from json_writer.iterencode(); chunks are written to a
+       temporary file as they arrive and compared with the existing file
+       at the end. The file is then renamed into place, so readers never
+       see it half written.
+
+    Returns:
+      bool: True if the file was written.
+    """
+    if isinstance(text, (str, bytes)):
+        text = [text]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in text:
+                f.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        if os.path.exists(path) and filecmp.cmp(tmp, path, shallow=False):
+            return False
+        os.replace(tmp, path)
+        return True
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class BuildState:
+    """SQLite table of key -> (input hash, output path)."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute(
+            '''CREATE TABLE IF NOT EXISTS build_state (
+                   key TEXT PRIMARY KEY,
+                   input_hash TEXT NOT NULL,
+                   output_path TEXT NOT NULL
+               )'''
+        )
+        self.conn.commit()
+
+    def is_fresh(self, key, input_hash):
+        """Returns the output path if key was last built from input_hash and
+           its output still exists, otherwise None."""
+        if input_hash is None:
+            return None
+        with self.lock, span('sqlite'):
+            row = self.conn.execute(
+                'SELECT input_hash, output_path FROM build_state WHERE key = ?',
+                (key,)
+            ).fetchone()
+        if row is None or row[0] != input_hash or not os.path.exists(row[1]):
+            return None
+        return row[1]
+
+    def record(self, key, input_hash, output_path):
+        if input_hash is None:
+            return
+        with self.lock, span('sqlite'):
+            self.conn.execute(
+                '''INSERT OR REPLACE INTO build_state (key, input_hash, output_path)
+                   VALUES (?, ?, ?)''',
+                (key, input_hash, output_path)
+            )
+            self.conn.commit()
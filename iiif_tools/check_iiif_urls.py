@@ -1,22 +1,282 @@
-import json, requests, sys
+#!/usr/bin/env python
 
-# e.g.  https://iiif-collection-dev.lib.uchicago.edu/social-scientists-map-chicago.json
+"""Usage:
+   check_iiif_urls <url> [--concurrency=<n>] [--per-host=<n>] [--timeout=<seconds>] [--match=<string>] [--state=<path>] [--json=<path>] [--csv=<path>]
 
-urls = {}
+Check every URL in a tree of IIIF collections, e.g.
+https://iiif-collection-dev.lib.uchicago.edu/social-scientists-map-chicago.json
 
-def add_url_status(u):
-    if not u in urls:
-        r = requests.get(u)
-        urls[u] = r.status_code
+Collections are fetched and their members followed- items (v3) or
+members/manifests/collections (v2). Whether a member is a collection is
+decided from its own JSON, not from the type its parent gives it, since
+e.g. the ssmaps browse collections list their sub-collections as
+Manifests. So every JSON document, and every member typed as a
+collection, is fetched with GET; anything else is checked with a HEAD
+request, falling back to GET if the server doesn't allow HEAD.
 
-        if r.status_code == 200:
-            data = json.loads(r.text)
-            for item in data['items']:
-                if 'lib.uchicago.edu' in item['id']:
-                    add_url_status(item['id'])
+With --state, ETags and Last-Modified dates from the previous run are
+sent as conditional requests, and collections that haven't changed are
+not downloaded again.
 
-if __name__=='__main__':
-    add_url_status(sys.argv[1])
+Options:
+  --concurrency=<n>      Requests in flight at once [default: 16].
+  --per-host=<n>         Requests in flight to any one host [default: 8].
+  --timeout=<seconds>    Timeout for each request [default: 30].
+  --match=<string>       Only follow URLs containing this string [default: lib.uchicago.edu].
+  --state=<path>         JSON file of ETags and results from the last run.
+  --json=<path>          Write a JSON report.
+  --csv=<path>           Write a CSV report.
+"""
+
+import asyncio
+import collections
+import csv
+import json
+import sys
+import time
+import urllib.parse
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from docopt import docopt
+from http_session import get_session
+
+
+def get_members(data):
+    """Returns [(url, is_collection), ...] for the members of a v2 or v3
+       collection. Anything that isn't shaped like one- a document that is
+       a JSON array, a member that isn't an object- is skipped."""
+    members = []
+    if not isinstance(data, dict):
+        return members
+    for key in ('items', 'members', 'collections', 'manifests'):
+        items = data.get(key)
+        if not isinstance(items, list):
+            continue
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            url = item.get('id') or item.get('@id')
+            item_type = item.get('type') or item.get('@type') or ''
+            if isinstance(url, str) and url:
+                members.append((url, 'Collection' in str(item_type)))
+    return members
+
+
+def is_collection(data):
+    if not isinstance(data, dict):
+        return False
+    return 'Collection' in str(data.get('type') or data.get('@type') or '')
+
+
+def should_fetch(url, declared_collection):
+    """Whether to GET a member and look inside it: anything its parent
+       calls a collection, and any JSON document, whatever its parent
+       calls it."""
+    return declared_collection or \
+        urllib.parse.urlparse(url).path.endswith('.json')
+
+
+def check_url(url, fetch, previous=None, timeout=30):
+    """Check one URL. With fetch, it is downloaded, and if it turns out to
+       be a collection its members are returned to be followed; otherwise
+       it gets a HEAD request.
+
+    Args:
+      previous (dict): this URL's entry in the state file from the last
+        run, if any.
+
+    Returns:
+      dict: status, method, elapsed, etag, last_modified, members.
+    """
+    headers = {}
+    if previous:
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+
+    start = time.perf_counter()
+    method = 'GET' if fetch else 'HEAD'
+    r = get_session().request(
+        method,
+        url,
+        headers=headers,
+        allow_redirects=True,
+        timeout=timeout,
+        stream=not fetch
+    )
+    if method == 'HEAD' and r.status_code in (405, 501):
+        method = 'GET'
+        r = get_session().get(
+            url,
+            headers=headers,
+            allow_redirects=True,
+            timeout=timeout,
+            stream=True
+        )
+
+    result = {
+        'status': r.status_code,
+        'method': method,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'members': [],
+        'not_modified': False
+    }
+    if r.status_code == 304 and previous:
+        result['status'] = previous['status']
+        result['etag'] = result['etag'] or previous.get('etag')
+        result['last_modified'] = result['last_modified'] or previous.get('last_modified')
+        result['members'] = previous.get('members', [])
+        result['not_modified'] = True
+    elif fetch and r.status_code == 200:
+        try:
+            data = r.json()
+        except ValueError:
+            data = None
+        if is_collection(data):
+            result['members'] = get_members(data)
+    r.close()
+    result['elapsed'] = time.perf_counter() - start
+    return result
+
+
+async def crawl(start_url, concurrency=16, per_host=8, timeout=30,
+                match='lib.uchicago.edu', state=None):
+    """Check start_url and everything reachable from it.
+
+    Returns:
+      dict: results by URL, each with the URL's parent added.
+    """
+    state = state or {}
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    host_limits = collections.defaultdict(lambda: asyncio.Semaphore(per_host))
+    queue = asyncio.Queue()
+    seen = {start_url}
+    results = {}
+
+    async def worker():
+        while True:
+            url, fetch, parent = await queue.get()
+            try:
+                try:
+                    async with host_limits[urllib.parse.urlparse(url).netloc]:
+                        result = await loop.run_in_executor(
+                            executor,
+                            check_url,
+                            url,
+                            fetch,
+                            state.get(url),
+                            timeout
+                        )
+                except Exception as e:
+                    # anything unexpected is reported against this URL,
+                    # rather than ending the worker and leaving the crawl
+                    # waiting on the queue forever.
+                    result = {
+                        'status': None,
+                        'method': None,
+                        'error': str(e) if isinstance(e, requests.RequestException)
+                            else '{}: {}'.format(type(e).__name__, e),
+                        'members': []
+                    }
+                result['parent'] = parent
+                results[url] = result
+                for member_url, member_is_collection in result['members']:
+                    if match in member_url and member_url not in seen:
+                        seen.add(member_url)
+                        queue.put_nowait((
+                            member_url,
+                            should_fetch(member_url, member_is_collection),
+                            url
+                        ))
+            finally:
+                queue.task_done()
 
-    for k, v in urls.items():
-        print('{} {}'.format(v, k))
+    queue.put_nowait((start_url, True, None))
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    await queue.join()
+    for w in workers:
+        w.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    executor.shutdown()
+    return results
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, results):
+    state = {}
+    for url, result in results.items():
+        if result.get('status') is not None:
+            state[url] = {
+                'status': result['status'],
+                'etag': result.get('etag'),
+                'last_modified': result.get('last_modified'),
+                'members': result['members']
+            }
+    with open(path, 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+
+
+REPORT_FIELDS = ('url', 'status', 'method', 'elapsed', 'not_modified', 'parent', 'error')
+
+
+def write_json_report(path, results):
+    with open(path, 'w') as f:
+        json.dump(
+            [
+                dict({'url': url}, **{k: r.get(k) for k in REPORT_FIELDS if k != 'url'})
+                for url, r in sorted(results.items())
+            ],
+            f,
+            indent=4,
+            sort_keys=True
+        )
+
+
+def write_csv_report(path, results):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_FIELDS)
+        for url, r in sorted(results.items()):
+            writer.writerow([url] + [r.get(k) for k in REPORT_FIELDS[1:]])
+
+
+def main():
+    options = docopt(__doc__)
+
+    state = load_state(options['--state']) if options['--state'] else {}
+
+    results = asyncio.run(
+        crawl(
+            options['<url>'],
+            concurrency=int(options['--concurrency']),
+            per_host=int(options['--per-host']),
+            timeout=float(options['--timeout']),
+            match=options['--match'],
+            state=state
+        )
+    )
+
+    if options['--state']:
+        save_state(options['--state'], results)
+    if options['--json']:
+        write_json_report(options['--json'], results)
+    if options['--csv']:
+        write_csv_report(options['--csv'], results)
+
+    for url, r in results.items():
+        sys.stdout.write('{} {}\n'.format(r['status'], url))
+
+
+if __name__=='__main__':
+    main()
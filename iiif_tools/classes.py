@@ -1,64 +1,326 @@
 # -*- coding: utf-8 -*-
-import json
+import ocfl_inventory
 import os
 import requests
 import sqlite3
+import threading
+import time
 import urllib.parse
 import uuid
+import xml.etree.ElementTree as ElementTree
 
-from io import BytesIO
-from metadata_converters.classes import SocSciMapsMarcXmlToDc
-
-from PIL import Image
-Image.MAX_IMAGE_PIXELS = 1000000000
+from array import array
+from ark_resolver import get_resolver
+from concurrent.futures import ThreadPoolExecutor
+from http_session import get_session
+from image_probe import probe_image
+from instrumentation import count, span
+from json_writer import dump, iterencode
+from provider import LOGO_URL, get_logo
+from thumbnails import IMAGE_SERVER, SCALE_FACTORS, fit_columns, get_thumbnail_url
+from validate import VALIDATE, check
 
 def get_ark_from_original_identifier(identifier):
-    conn = sqlite3.connect('/data/s4/jej/ark_data.db')
-    c = conn.cursor()
-    c.execute("SELECT ark FROM arks WHERE original_identifier = '%s'" % identifier)
-    return c.fetchone()[0]
+    return get_resolver().get_ark(identifier)
 
 def get_original_identifier_from_ark(ark):
-    conn = sqlite3.connect('/data/s4/jej/ark_data.db')
-    c = conn.cursor()
-    c.execute("SELECT original_identifier FROM arks WHERE ark = '%s'" % ark)
-    return c.fetchone()[0]
+    return get_resolver().get_original_identifier(ark)
+
+def get_arks_from_original_identifier_prefix(prefix):
+    '''Returns ARKs for every object whose original identifier starts with
+        prefix, e.g. 'gms-'.'''
+    return get_resolver().get_arks_with_prefix(prefix)
+
+IMAGE_SIZE_CACHE = os.environ.get(
+    'IIIF_TOOLS_IMAGE_SIZE_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'iiif_tools', 'image_sizes.db')
+)
+
+MANIFEST_DOMAIN = 'https://iiif-manifest.lib.uchicago.edu'
+
+# where file.tif and file.dc.xml for each ARK are served from.
+ARK_SERVER = os.environ.get('IIIF_TOOLS_ARK_SERVER', 'https://ark.lib.uchicago.edu')
+
+PROBE_WORKERS = int(os.environ.get('IIIF_TOOLS_PROBE_WORKERS', 8))
+PROBE_TIMEOUT = 30
+PROBE_RETRIES = 3
+
+def get_inventory_path(ark):
+    return ocfl_inventory.get_inventory_path(ark)
+
+def get_inventory_version(ark):
+    '''Returns the OCFL head version for an ARK, e.g. 'v2', or None if its
+        inventory.json is not available.'''
+    try:
+        return ocfl_inventory.load_inventory(ark).head
+    except FileNotFoundError:
+        return None
 
 def get_digital_objects_from_ark(ark):
     '''Returns a list of page objects, 
         e.g. ['00000001', '00000002', '00000003']'''
-    noid = ark.split('/')[-1]
-    inventory_path = '/data/digital_collections/ark_data/{}/inventory.json'.format(
-        os.sep.join([noid[i:i+2] for i in range(0, len(noid), 2)])
+    return ocfl_inventory.load_inventory(ark).get_objects()
+
+def get_files_from_ark(ark, object_number=None):
+    '''Returns the files in the head version of a page object, e.g.
+        ['file.dc.xml', 'file.tif'], or at the top of the object if
+        object_number is None.'''
+    return ocfl_inventory.load_inventory(ark).get_files(object_number)
+
+def get_file_url_from_ark(ark, name, object_number=None):
+    '''Returns the URL of a file in an ARK, e.g. 'file.dc.xml', or in one of
+        its page objects, e.g. '00000001'.'''
+    if object_number is None:
+        return '{}/{}/{}'.format(ARK_SERVER, ark, name)
+    else:
+        return '{}/{}/{}/{}'.format(ARK_SERVER, ark, object_number, name)
+
+def get_image_url_from_ark(ark, object_number=None):
+    '''Returns the URL of the master image for an ARK, or for one of its
+        page objects, e.g. '00000001'.'''
+    return get_file_url_from_ark(ark, 'file.tif', object_number)
+
+def get_dc_from_ark(ark):
+    '''Fetch and parse the DC record for an ARK, file.dc.xml.'''
+    with span('http'):
+        r = get_session().get(get_file_url_from_ark(ark, 'file.dc.xml'))
+    count('http.requests')
+    count('http.bytes', len(r.content))
+    with span('xml'):
+        return ElementTree.fromstring(r.content)
+
+class ImageSizeCache:
+    """Persistent cache of master image dimensions.
+
+       Rows are keyed by (ark, object number) and record the OCFL head
+       version they were read from. When an object gets a new version in
+       the repository, its rows no longer match and are probed again.
+    """
+
+    def __init__(self, path=IMAGE_SIZE_CACHE):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            '''CREATE TABLE IF NOT EXISTS image_sizes (
+                   ark TEXT NOT NULL,
+                   object_number TEXT NOT NULL,
+                   width INTEGER NOT NULL,
+                   height INTEGER NOT NULL,
+                   mime_type TEXT NOT NULL,
+                   version TEXT,
+                   PRIMARY KEY (ark, object_number)
+               )'''
+        )
+        self.conn.commit()
+
+    def get(self, ark, object_number=None, version=None):
+        '''Returns (width, height, mime_type), or None on a miss. Pass the
+            current OCFL head version to ignore rows from older versions.'''
+        with self.lock, span('sqlite'):
+            row = self.conn.execute(
+                '''SELECT width, height, mime_type, version FROM image_sizes
+                   WHERE ark = ? AND object_number = ?''',
+                (ark, object_number or '')
+            ).fetchone()
+        if row is None:
+            return None
+        if version is not None and row[3] != version:
+            # stale; the caller probes it again, and set() replaces it.
+            return None
+        return row[:3]
+
+    def set(self, ark, object_number, width, height, mime_type, version=None):
+        with self.lock, span('sqlite'):
+            self.conn.execute(
+                '''INSERT OR REPLACE INTO image_sizes
+                   (ark, object_number, width, height, mime_type, version)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                (ark, object_number or '', width, height, mime_type, version)
+            )
+            self.conn.commit()
+
+    def invalidate(self, ark, version=None):
+        '''Delete the rows for an ARK, or with version, only the rows
+            that weren't read from that version.'''
+        with self.lock, span('sqlite'):
+            if version is None:
+                self.conn.execute('DELETE FROM image_sizes WHERE ark = ?', (ark,))
+            else:
+                self.conn.execute(
+                    'DELETE FROM image_sizes WHERE ark = ? AND version IS NOT ?',
+                    (ark, version)
+                )
+            self.conn.commit()
+
+_image_size_cache = None
+_image_size_cache_pid = None
+
+def get_image_size_cache():
+    '''Returns the image size cache for this process. A SQLite connection
+        can't be shared with a forked child, so a child opens its own.'''
+    global _image_size_cache, _image_size_cache_pid
+    if _image_size_cache is None or _image_size_cache_pid != os.getpid():
+        _image_size_cache = ImageSizeCache()
+        _image_size_cache_pid = os.getpid()
+    return _image_size_cache
+
+def get_image_size_from_ark(ark, object_number=None, timeout=None):
+    '''Returns (width, height) for an ARK's master image. Sizes come from
+        the image size cache when possible, otherwise from the image
+        header.'''
+    cache = get_image_size_cache()
+    version = get_inventory_version(ark)
+
+    cached = cache.get(ark, object_number, version)
+    if cached is not None:
+        count('image_size_cache.hit')
+        return cached[:2]
+    count('image_size_cache.miss')
+
+    width, height, mime_type = probe_image(
+        get_image_url_from_ark(ark, object_number),
+        timeout
     )
-    with open(inventory_path) as f:
-        data = json.load(f)
+    cache.set(ark, object_number, width, height, mime_type, version)
+    return width, height
+
+def _is_transient(e):
+    '''True for request errors worth retrying: connection failures,
+        timeouts and 5xx responses, but not e.g. a 404.'''
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(e, 'response', None)
+    return response is not None and response.status_code >= 500
+
+def get_image_sizes_from_ark(ark, object_numbers, max_workers=PROBE_WORKERS,
+                             timeout=PROBE_TIMEOUT, retries=PROBE_RETRIES):
+    '''Returns [(width, height), ...] for a list of page objects, in the
+        same order as object_numbers. Pages are probed on a bounded thread
+        pool; each request gets a timeout and transient failures are
+        retried with a short backoff. Each page, retries included, is
+        timed as a page_probe span.'''
+    def probe(object_number):
+        with span('page_probe'):
+            for attempt in range(retries + 1):
+                try:
+                    return get_image_size_from_ark(ark, object_number, timeout)
+                except requests.RequestException as e:
+                    if attempt == retries or not _is_transient(e):
+                        raise
+                    count('image_probe.retries')
+                    time.sleep(0.5 * 2 ** attempt)
+
+    # read the inventory once, up front, rather than from every worker, and
+    # drop rows from older versions of the object in one statement.
+    version = get_inventory_version(ark)
+    if version is not None:
+        get_image_size_cache().invalidate(ark, version)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(probe, object_numbers))
+
+class Page:
+    '''One row of a PageTable.'''
+    __slots__ = ('n', 'width', 'height', 'service_url')
+
+    def __init__(self, n, width, height, service_url):
+        self.n = n
+        self.width = width
+        self.height = height
+        self.service_url = service_url
 
-    objects = []
-    for file_hash in data['versions'][data['head']]['state'].values():
-        for f in file_hash:
-            if f.endswith('/file.tif'):
-                objects.append(f.split('/')[0])
+class PageTable:
+    '''The pages of a manifest: widths and heights in arrays, and image
+        server URLs quoted once per page rather than each time a canvas,
+        annotation or thumbnail needs one.'''
+    def __init__(self, ark, server=IMAGE_SERVER):
+        self.ark = ark
+        self.server = server
+        self.widths = array('I')
+        self.heights = array('I')
+        self._service_urls = None
+        self._thumbnail_sizes = {}
+
+    def __len__(self):
+        return len(self.widths)
+
+    def append(self, width, height):
+        self.widths.append(width)
+        self.heights.append(height)
+        self._service_urls = None
+        self._thumbnail_sizes = {}
+
+    def _get_service_urls(self):
+        # a single image is served as the ARK itself, pages of a multi-page
+        # object as ARK/00000001, ARK/00000002, ...
+        if self._service_urls is None:
+            prefix = '{}/{}'.format(
+                self.server,
+                urllib.parse.quote(self.ark, safe='')
+            )
+            if len(self) == 1:
+                self._service_urls = [prefix]
+            else:
+                self._service_urls = [
+                    '{}%2F{:08}'.format(prefix, n+1) for n in range(len(self))
+                ]
+        return self._service_urls
+
+    def service_url(self, n):
+        return self._get_service_urls()[n]
 
-    return sorted(objects)
+    def thumbnail_size(self, n, max_size):
+        '''Best-fit thumbnail size for page n. Sizes are computed for every
+            page at once, the first time one is asked for.'''
+        if max_size not in self._thumbnail_sizes:
+            self._thumbnail_sizes[max_size] = fit_columns(
+                self.widths,
+                self.heights,
+                max_size,
+                SCALE_FACTORS
+            )
+        widths, heights = self._thumbnail_sizes[max_size]
+        return widths[n], heights[n]
+
+    def __getitem__(self, n):
+        return Page(n, self.widths[n], self.heights[n], self.service_url(n))
+
+    def __iter__(self):
+        service_urls = self._get_service_urls()
+        for n in range(len(self)):
+            yield Page(n, self.widths[n], self.heights[n], service_urls[n])
 
 class IIIFManifest:
-    def __init__(self, domain, identifier, ark, title, summary, required_statement):
+    def __init__(self, domain, identifier, ark, title, summary, required_statement,
+                 random_ids=False):
         self.domain = domain
         self.identifier = identifier
         self.ark = ark
         self.title = title
         self.summary = summary
         self.required_statement = required_statement
-        self.image_sizes = []
+        self.random_ids = random_ids
+        self.pages = PageTable(ark)
+
+        self.logo_url = LOGO_URL
+        logo = get_logo(self.logo_url)
+        self.logo_size = (logo.width, logo.height)
+        self.logo_mime_type = logo.mime_type
 
-        self.logo_url = 'https://www.lib.uchicago.edu/static/base/images/color-logo.png'
-        with BytesIO(
-            requests.get(self.logo_url).content
-        ) as f:
-            img = Image.open(f)
-        self.logo_size = img.size
-        self.logo_mime_type = 'image/png'
+    def _add_images(self, object_numbers):
+        '''Add image sizes for a list of page objects. Use [None] for an
+            ARK with a single file.tif.'''
+        with span('images'):
+            sizes = get_image_sizes_from_ark(self.ark, object_numbers)
+        for width, height in sizes:
+            self.pages.append(width, height)
+
+    @property
+    def image_sizes(self):
+        '''[(width, height), ...] for each page.'''
+        return list(zip(self.pages.widths, self.pages.heights))
 
     def _get_provider(self):
         return [
@@ -74,28 +336,33 @@ class IIIFManifest:
                         'format': 'text/html'
                      }
                 ],
-                'logo': [
-                     {
-                         'id': self.logo_url,
-                         'type': 'Image',
-                         'format': self.logo_mime_type,
-                         'height': self.logo_size[1],
-                         'width': self.logo_size[0]
-                     }
-                 ]
+                'logo': [ self._get_logo() ]
              }
          ]
 
-    def _get_thumbnail(self, n, width):
+    def _get_logo(self):
+        logo = {
+            'id': self.logo_url,
+            'type': 'Image',
+            'format': self.logo_mime_type
+        }
+        # offline, a logo that has never been fetched has no known size.
+        if self.logo_size[0] is not None:
+            logo['height'] = self.logo_size[1]
+            logo['width'] = self.logo_size[0]
+        return logo
+
+    def _get_thumbnail(self, page, max_size):
+        size = self.pages.thumbnail_size(page.n, max_size)
         return [
             {
-                'id': '{}/full/{},/0/default.jpg'.format(
-                    self._get_imageserver_url(n),
-                    width
-                ),
+                'id': get_thumbnail_url(page.service_url, size),
+                'format': 'image/jpeg',
+                'height': size[1],
+                'width': size[0],
                 'service': [
                     {
-                        '@id': self._get_imageserver_url(n),
+                        '@id': page.service_url,
                         '@type': 'ImageService2',
                         'profile': 'http://iiif.io/api/image/2/level2.json'
                     }
@@ -104,55 +371,72 @@ class IIIFManifest:
             }
         ]
 
-    def _get_canvases(self):
-        canvases = []
-        for n in range(len(self.image_sizes)):
-            canvas_id = 'https://{}'.format(str(uuid.uuid4()))
-            canvases.append({
-                'height': self._get_height(n),
+    def _get_id(self, n, kind):
+        '''Returns an id for part of page n, where kind is 'canvas',
+            'annotation-page', 'annotation' or 'image'. IDs are UUIDv5s of
+            the ARK, page and kind, so an unchanged object always gets the
+            same IDs. With random_ids=True they are random UUIDs instead.'''
+        if self.random_ids:
+            return 'https://{}'.format(str(uuid.uuid4()))
+        return 'https://{}'.format(str(uuid.uuid5(
+            uuid.NAMESPACE_URL,
+            '{}/{:08}/{}'.format(self.ark, n+1, kind)
+        )))
+
+    def _iter_canvases(self):
+        for page in self.pages:
+            canvas_id = self._get_id(page.n, 'canvas')
+            yield {
+                'height': page.height,
                 'id': canvas_id,
-                'items': [ self._get_annotation_page(n, canvas_id) ],
-                'label': { 'en': [ 'Image {:03d}'.format(n+1) ] },
-                'thumbnail': self._get_thumbnail(n, 200),
+                'items': [ self._get_annotation_page(page, canvas_id) ],
+                'label': { 'en': [ 'Image {:03d}'.format(page.n+1) ] },
+                'thumbnail': self._get_thumbnail(page, 200),
                 'type': 'Canvas',
-                'width': self._get_width(n)
-            })
-        return canvases
+                'width': page.width
+            }
+
+    def _get_canvases(self):
+        return list(self._iter_canvases())
 
-    def _get_annotation_page(self, n, canvas_id):
-        annotation_id = 'https://{}'.format(str(uuid.uuid4()))
+    def _get_annotation_page(self, page, canvas_id):
+        n = page.n
         return {
-            'id': annotation_id,
+            'id': self._get_id(n, 'annotation-page'),
             'type': 'AnnotationPage',
             'items': [
                 {
-                    'id': annotation_id,
+                    'id': self._get_id(n, 'annotation'),
                     'type': 'Annotation',
                     'motivation': 'Painting',
                     'target': canvas_id,
                     'body': {
                         'format': 'image/jpeg',
-                        'height': self._get_height(0),
-                        'id': 'https://{}'.format(str(uuid.uuid4())),
+                        'height': self.pages.heights[0],
+                        'id': self._get_id(n, 'image'),
                         'service': [
                             {
-                                '@id': self._get_imageserver_url(n),
+                                '@id': page.service_url,
                                 '@type': 'ImageService2',
                                 'profile': 'http://iiif.io/api/image/2/level2.json'
                             }
                         ],
                         'type': 'Image',
-                        'width': self._get_width(0)
+                        'width': self.pages.widths[0]
                     }
                 }
             ]
         }
 
-    def data(self):
-        if len(self.image_sizes) > 1:
+    def data(self, lazy=False):
+        '''Returns the manifest as a dict. With lazy=True, 'items' is a
+            generator of canvases, for use with json_writer.'''
+        if len(self.pages) > 1:
             behavior = 'paged'
         else:
             behavior = 'non-paged'
+        with span('metadata'):
+            metadata = self._get_metadata()
         manifest = {
             '@context': [
                 'http://iiif.io/api/presentation/3/context.json',
@@ -160,9 +444,9 @@ class IIIFManifest:
             ],
             'behavior': [ behavior ],
             'id': self._get_manifest_url(),
-            'items': self._get_canvases(),
+            'items': self._iter_canvases() if lazy else self._get_canvases(),
             'type': 'Manifest',
-            'metadata': self._get_metadata(),
+            'metadata': metadata,
             'provider': self._get_provider(),
             'label': { 'en': [ self.title ] },
             'requiredStatement': {
@@ -175,37 +459,53 @@ class IIIFManifest:
                     self.summary
                 ]
             },
-            'thumbnail': self._get_thumbnail(0, 500)
+            'thumbnail': self._get_thumbnail(self.pages[0], 500)
         }
-        if len(self.image_sizes) > 1:
+        if len(self.pages) > 1:
             manifest['viewingDirection'] = 'left-to-right'
         return manifest
 
+    def _data_to_write(self, validate=None):
+        '''The manifest to encode. With validate- by default, if
+            IIIF_TOOLS_VALIDATE is set- the whole manifest is built and
+            checked against the IIIF schema first, and an invalid manifest
+            raises validate.ValidationError instead of being written.'''
+        if validate is None:
+            validate = VALIDATE
+        if not validate:
+            return self.data(lazy=True)
+        data = self.data()
+        check(data, self._get_manifest_url())
+        return data
+
+    def write(self, f, compact=False, validate=None):
+        '''Write the manifest as JSON to a file handle, one canvas at a
+            time.'''
+        with span('json'):
+            dump(self._data_to_write(validate), f, compact)
+
+    def iterencode(self, compact=False, validate=None):
+        return iterencode(self._data_to_write(validate), compact)
+
+    def _get_manifest_url(self):
+        # e.g. https://iiif-manifest.lib.uchicago.edu/gms/0019/gms-0019.json
+        return '{}/{}/{}.json'.format(
+            self.domain,
+            '/'.join(self.identifier.split('-')),
+            self.identifier
+        )
+
     def _get_width(self, n):
-        return self.image_sizes[n][0]
+        return self.pages.widths[n]
             
     def _get_height(self, n):
-        return self.image_sizes[n][1]
+        return self.pages.heights[n]
 
     def _get_imageserver_url(self, n):
-        if len(self.image_sizes) == 1:
-            return 'https://iiif-server.lib.uchicago.edu/{}'.format(
-                urllib.parse.quote(self.ark, safe='')
-            )
-        else:
-            return 'https://iiif-server.lib.uchicago.edu/{}'.format(
-                urllib.parse.quote(
-                    '{}/{:08}'.format(self.ark, n+1),
-                    safe=''
-                )
-            )
+        return self.pages.service_url(n)
 
     def _get_imageserver_url_thumb(self, max_size):
-        thumbnail_size = [round(1.0 * max_size / max(self.image_sizes[0] * d))
-                          for d in self.image_sizes[0]]
-
-        return '{}/full/{},{}/0/default.jpg'.format( 
+        return get_thumbnail_url(
             self._get_imageserver_url(0),
-            thumbnail_size[0],
-            thumbnail_size[1]
+            self.pages.thumbnail_size(0, max_size)
         )
@@ -1,57 +1,258 @@
 #!/usr/bin/env python
 
 """Usage:
-   cli_collection_browse <collection-url>
+   cli_collection_browse <collection-url> [--depth=<n>] [--workers=<n>] [--timeout=<seconds>] [--cache=<path>] [--cache-ttl=<seconds>]
 
 https://iiif-collection.lib.uchicago.edu/top.json
+
+Members are checked concurrently with HEAD requests, and member
+collections are followed down to --depth levels. Whether a member is a
+collection is decided from its own JSON, since some collections list their
+sub-collections as Manifests. Lines are printed in
+collection order as soon as the checks for them are done. Both v2
+(members, @id, viewingHint) and v3 (items, id, behavior) collections can be
+browsed.
+
+Options:
+  --depth=<n>             How many levels of collections to show [default: 1].
+  --workers=<n>           Requests in flight at once [default: 16].
+  --timeout=<seconds>     Timeout for each request [default: 30].
+  --cache=<path>          JSON file of recent reachability results.
+  --cache-ttl=<seconds>   How long a cached result is good for [default: 300].
 """
 
-import json, urllib.request, sys 
+import json
+import sys
+import threading
+import time
+import urllib.parse
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from docopt import docopt
+from http_session import get_session
+
+
+def get_members(collection):
+    """Returns the member list of a v2 or v3 collection. v2 collections
+       may list members, or separate collections and manifests. Members
+       that aren't JSON objects are skipped.
+
+    Raises:
+      ValueError: if the collection isn't a JSON object, or its members
+        aren't a list.
+    """
+    if not isinstance(collection, dict):
+        raise ValueError('not a collection: expected a JSON object')
+    if 'items' in collection:
+        lists = [collection['items']]
+    elif 'members' in collection:
+        lists = [collection['members']]
+    else:
+        lists = [
+            collection.get('collections', []),
+            collection.get('manifests', [])
+        ]
+    members = []
+    for member_list in lists:
+        if not isinstance(member_list, list):
+            raise ValueError('not a collection: expected a list of members')
+        members.extend(m for m in member_list if isinstance(m, dict))
+    return members
+
+
+def get_label(member):
+    """v2 labels are strings; v3 labels are language maps."""
+    label = member.get('label', '')
+    if isinstance(label, dict):
+        return ' '.join(v for values in label.values() for v in values)
+    return label
+
+
+def get_id(member):
+    return member.get('id') or member.get('@id')
+
+
+def get_type(member):
+    return member.get('type') or member.get('@type') or ''
+
+
+def is_collection(data):
+    return isinstance(data, dict) and 'Collection' in str(get_type(data))
+
+
+def might_be_collection(member):
+    """Anything its parent calls a collection, and any JSON document,
+       whatever its parent calls it."""
+    return 'Collection' in str(get_type(member)) or \
+        urllib.parse.urlparse(get_id(member) or '').path.endswith('.json')
+
+
+def get_hint(member):
+    hint = member.get('behavior', member.get('viewingHint', ''))
+    if isinstance(hint, list):
+        return ' '.join(hint)
+    return hint
+
+
+class ReachabilityCache:
+    """Short-lived on-disk record of which URLs responded.
+
+    Args:
+      path (str): a JSON file, or None to keep results in memory only.
+      ttl (float): seconds a result stays good for.
+    """
+
+    def __init__(self, path=None, ttl=300):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path:
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def get(self, url):
+        """Returns True or False for a recent result, otherwise None."""
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def set(self, url, available):
+        with self.lock:
+            self.entries[url] = [available, time.time()]
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        with self.lock:
+            entries = {
+                url: entry for url, entry in self.entries.items()
+                if now - entry[1] <= self.ttl
+            }
+        with open(self.path, 'w') as f:
+            json.dump(entries, f)
+
+
+class Node:
+    """One member of a collection, with its check running in the pool."""
+
+    def __init__(self, member, depth):
+        self.member = member
+        self.depth = depth
+        self.future = None
+
+
+class Browser:
+    def __init__(self, workers=16, timeout=30, cache=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.timeout = timeout
+        self.cache = cache or ReachabilityCache()
+
+    def is_available(self, url):
+        available = self.cache.get(url)
+        if available is not None:
+            return available
+        try:
+            r = get_session().head(url, allow_redirects=True, timeout=self.timeout)
+            if r.status_code in (405, 501):
+                r = get_session().get(
+                    url,
+                    allow_redirects=True,
+                    timeout=self.timeout,
+                    stream=True
+                )
+                r.close()
+            available = r.status_code < 400
+        except requests.RequestException:
+            available = False
+        self.cache.set(url, available)
+        return available
+
+    def fetch_collection(self, url):
+        r = get_session().get(url, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def schedule(self, members, depth):
+        """Start checking a list of members, returning their Nodes."""
+        nodes = []
+        for member in members:
+            node = Node(member, depth)
+            node.future = self.pool.submit(self.check, node)
+            nodes.append(node)
+        return nodes
+
+    def check(self, node):
+        """Returns (available, child Nodes). Members that may be collections
+           shown expanded are downloaded, and if they are, their own members
+           are scheduled right away, so deeper levels are checked while
+           earlier lines print. A body that isn't a JSON object, or a
+           collection without a list of members, is reported unavailable."""
+        url = get_id(node.member)
+        if node.depth > 1 and might_be_collection(node.member):
+            try:
+                data = self.fetch_collection(url)
+                if isinstance(data, dict) and not is_collection(data):
+                    members = []
+                else:
+                    members = get_members(data)
+            except (requests.RequestException, ValueError):
+                self.cache.set(url, False)
+                return False, []
+            self.cache.set(url, True)
+            return True, self.schedule(members, node.depth - 1)
+        return self.is_available(url), []
+
+    def write_nodes(self, nodes, prefix, out):
+        for i, node in enumerate(nodes):
+            if i < len(nodes) - 1:
+                pipe_char = '|'
+            else:
+                pipe_char = ' '
+
+            available, children = node.future.result()
+
+            out.write('{}|--- {}{}\n'.format(
+                prefix,
+                '' if available else 'UNAVAILABLE ',
+                get_label(node.member)
+            ))
+            for line in (get_id(node.member), get_type(node.member), get_hint(node.member)):
+                out.write('{}{}    {}\n'.format(prefix, pipe_char, line))
+            if children:
+                out.write('{}{}    |\n'.format(prefix, pipe_char))
+                self.write_nodes(children, '{}{}    '.format(prefix, pipe_char), out)
+            out.write('{}{}\n'.format(prefix, pipe_char))
+            out.flush()
+
+    def browse(self, url, depth=1, out=sys.stdout):
+        out.write('+ {}\n|\n'.format(url))
+        out.flush()
+        nodes = self.schedule(get_members(self.fetch_collection(url)), depth)
+        try:
+            self.write_nodes(nodes, '', out)
+        finally:
+            self.pool.shutdown()
+            self.cache.save()
 
-# check to see if files exist at that location. 
 
 def main():
     options = docopt(__doc__)
 
-    sys.stdout.write('+ {}\n|\n'.format(options['<collection-url>']))
-    
-    u = urllib.request.urlopen(options['<collection-url>'])
-    collection = json.loads(u.read().decode())
-   
-    m = 0 
-    while m < len(collection['members']):
-        if m < len(collection['members']) - 1:
-            pipe_char = '|' 
-        else:
-            pipe_char = ' ' 
+    browser = Browser(
+        workers=int(options['--workers']),
+        timeout=float(options['--timeout']),
+        cache=ReachabilityCache(options['--cache'], float(options['--cache-ttl']))
+    )
+    browser.browse(options['<collection-url>'], int(options['--depth']))
 
-        try:
-            urllib.request.urlopen(collection['members'][m]['@id'])
-            error_message = ''
-        except urllib.error.URLError:
-            error_message = 'UNAVAILABLE '
-
-        sys.stdout.write('|--- {}{}\n'.format(
-            error_message,
-            collection['members'][m]['label']
-        ))  
-        sys.stdout.write('{}    {}\n'.format(
-            pipe_char, 
-            collection['members'][m]['@id']
-        ))  
-        sys.stdout.write('{}    {}\n'.format(
-            pipe_char, 
-            collection['members'][m]['@type']
-        ))  
-        sys.stdout.write('{}    {}\n'.format(
-            pipe_char, 
-            collection['members'][m]['viewingHint']
-        ))  
-        sys.stdout.write('{}\n'.format(
-            pipe_char
-        ))  
-        m += 1
 
 if __name__=='__main__':
     main()
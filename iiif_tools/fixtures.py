@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+
+"""Usage:
+   fixtures.py generate <dir> [--gms=<n>] [--speculum=<n>] [--pages=<n>] [--no-rac] [--no-ssmaps]
+   fixtures.py serve <dir> [--host=<host>] [--port=<port>]
+
+A local stand-in for the ARK database, the OCFL pairtree, the ARK server
+and the IIIF image server, so that the builders and checkers can run end
+to end, and be timed, with no network.
+
+generate writes, below <dir>:
+  ark_data/       an OCFL pairtree of inventories for fake objects.
+  ark_data.db     an ARK database for them.
+  objects.json    each ARK's identifier and page sizes, read by serve.
+  logos.json      static logo details, so the logo is never fetched.
+
+write_mvol_issue() writes an mvol issue, and MvolListing stands in for the
+WebDAV server holding a year of them.
+
+Objects are made for real gms, speculum, rac and ssmaps identifiers, so
+each builder finds metadata for them; their images and DC are made up.
+
+serve answers, for every ARK in objects.json:
+  /<ark>[/<page>]/file.tif        a TIFF header for an image of the right
+                                  size, padded out, with Range support.
+  /<ark>/file.dc.xml              DC XML.
+  /<ark>[/<page>]/info.json       IIIF image information (the identifier
+                                  may be URL-quoted, as the image server's is).
+  /<ark>[/<page>]/full/...        a JPEG header.
+and:
+  /manifests/...                  files under <dir>/manifests, e.g. from
+                                  iiif_tools build --output-dir=<dir>
+                                  --domain=<server>/manifests.
+  /collections/top.json           a v2 collection of v3 collections, one
+                                  for each directory in <dir>/manifests.
+  /collections/<name>.json        a v3 collection of the manifests in
+                                  <dir>/manifests/<name>.
+JSON responses have ETags and answer If-None-Match with 304.
+
+serve prints the environment variables that point iiif_tools at the
+fixtures.
+
+Options:
+  --gms=<n>        Number of gms manuscripts [default: 10].
+  --speculum=<n>   Number of speculum prints [default: 100].
+  --pages=<n>      Pages in each manuscript [default: 20].
+  --no-rac         Leave out the rac manuscripts.
+  --no-ssmaps      Leave out the social scientists maps.
+  --host=<host>    Address to listen on [default: 127.0.0.1].
+  --port=<port>    Port to listen on [default: 8000].
+"""
+
+import collections
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import sqlite3
+import struct
+import sys
+import urllib.parse
+
+from docopt import docopt
+
+# how large each fake master TIFF claims to be.
+TIFF_SIZE = 4 * 1024 * 1024
+
+DC_SUBJECTS = (
+    'Ethnic groups',
+    'Housing',
+    'Land use',
+    'Population density',
+    'Social conditions'
+)
+
+
+def make_ark(identifier):
+    # e.g. 'gms-0019' -> 'ark:61001/f5d2b6c0e1a9' - a stable, fake ARK.
+    return 'ark:61001/f{}'.format(hashlib.sha1(identifier.encode('utf-8')).hexdigest()[:11])
+
+
+def make_size(seed):
+    r = random.Random(seed)
+    return [r.randint(2000, 8000), r.randint(2000, 8000)]
+
+
+def tiff_header(width, height):
+    """A little-endian TIFF header with one IFD giving ImageWidth and
+       ImageLength."""
+    entries = ((256, width), (257, height))
+    ifd = struct.pack('<H', len(entries))
+    for tag, value in entries:
+        ifd += struct.pack('<HHII', tag, 4, 1, value)
+    ifd += struct.pack('<I', 0)
+    return b'II*\x00' + struct.pack('<I', 8) + ifd
+
+
+def jpeg(width, height):
+    """A JPEG with only a start-of-frame header, enough to be probed."""
+    sof = struct.pack('>BHHB', 8, height, width, 1) + b'\x01\x11\x00'
+    return b'\xff\xd8\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof + b'\xff\xd9'
+
+
+def dc_xml(identifier, ark):
+    r = random.Random(identifier)
+    year = re.search(r'(18|19)\d\d', identifier)
+    return '\n'.join([
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'xmlns:dcterms="http://purl.org/dc/terms/" '
+        'xmlns:madsrdf="http://www.loc.gov/mads/rdf/v1#">',
+        '  <dc:title>{}</dc:title>'.format(identifier),
+        '  <madsrdf:CorporateName>University of Chicago. Social Science Research Committee.</madsrdf:CorporateName>',
+        '  <dcterms:issued>{}</dcterms:issued>'.format(year.group(0) if year else '1930'),
+        '  <dc:publisher>University of Chicago</dc:publisher>',
+        '  <dc:language>English</dc:language>',
+        '  <dcterms:spatial>Chicago (Ill.)</dcterms:spatial>',
+    ] + [
+        '  <dc:subject>{}</dc:subject>'.format(s)
+        for s in r.sample(DC_SUBJECTS, 2)
+    ] + [
+        '  <dc:type>Maps</dc:type>',
+        '  <dc:identifier>{}</dc:identifier>'.format(ark),
+        '</metadata>',
+        ''
+    ])
+
+
+def get_identifiers(gms, speculum, rac, ssmaps):
+    """Returns {identifier: (ark, paged)}, using real identifiers so the
+       builders find metadata for them. Paged objects have page objects
+       00000001, 00000002, ...; the others have a single file.tif."""
+    from build import load_script
+    from metadata_store import GMS_XML, SPECULUM_JSON, index_gms, index_speculum
+
+    identifiers = {}
+    shelfmarks = [
+        s for s in index_gms(GMS_XML)
+        if re.match(r'^Ms\. \d+$', s)
+    ]
+    for shelfmark in shelfmarks[:gms]:
+        identifier = 'gms-{:04d}'.format(int(shelfmark.split(' ')[1]))
+        identifiers[identifier] = (make_ark(identifier), True)
+    for identifier in list(index_speculum(SPECULUM_JSON))[:speculum]:
+        identifiers[identifier] = (make_ark(identifier), False)
+    if rac:
+        for identifier, ark in load_script('rac_build_manifest').ARKS.items():
+            identifiers[identifier] = (ark, True)
+    if ssmaps:
+        for identifier in load_script('ssmaps_build_collection').socsci_identifiers():
+            identifiers[identifier] = (make_ark(identifier), False)
+    return identifiers
+
+
+def write_inventory(pairtree_root, ark, files):
+    noid = ark.split('/')[-1]
+    directory = os.path.join(
+        pairtree_root,
+        os.sep.join([noid[i:i+2] for i in range(0, len(noid), 2)])
+    )
+    os.makedirs(directory, exist_ok=True)
+    state = {}
+    manifest = {}
+    for path in files:
+        digest = hashlib.sha512('{}/{}'.format(ark, path).encode('utf-8')).hexdigest()
+        state[digest] = [path]
+        manifest[digest] = ['v1/content/{}'.format(path)]
+    with open(os.path.join(directory, 'inventory.json'), 'w') as f:
+        json.dump({
+            'digestAlgorithm': 'sha512',
+            'head': 'v1',
+            'id': ark,
+            'manifest': manifest,
+            'type': 'https://ocfl.io/1.0/spec/#inventory',
+            'versions': {
+                'v1': {
+                    'created': '2020-01-01T00:00:00Z',
+                    'message': 'fixture',
+                    'state': state
+                }
+            }
+        }, f, indent=2, sort_keys=True)
+
+
+def generate(directory, gms=10, speculum=100, pages=20, rac=True, ssmaps=True):
+    from provider import LOGO_URL
+
+    os.makedirs(directory, exist_ok=True)
+    pairtree_root = os.path.join(directory, 'ark_data')
+
+    db_path = os.path.join(directory, 'ark_data.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE arks (ark TEXT PRIMARY KEY, original_identifier TEXT)')
+    conn.execute('CREATE INDEX arks_original_identifier ON arks (original_identifier)')
+
+    objects = {}
+    for identifier, (ark, paged) in sorted(
+        get_identifiers(gms, speculum, rac, ssmaps).items()
+    ):
+        if paged:
+            sizes = {
+                '{:08d}'.format(n): make_size('{}/{}'.format(identifier, n))
+                for n in range(1, pages + 1)
+            }
+            files = []
+            for object_number in sizes:
+                files.append('{}/file.tif'.format(object_number))
+                files.append('{}/file.dc.xml'.format(object_number))
+        else:
+            sizes = {'': make_size(identifier)}
+            files = ['file.tif', 'file.dc.xml']
+        write_inventory(pairtree_root, ark, files)
+        conn.execute('INSERT INTO arks VALUES (?, ?)', (ark, identifier))
+        objects[ark] = {'identifier': identifier, 'sizes': sizes}
+    conn.commit()
+    conn.close()
+
+    with open(os.path.join(directory, 'objects.json'), 'w') as f:
+        json.dump(objects, f, indent=2, sort_keys=True)
+    with open(os.path.join(directory, 'logos.json'), 'w') as f:
+        json.dump(
+            {LOGO_URL: {'width': 600, 'height': 120, 'mime_type': 'image/png'}},
+            f,
+            indent=2
+        )
+    return objects
+
+
+def write_mvol_issue(directory, identifier, pages):
+    """Write an mvol issue the way MvolIIIFManifest reads it: a struct.txt,
+       a METS file with a MIX techMD per page, and a JPEG/ directory with a
+       file per page.
+    """
+    os.makedirs(os.path.join(directory, 'JPEG'), exist_ok=True)
+    with open(os.path.join(directory, identifier + '.struct.txt'), 'w') as f:
+        f.write('object\tpage\tmilestone\n')
+        for n in range(1, pages + 1):
+            f.write('{:08d}\t{}\t\n'.format(n, n))
+    with open(os.path.join(directory, identifier + '.mets.xml'), 'w') as f:
+        f.write(
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<mets:mets xmlns:mets="http://www.loc.gov/METS/" '
+            'xmlns:mix="http://www.loc.gov/mix/v20">\n'
+            '<mets:amdSec>\n'
+        )
+        for n in range(1, pages + 1):
+            width, height = make_size('{}/{}'.format(identifier, n))
+            f.write(
+                '<mets:techMD ID="TMD{0:08d}"><mets:mdWrap MDTYPE="NISOIMG">'
+                '<mets:xmlData><mix:mix><mix:BasicImageInformation>'
+                '<mix:BasicImageCharacteristics>'
+                '<mix:imageWidth>{1}</mix:imageWidth>'
+                '<mix:imageHeight>{2}</mix:imageHeight>'
+                '</mix:BasicImageCharacteristics>'
+                '</mix:BasicImageInformation></mix:mix></mets:xmlData>'
+                '</mets:mdWrap></mets:techMD>\n'.format(n, width, height)
+            )
+        f.write('</mets:amdSec>\n</mets:mets>\n')
+    for n in range(1, pages + 1):
+        open(os.path.join(directory, 'JPEG', '{}_{:04d}.jpg'.format(identifier, n)), 'w').close()
+
+
+class MvolListing:
+    """Stands in for an owncloud.Client holding a made-up year of mvol
+       issues, e.g. /IIIF_Files/mvol/0004/1930/0103/, each with a
+       struct.txt and a TIFF/ directory of page images. Answers list(),
+       file_info() and get_file_contents() the way the client does, with
+       ETags that change when a file below them does, and counts requests.
+
+    Args:
+      directory (str): the year directory.
+      issues (int): number of issue directories, cycling through the
+        days of the year.
+      pages (int): page images in each issue.
+      max_depth (int): refuse PROPFINDs deeper than this with a 403, like
+        a server with depth-infinity disabled.
+    """
+
+    class Entry:
+        def __init__(self, path, file_type, etag=None, size=None):
+            self.path = path
+            self.file_type = file_type
+            self.attributes = {'{DAV:}getetag': etag}
+            if size is not None:
+                self.attributes['{DAV:}getcontentlength'] = str(size)
+
+    class Refused(Exception):
+        status_code = 403
+
+    def __init__(self, directory, issues, pages=0, max_depth=None):
+        self.url = 'http://webdav.invalid/'
+        self.directory = directory.rstrip('/')
+        self.max_depth = max_depth
+        self.requests = 0
+        self.children = {self.directory: []}
+        self.files = {}
+        self.etags = {}
+
+        for n in range(issues):
+            issue = '{:02d}{:02d}'.format(n // 28 % 12 + 1, n % 28 + 1)
+            path = '{}/{}'.format(self.directory, issue)
+            self.children[self.directory].append(path + '/')
+            if path in self.children:
+                continue
+            identifier = '-'.join(['mvol'] + self.directory.split('/')[-2:] + [issue])
+            self.children[path] = []
+            self.add_file(
+                '{}/{}.struct.txt'.format(path, identifier),
+                ''.join(
+                    ['object\tpage\tmilestone\n'] +
+                    ['{:08d}\t{}\t\n'.format(p, p) for p in range(1, pages + 1)]
+                ).encode('utf-8')
+            )
+            self.children[path].append(path + '/TIFF/')
+            self.children[path + '/TIFF'] = []
+            for p in range(1, pages + 1):
+                self.add_file('{}/TIFF/{}_{:04d}.tif'.format(path, identifier, p), b'')
+
+    def add_file(self, path, data):
+        """Add or replace a file, changing the ETag of each directory above
+           it."""
+        parent = os.path.dirname(path)
+        if path not in self.files:
+            self.children[parent].append(path)
+        self.files[path] = data
+        while parent.startswith(self.directory):
+            self.etags.pop(parent, None)
+            parent = os.path.dirname(parent)
+
+    def _etag(self, path):
+        if path in self.files:
+            return '"{}"'.format(hashlib.sha1(self.files[path]).hexdigest())
+        if path not in self.etags:
+            self.etags[path] = '"{}"'.format(hashlib.sha1(''.join(
+                self._etag(child.rstrip('/')) for child in self.children[path]
+            ).encode('utf-8')).hexdigest())
+        return self.etags[path]
+
+    def _info(self, path):
+        stripped = path.rstrip('/')
+        if stripped in self.files:
+            return self.Entry(path, 'file', self._etag(stripped), len(self.files[stripped]))
+        return self.Entry(stripped + '/', 'dir', self._etag(stripped))
+
+    def file_info(self, path):
+        self.requests += 1
+        return self._info(path)
+
+    def list(self, path, depth=1):
+        self.requests += 1
+        if self.max_depth is not None and (depth == 'infinity' or depth > self.max_depth):
+            raise self.Refused(path)
+        entries = []
+        pending = collections.deque([(path.rstrip('/'), 1)])
+        # issues past the end of the year repeat earlier ones; list their
+        # contents once.
+        expanded = set()
+        while pending:
+            directory, level = pending.popleft()
+            for child in self.children.get(directory, []):
+                entries.append(self._info(child))
+                if child.endswith('/') and child not in expanded and \
+                        (depth == 'infinity' or level < depth):
+                    expanded.add(child)
+                    pending.append((child.rstrip('/'), level + 1))
+        return entries
+
+    def get_file_contents(self, path):
+        self.requests += 1
+        return self.files['/' + path.strip('/')]
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    # keep connections open, like the real servers.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond(head=False)
+
+    def send_body(self, status, content_type, body, head, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_json(self, data, head):
+        body = json.dumps(data, indent=4, sort_keys=True).encode('utf-8')
+        self.send_file(body, 'application/json', head)
+
+    def send_file(self, body, content_type, head):
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_body(200, content_type, body, head, {'ETag': etag})
+
+    def send_not_found(self, head):
+        self.send_body(404, 'text/plain', b'not found\n', head)
+
+    def send_tiff(self, width, height, head):
+        header = tiff_header(width, height)
+        start, end = 0, TIFF_SIZE - 1
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), TIFF_SIZE - 1)
+            if start >= TIFF_SIZE:
+                self.send_body(416, 'text/plain', b'', head)
+                return
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, TIFF_SIZE)
+        body = header[start:end + 1]
+        body += b'\0' * (end + 1 - start - len(body))
+        self.send_body(status, 'image/tiff', body, head, headers)
+
+    def find_page(self, path):
+        # e.g. 'ark:61001/f5d2b6c0e1a9/00000001' -> (ark, '00000001')
+        m = re.match(r'^(ark:\d+/[^/]+)(?:/(\d{8}))?$', path)
+        if not m or m.group(1) not in self.server.objects:
+            return None, None
+        sizes = self.server.objects[m.group(1)]['sizes']
+        return m.group(1), sizes.get(m.group(2) or '')
+
+    def respond(self, head):
+        path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path).lstrip('/')
+
+        if path.startswith('manifests/'):
+            local = os.path.normpath(os.path.join(self.server.directory, path))
+            if not local.startswith(os.path.join(self.server.directory, 'manifests')) \
+                    or not os.path.isfile(local):
+                return self.send_not_found(head)
+            with open(local, 'rb') as f:
+                return self.send_file(f.read(), 'application/json', head)
+
+        if path.startswith('collections/') and path.endswith('.json'):
+            collection = self.get_collection(path[len('collections/'):-len('.json')])
+            if collection is None:
+                return self.send_not_found(head)
+            return self.send_json(collection, head)
+
+        for suffix in ('/file.tif', '/file.dc.xml', '/info.json'):
+            if path.endswith(suffix):
+                ark, size = self.find_page(path[:-len(suffix)])
+                break
+        else:
+            suffix = '/full/'
+            ark, size = self.find_page(path.split('/full/')[0]) \
+                if '/full/' in path else (None, None)
+        if size is None:
+            return self.send_not_found(head)
+
+        if suffix == '/file.tif':
+            self.send_tiff(size[0], size[1], head)
+        elif suffix == '/file.dc.xml':
+            identifier = self.server.objects[ark]['identifier']
+            self.send_file(
+                dc_xml(identifier, ark).encode('utf-8'),
+                'application/xml',
+                head
+            )
+        elif suffix == '/info.json':
+            self.send_json({
+                '@context': 'http://iiif.io/api/image/2/context.json',
+                '@id': '{}/{}'.format(
+                    self.server.base_url,
+                    urllib.parse.quote(path[:-len(suffix)], safe='')
+                ),
+                'height': size[1],
+                'profile': ['http://iiif.io/api/image/2/level2.json'],
+                'protocol': 'http://iiif.io/api/image',
+                'tiles': [{'scaleFactors': [1, 2, 4, 8, 16, 32], 'width': 512}],
+                'width': size[0]
+            }, head)
+        else:
+            self.send_body(200, 'image/jpeg', jpeg(1, 1), head)
+
+    def get_collection(self, name):
+        manifests = os.path.join(self.server.directory, 'manifests')
+        if not os.path.isdir(manifests):
+            return None
+        base = self.server.base_url
+        if name == 'top':
+            return {
+                '@context': 'http://iiif.io/api/presentation/2/context.json',
+                '@id': '{}/collections/top.json'.format(base),
+                '@type': 'sc:Collection',
+                'label': 'Fixtures',
+                'members': [
+                    {
+                        '@id': '{}/collections/{}.json'.format(base, d),
+                        '@type': 'sc:Collection',
+                        'label': d,
+                        'viewingHint': 'multi-part'
+                    }
+                    for d in sorted(os.listdir(manifests))
+                    if os.path.isdir(os.path.join(manifests, d))
+                ]
+            }
+        directory = os.path.join(manifests, name)
+        if '/' in name or not os.path.isdir(directory):
+            return None
+        items = []
+        for root, dirs, files in sorted(os.walk(directory)):
+            for f in sorted(files):
+                if f.endswith('.json'):
+                    url = '{}/{}'.format(
+                        base,
+                        os.path.relpath(os.path.join(root, f), self.server.directory)
+                    )
+                    items.append({
+                        'id': url,
+                        'type': 'Manifest',
+                        'label': { 'en': [ f[:-len('.json')] ] }
+                    })
+        return {
+            '@context': 'http://iiif.io/api/presentation/3/context.json',
+            'id': '{}/collections/{}.json'.format(base, name),
+            'type': 'Collection',
+            'label': { 'en': [ name ] },
+            'behavior': [ 'individuals' ],
+            'items': items
+        }
+
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory, host='127.0.0.1', port=8000):
+        super().__init__((host, port), FixtureHandler)
+        self.directory = os.path.abspath(directory)
+        with open(os.path.join(self.directory, 'objects.json')) as f:
+            self.objects = json.load(f)
+        self.base_url = 'http://{}:{}'.format(host, self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # clients that stop reading once they have an image's header
+        # close the connection mid-response; that's expected.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def environment(self):
+        """Environment variables that point iiif_tools at this server."""
+        return {
+            'ARK_DATA_DB': os.path.join(self.directory, 'ark_data.db'),
+            'IIIF_TOOLS_PAIRTREE_ROOT': os.path.join(self.directory, 'ark_data'),
+            'IIIF_TOOLS_ARK_SERVER': self.base_url,
+            'IIIF_TOOLS_IMAGE_SERVER': self.base_url,
+            'IIIF_TOOLS_IMAGE_SIZE_CACHE': os.path.join(self.directory, 'image_sizes.db'),
+            'IIIF_TOOLS_LOGO_CONFIG': os.path.join(self.directory, 'logos.json'),
+            'IIIF_TOOLS_OFFLINE': '1'
+        }
+
+
+def main():
+    options = docopt(__doc__)
+
+    if options['generate']:
+        objects = generate(
+            options['<dir>'],
+            int(options['--gms']),
+            int(options['--speculum']),
+            int(options['--pages']),
+            not options['--no-rac'],
+            not options['--no-ssmaps']
+        )
+        sys.stdout.write('{} objects in {}\n'.format(len(objects), options['<dir>']))
+    elif options['serve']:
+        server = FixtureServer(
+            options['<dir>'],
+            options['--host'],
+            int(options['--port'])
+        )
+        for k, v in sorted(server.environment().items()):
+            sys.stdout.write('export {}={}\n'.format(k, v))
+        sys.stdout.write(
+            '# e.g. iiif_tools build --collection=gms '
+            '--domain={0}/manifests --output-dir={1}\n'.format(
+                server.base_url,
+                server.directory
+            )
+        )
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
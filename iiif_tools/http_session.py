@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""One requests session per thread.
+
+A requests.Session keeps connections open between requests, but isn't
+safe to share between threads. The probers and checkers run requests on
+thread pools, so each thread gets its own session, and reuses its
+connections from one request to the next.
+
+e.g. r = get_session().get(url, timeout=30)
+"""
+
+import threading
+
+import requests
+
+_local = threading.local()
+
+
+def get_session():
+    """Return a requests session for the current thread."""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
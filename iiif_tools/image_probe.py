@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Read image dimensions from file headers.
+
+Master TIFFs can be several gigabytes, but width and height live in the
+first few kilobytes of a TIFF, JPEG, JP2 or PNG file. The functions here
+fetch only the bytes they need- via HTTP Range requests for remote images,
+or seek() and read() for local ones- and parse the header directly.
+
+e.g. probe_image('http://ark.lib.uchicago.edu/ark:61001/b2hd4d25q389/00000001/file.tif')
+     -> (5184, 7200, 'image/tiff')
+"""
+
+import os
+import struct
+import urllib.parse
+import urllib.request
+
+from http_session import get_session
+from instrumentation import count, span
+
+CHUNK_SIZE = 64 * 1024
+MAX_BYTES = 16 * 1024 * 1024
+
+
+class ImageProbeError(Exception):
+    pass
+
+
+class _FileReader:
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.bytes_read = 0
+
+    def read(self, offset, length):
+        self.f.seek(offset)
+        data = self.f.read(length)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class _HttpReader:
+    """Read byte ranges from a URL, caching whatever has already been
+       fetched. If the server ignores the Range header, stream the response
+       and stop once enough bytes have arrived."""
+
+    def __init__(self, url, timeout=None):
+        self.url = url
+        self.timeout = timeout
+        self.blocks = {}
+        self.prefix = None
+        self.bytes_read = 0
+
+    def read(self, offset, length):
+        if self.prefix is not None:
+            return self._read_prefix(offset, length)
+        for start, data in self.blocks.items():
+            if start <= offset and offset + length <= start + len(data):
+                return data[offset - start:offset - start + length]
+
+        window = max(length, CHUNK_SIZE)
+        with span('http'):
+            count('http.requests')
+            r = get_session().get(
+                self.url,
+                headers={'Range': 'bytes={}-{}'.format(offset, offset + window - 1)},
+                stream=True,
+                timeout=self.timeout
+            )
+            try:
+                if r.status_code == 416:
+                    return b''
+                r.raise_for_status()
+                if r.status_code == 206:
+                    data = r.content
+                    self.bytes_read += len(data)
+                    count('http.bytes', len(data))
+                    self.blocks[offset] = data
+                    return data[:length]
+                self.prefix = b''
+                self._extend_prefix(r, offset + length)
+            finally:
+                r.close()
+        return self._read_prefix(offset, length)
+
+    def _read_prefix(self, offset, length):
+        if offset + length > len(self.prefix):
+            with span('http'):
+                count('http.requests')
+                r = get_session().get(self.url, stream=True, timeout=self.timeout)
+                try:
+                    r.raise_for_status()
+                    self.prefix = b''
+                    self._extend_prefix(r, offset + length)
+                finally:
+                    r.close()
+        return self.prefix[offset:offset + length]
+
+    def _extend_prefix(self, r, end):
+        chunks = []
+        size = 0
+        for chunk in r.iter_content(CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= max(end, CHUNK_SIZE) or size > MAX_BYTES:
+                break
+        self.prefix = b''.join(chunks)
+        self.bytes_read += size
+        count('http.bytes', size)
+
+    def close(self):
+        pass
+
+
+def _open(source, timeout=None):
+    parsed = urllib.parse.urlparse(source)
+    if parsed.scheme in ('http', 'https'):
+        return _HttpReader(source, timeout)
+    if parsed.scheme == 'file':
+        return _FileReader(urllib.request.url2pathname(parsed.path))
+    return _FileReader(os.fspath(source))
+
+
+def _read(reader, offset, length, what='image header'):
+    """Read exactly length bytes at offset, or raise ImageProbeError- e.g.
+       for a truncated file, a response cut off by MAX_BYTES, or a 416."""
+    data = reader.read(offset, length)
+    if len(data) < length:
+        raise ImageProbeError(
+            'truncated {}: wanted {} bytes at {}, got {}'.format(
+                what,
+                length,
+                offset,
+                len(data)
+            )
+        )
+    return data
+
+
+def _tiff_size(reader, head):
+    endian = '<' if head[:2] == b'II' else '>'
+    magic = struct.unpack(endian + 'H', head[2:4])[0]
+    if magic == 42:
+        if len(head) < 8:
+            raise ImageProbeError('truncated TIFF header')
+        ifd_offset = struct.unpack(endian + 'I', head[4:8])[0]
+        count_format, count_size, entry_size, value_offset = 'H', 2, 12, 8
+    elif magic == 43:
+        if len(head) < 16:
+            raise ImageProbeError('truncated BigTIFF header')
+        ifd_offset = struct.unpack(endian + 'Q', head[8:16])[0]
+        count_format, count_size, entry_size, value_offset = 'Q', 8, 20, 12
+    else:
+        raise ImageProbeError('not a TIFF file')
+
+    n = struct.unpack(
+        endian + count_format,
+        _read(reader, ifd_offset, count_size, 'TIFF IFD')
+    )[0]
+    entries = _read(reader, ifd_offset + count_size, n * entry_size, 'TIFF IFD')
+
+    width = height = None
+    for i in range(n):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, field_type = struct.unpack(endian + 'HH', entry[:4])
+        if tag not in (256, 257):
+            continue
+        if field_type == 3:
+            value = struct.unpack(endian + 'H', entry[value_offset:value_offset + 2])[0]
+        elif field_type == 4:
+            value = struct.unpack(endian + 'I', entry[value_offset:value_offset + 4])[0]
+        elif field_type == 16:
+            value = struct.unpack(endian + 'Q', entry[value_offset:value_offset + 8])[0]
+        else:
+            raise ImageProbeError('unexpected TIFF field type {}'.format(field_type))
+        if tag == 256:
+            width = value
+        else:
+            height = value
+
+    if width is None or height is None:
+        raise ImageProbeError('TIFF IFD has no ImageWidth/ImageLength')
+    return width, height
+
+
+def _jpeg_size(reader):
+    offset = 2
+    while offset < MAX_BYTES:
+        marker = reader.read(offset, 4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            break
+        # skip fill bytes.
+        if marker[1] == 0xFF:
+            offset += 1
+            continue
+        code = marker[1]
+        if code == 0xD8 or 0xD0 <= code <= 0xD7 or code == 0x01:
+            offset += 2
+            continue
+        length = struct.unpack('>H', marker[2:4])[0]
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(
+                '>HH',
+                _read(reader, offset + 5, 4, 'JPEG SOF segment')
+            )
+            return width, height
+        offset += 2 + length
+    raise ImageProbeError('no SOF marker found in JPEG header')
+
+
+def _j2k_size(reader, offset):
+    # SIZ marker segment: FF51, Lsiz, Rsiz, Xsiz, Ysiz, XOsiz, YOsiz.
+    siz = _read(reader, offset, 22, 'JPEG 2000 SIZ segment')
+    if siz[:2] != b'\xff\x51':
+        raise ImageProbeError('JPEG 2000 codestream has no SIZ marker')
+    x, y, x0, y0 = struct.unpack('>IIII', siz[6:22])
+    return x - x0, y - y0
+
+
+def _jp2_size(reader, offset, end):
+    while offset < end:
+        header = reader.read(offset, 16)
+        if len(header) < 8:
+            break
+        length, box_type = struct.unpack('>I4s', header[:8])
+        header_size = 8
+        if length == 1:
+            if len(header) < 16:
+                break
+            length = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif length == 0:
+            length = end - offset
+        if box_type == b'jp2h':
+            return _jp2_size(reader, offset + header_size, offset + length)
+        if box_type == b'ihdr':
+            height, width = struct.unpack(
+                '>II',
+                _read(reader, offset + header_size, 8, 'JP2 ihdr box')
+            )
+            return width, height
+        if box_type == b'jp2c':
+            return _j2k_size(reader, offset + header_size + 2)
+        offset += length
+    raise ImageProbeError('no ihdr box found in JP2 header')
+
+
+def probe_image(source, timeout=None):
+    """Get the dimensions and MIME type of an image without reading it all.
+
+    Args:
+      source (str): an http(s) URL, a file:// URL or a local path.
+      timeout (float): per-request timeout for remote images.
+
+    Returns:
+      tuple: (width, height, mime_type)
+    """
+    with span('image_probe'):
+        reader = _open(source, timeout)
+        try:
+            head = reader.read(0, 32)
+            if head[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+                return _tiff_size(reader, head) + ('image/tiff',)
+            if head[:3] == b'\xff\xd8\xff':
+                return _jpeg_size(reader) + ('image/jpeg',)
+            if head[:12] == b'\x00\x00\x00\x0cjP  \r\n\x87\n':
+                return _jp2_size(reader, 0, MAX_BYTES) + ('image/jp2',)
+            if head[:4] == b'\xff\x4f\xff\x51':
+                return _j2k_size(reader, 2) + ('image/jp2',)
+            if head[:8] == b'\x89PNG\r\n\x1a\n':
+                if len(head) < 24:
+                    raise ImageProbeError('truncated PNG header')
+                return struct.unpack('>II', head[16:24]) + ('image/png',)
+            raise ImageProbeError('unrecognized image format: {}'.format(source))
+        finally:
+            reader.close()
+
+
+def get_image_size(source, timeout=None):
+    """Get the (width, height) of an image from its header."""
+    return probe_image(source, timeout)[:2]
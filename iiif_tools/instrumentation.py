@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Timing spans and counters for the build commands.
+
+Slow phases are wrapped in named spans, and cache lookups and downloads
+are counted, so a slow build can be broken down by where the time went:
+
+e.g. with span('sqlite'):
+         rows = conn.execute(sql).fetchall()
+     count('http.bytes', len(data))
+     count('image_size_cache.hit')
+
+Spans in use: sqlite, http, image_probe, page_probe, inventory, xml,
+metadata, images, json, webdav, validate and compress. A span records how
+many times it was entered and the wall-clock time spent inside it. Spans
+nest (page_probe, one per page with its retries, includes image_probe,
+which includes http) and run on several threads at once, so span times
+overlap and can add up to more than the elapsed time.
+
+Metrics are kept per process. Worker processes collect() theirs after
+each task and send them back to be merge()d into the parent's.
+
+profile() wires this up for a command: it prints a per-phase breakdown
+(--profile), writes a cProfile/pstats file (--pstats) and dumps the
+metrics as JSON (--metrics-json).
+"""
+
+import contextlib
+import cProfile
+import glob
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_profiler = None
+_task_profiler = None
+
+
+class Span:
+    """Context manager that adds the time spent inside it to a named
+       span. Use span(name)."""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            totals = _spans.get(self.name)
+            if totals is None:
+                _spans[self.name] = [1, seconds]
+            else:
+                totals[0] += 1
+                totals[1] += seconds
+        return False
+
+
+def span(name):
+    return Span(name)
+
+
+def count(name, n=1):
+    """Add n to a named counter, e.g. count('http.bytes', 65536)."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def _snapshot():
+    return {
+        'spans': {
+            name: {'calls': calls, 'seconds': seconds}
+            for name, (calls, seconds) in _spans.items()
+        },
+        'counters': dict(_counters)
+    }
+
+
+def snapshot():
+    """Returns this process's metrics as a dict:
+       {'spans': {name: {'calls': n, 'seconds': s}}, 'counters': {name: n}}"""
+    with _lock:
+        return _snapshot()
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def collect():
+    """Returns snapshot() and resets, so that each call only reports what
+       happened since the last one."""
+    with _lock:
+        data = _snapshot()
+        _spans.clear()
+        _counters.clear()
+    return data
+
+
+def merge(data):
+    """Add metrics from collect(), e.g. from a worker process."""
+    with _lock:
+        for name, totals in data['spans'].items():
+            current = _spans.setdefault(name, [0, 0.0])
+            current[0] += totals['calls']
+            current[1] += totals['seconds']
+        for name, n in data['counters'].items():
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def format_report(data):
+    """Format metrics as a table of spans, slowest first, then counters."""
+    lines = ['{:24} {:>10} {:>12}'.format('span', 'calls', 'seconds')]
+    for name, totals in sorted(
+        data['spans'].items(),
+        key=lambda item: item[1]['seconds'],
+        reverse=True
+    ):
+        lines.append('{:24} {:>10} {:>12.3f}'.format(
+            name,
+            totals['calls'],
+            totals['seconds']
+        ))
+    if data['counters']:
+        lines.append('')
+        lines.append('{:24} {:>23}'.format('counter', 'value'))
+        for name, n in sorted(data['counters'].items()):
+            lines.append('{:24} {:>23}'.format(name, n))
+    if 'elapsed' in data:
+        lines.append('')
+        lines.append('elapsed {:.3f}s'.format(data['elapsed']))
+    return '\n'.join(lines) + '\n'
+
+
+def _task_profiles(pstats_path):
+    return [
+        path for path in glob.glob(glob.escape(pstats_path) + '.*')
+        if path.rsplit('.', 1)[1].isdigit()
+    ]
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+@contextlib.contextmanager
+def profile_task(pstats_path):
+    """For worker processes: profile one task, adding it to a profile of
+       every task this process has run, kept at <pstats_path>.<pid>.
+       profile() merges these into pstats_path when the command ends."""
+    global _profiler, _task_profiler
+    if not pstats_path:
+        yield
+        return
+    if _task_profiler is None:
+        # a forked worker starts out with its parent's profiler running.
+        if _profiler is not None:
+            _profiler.disable()
+            _profiler = None
+        _task_profiler = cProfile.Profile()
+    _task_profiler.enable()
+    try:
+        yield
+    finally:
+        _task_profiler.disable()
+        _task_profiler.dump_stats('{}.{}'.format(pstats_path, os.getpid()))
+
+
+@contextlib.contextmanager
+def profile(report=False, pstats_path=None, metrics_path=None, out=None):
+    """Instrument a whole command.
+
+    Args:
+      report (bool): print a per-phase breakdown when the command ends.
+      pstats_path (str): run under cProfile and write a pstats file here.
+      metrics_path (str): write spans, counters and elapsed time as JSON.
+      out (file): where to print the report, by default sys.stderr.
+    """
+    global _profiler
+    if pstats_path:
+        # don't pick up profiles left over from an earlier run.
+        for path in _task_profiles(pstats_path):
+            os.remove(path)
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if _profiler is not None:
+            _profiler.disable()
+            stats = pstats.Stats(_profiler)
+            _profiler = None
+            for path in _task_profiles(pstats_path):
+                stats.add(path)
+                os.remove(path)
+            stats.dump_stats(pstats_path)
+
+        data = snapshot()
+        data['elapsed'] = elapsed
+        if report:
+            (out or sys.stderr).write(format_report(data))
+        if metrics_path:
+            write_json(metrics_path, data)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Write JSON documents a piece at a time.
+
+dump() produces the same text as json.dumps(obj, indent=4, sort_keys=True),
+but any list in obj can be replaced by a generator- e.g. a manifest's
+canvases- and its elements are encoded and written one at a time, so the
+whole document never has to exist in memory as one string.
+
+compact=True writes the document without whitespace, for publishing. If
+orjson is installed it is used to encode compact output.
+"""
+
+import collections.abc
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+INDENT = 4
+
+
+def _is_lazy(o):
+    return isinstance(o, collections.abc.Iterator)
+
+
+def _contains_lazy(o):
+    if _is_lazy(o):
+        return True
+    if isinstance(o, dict):
+        return any(_contains_lazy(v) for v in o.values())
+    if isinstance(o, list):
+        return any(_contains_lazy(v) for v in o)
+    return False
+
+
+def _encode(o, level, compact):
+    if compact:
+        if orjson is not None:
+            return orjson.dumps(o, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+        # orjson writes UTF-8, not \u escapes; match it byte for byte.
+        return json.dumps(
+            o,
+            ensure_ascii=False,
+            separators=(',', ':'),
+            sort_keys=True
+        )
+    text = json.dumps(o, indent=INDENT, sort_keys=True)
+    if level:
+        text = text.replace('\n', '\n' + ' ' * (INDENT * level))
+    return text
+
+
+def iterencode(o, compact=False, level=0):
+    """Yield the JSON text for o in chunks."""
+    if compact:
+        newline = ''
+        close = ''
+        key_separator = ':'
+    else:
+        newline = '\n' + ' ' * (INDENT * (level + 1))
+        close = '\n' + ' ' * (INDENT * level)
+        key_separator = ': '
+
+    if isinstance(o, dict) and _contains_lazy(o):
+        if not o:
+            yield '{}'
+            return
+        yield '{'
+        for i, key in enumerate(sorted(o)):
+            yield '{}{}{}{}'.format(
+                ',' if i else '',
+                newline,
+                _encode(key, 0, compact),
+                key_separator
+            )
+            yield from iterencode(o[key], compact, level + 1)
+        yield close + '}'
+    elif _is_lazy(o) or (isinstance(o, list) and _contains_lazy(o)):
+        # e.g. a v2 manifest's sequences, a list holding a generator of
+        # canvases.
+        empty = True
+        for i, item in enumerate(o):
+            yield '{}{}'.format(',' if i else '[', newline)
+            yield from iterencode(item, compact, level + 1)
+            empty = False
+        yield '[]' if empty else close + ']'
+    else:
+        yield _encode(o, level, compact)
+
+
+def dump(o, f, compact=False):
+    """Write o to a file handle."""
+    for chunk in iterencode(o, compact):
+        f.write(chunk)
+
+
+def dumps(o, compact=False):
+    return ''.join(iterencode(o, compact))
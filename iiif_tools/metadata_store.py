@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Parsed, indexed copies of the metadata files in metadata/.
+
+Each file is parsed once per process and indexed by identifier, then
+parsed again only if its mtime or size changes. Set
+IIIF_TOOLS_METADATA_CACHE to a directory to also keep a pickled copy of
+each index there, so new processes can skip parsing entirely.
+
+e.g. get_gms_item('Ms. 19') -> <msItem> element
+     get_speculum_record('speculum-0001') -> [{'label': ..., 'value': ...}, ...]
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+import xml.etree.ElementTree as ElementTree
+
+from build_state import write_if_changed
+from instrumentation import count, span
+
+METADATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metadata')
+GMS_XML = os.path.join(METADATA_DIR, 'gms.xml')
+SPECULUM_JSON = os.path.join(METADATA_DIR, 'speculum.json')
+
+METADATA_CACHE = os.environ.get('IIIF_TOOLS_METADATA_CACHE')
+
+
+def index_gms(path):
+    """Index msItems by shelfmark, e.g. 'Ms. 19'. Manuscripts listed as
+       'Ms. 2057 (OIM)' can also be found as 'Ms. 2057'."""
+    with open(path) as f, span('xml'):
+        gms = ElementTree.fromstring(f.read())
+
+    index = {}
+    for ms_item in gms.findall('msItem'):
+        index[ms_item.find('manuscript').text] = ms_item
+    for shelfmark, ms_item in list(index.items()):
+        if shelfmark.endswith(' (OIM)'):
+            index.setdefault(shelfmark[:-len(' (OIM)')], ms_item)
+    return index
+
+
+def index_speculum(path):
+    """speculum.json is already keyed by identifier, e.g. 'speculum-0001'."""
+    with open(path) as f:
+        return json.load(f)
+
+
+class MetadataSource:
+    """One metadata file and its index.
+
+    Args:
+      path (str): the metadata file.
+      indexer (function): parses the file at a path into an index.
+      cache_dir (str): optional directory for pickled indexes.
+    """
+
+    def __init__(self, path, indexer, cache_dir=METADATA_CACHE):
+        self.path = path
+        self.indexer = indexer
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.signature = None
+        self.index = None
+
+    def _pickle_path(self):
+        return os.path.join(
+            self.cache_dir,
+            '{}.pickle'.format(hashlib.sha1(self.path.encode('utf-8')).hexdigest())
+        )
+
+    def _load(self, signature):
+        if self.cache_dir:
+            try:
+                with open(self._pickle_path(), 'rb') as f:
+                    cached_signature, index = pickle.load(f)
+                if cached_signature == signature:
+                    count('metadata_cache.hit')
+                    return index
+            except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+                pass
+
+        count('metadata_cache.miss')
+        with span('metadata'):
+            index = self.indexer(self.path)
+
+        if self.cache_dir:
+            write_if_changed(
+                self._pickle_path(),
+                pickle.dumps((signature, index), pickle.HIGHEST_PROTOCOL)
+            )
+        return index
+
+    def get(self):
+        """Returns the index, re-parsing the file if it has changed."""
+        st = os.stat(self.path)
+        signature = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if signature != self.signature:
+                self.index = self._load(signature)
+                self.signature = signature
+            return self.index
+
+
+_sources = {}
+
+
+def get_source(path, indexer):
+    if path not in _sources:
+        _sources[path] = MetadataSource(path, indexer)
+    return _sources[path]
+
+
+def get_gms_item(shelfmark):
+    """Returns the msItem for a shelfmark, e.g. 'Ms. 19', or None."""
+    return get_source(GMS_XML, index_gms).get().get(shelfmark)
+
+
+def get_speculum_record(identifier):
+    """Returns the list of label/value pairs for a speculum identifier."""
+    return get_source(SPECULUM_JSON, index_speculum).get()[identifier]
@@ -1,7 +1,52 @@
 import csv
+import os
 import re
 import xml.etree.ElementTree as ElementTree
 
+from array import array
+
+METS_AMDSEC = '{http://www.loc.gov/METS/}amdSec'
+METS_TECHMD = '{http://www.loc.gov/METS/}techMD'
+MIX_IMAGE_WIDTH = '{http://www.loc.gov/mix/v20}imageWidth'
+MIX_IMAGE_HEIGHT = '{http://www.loc.gov/mix/v20}imageHeight'
+
+
+def read_mix_sizes(source):
+    """Read the image width and height from each techMD section of a METS
+    file, in a single pass.
+
+    The file is read with iterparse, and elements are cleared as soon as
+    they have been read, so the whole METS tree is never held in memory.
+
+    Args:
+      source (str or file): a METS file with a MIX techMD for each image.
+
+    Returns:
+      tuple: (widths, heights), two array('I')s indexed by object number,
+        starting from 0. Sizes missing from a techMD are 0.
+    """
+    widths = array('I')
+    heights = array('I')
+    amdsec = None
+    width = height = 0
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == METS_AMDSEC:
+                amdsec = elem
+            continue
+        if elem.tag == MIX_IMAGE_WIDTH:
+            width = int(elem.text)
+        elif elem.tag == MIX_IMAGE_HEIGHT:
+            height = int(elem.text)
+        elif elem.tag == METS_TECHMD:
+            widths.append(width)
+            heights.append(height)
+            width = height = 0
+            if amdsec is not None and len(amdsec) and amdsec[-1] is elem:
+                del amdsec[-1]
+        elem.clear()
+    return widths, heights
+
 
 class MvolMetadata:
     """helper functions to make collection and manifest files for iiif. 
@@ -14,7 +59,7 @@ class MvolMetadata:
     def __init__(self, directory):
         self.directory = directory
         self.struct = None
-        self.mets = None
+        self.mix_sizes = None
 
     def get_page(self, n):
         """Get a page number from structural metadata.
@@ -51,17 +96,11 @@ class MvolMetadata:
 
         """
 
-        if not self.mets:
+        if not self.mix_sizes:
             self._load_mets()
-            assert self.mets != None
+            assert self.mix_sizes != None
 
-        # get width here.
-        # /mets/amdSec/techMD/mdWrap/xmlData
-
-        # /mix:mix
-        #   /mix:BasicImageInformation
-        #     /mix:BasicImageCharacteristics
-        #       /mix:imageWidth
+        return self.mix_sizes[0][n]
 
     def get_height(self, n):
         """Get image height. 
@@ -74,13 +113,13 @@ class MvolMetadata:
 
         """
 
-        if not self.mets:
+        if not self.mix_sizes:
             self._load_mets()
-            assert self.mets != None
+            assert self.mix_sizes != None
 
-        # get height here.
+        return self.mix_sizes[1][n]
 
-        def _load_mets(self):
-            for entry in os.listdir(self.directory):
-                if entry.endswith('mets.xml'):
-                    self.mets = ElementTree.parse(self.directory + '/' + entry)
+    def _load_mets(self):
+        for entry in os.listdir(self.directory):
+            if entry.endswith('mets.xml'):
+                self.mix_sizes = read_mix_sizes(self.directory + '/' + entry)
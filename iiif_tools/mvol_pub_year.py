@@ -1,15 +1,36 @@
+"""Check that a year of mvol issues is available from the image server and
+the OCR service, and produce an input file for the OCR building script.
+
+Issues are verified as a pipeline: date folders come from one WebDAV
+listing, and each issue's struct.txt is read and its OCR, image and
+info.json URLs checked with HEAD requests as soon as it is reached. At
+most --concurrency requests are in flight at once, each thread reusing
+one pooled HTTP session.
+
+Failures are collected into each issue's 'failures' instead of stopping
+the run. With --state, issues that pass are checkpointed to a JSON file as
+they finish; an interrupted run started again with the same --state only
+checks the issues that were left, or that failed.
+"""
+
 import argparse
+import asyncio
 import csv
 import getpass
 import json
 import os
-import owncloud
 import re
 import requests
 import sys
-import urllib
+import urllib.parse
 
+from build_state import write_if_changed
+from concurrent.futures import ThreadPoolExecutor
+from http_session import get_session
 from io import StringIO
+from instrumentation import count, profile, span
+from thumbnails import IMAGE_SERVER
+from webdav_listing import WebDavListing
 
 
 def get_identifier_from_path(path):
@@ -29,19 +50,19 @@ def get_ocr_url(identifier):
 
 def get_image_url(identifier_and_object_number):
     """ e.g. mvol-0004-1931-0106_0001
-        https://iiif-server.lib.uchicago.edu/0/0/0/1/1931.tif/full/1000,800/0/default.jpg
+        https://iiif-server.lib.uchicago.edu/mvol/0004/1931/0106/TIFF/mvol-0004-1931-0106_0001.tif/full/1000,800/0/default.jpg
     """
     pieces = identifier_and_object_number.split('-')
     last_chunk = pieces.pop()
     pieces = pieces + last_chunk.split('_')
-    return 'https://iiif-server.lib.uchicago.edu/' + '/'.join(pieces[0:4]) + '/TIFF/' + identifier_and_object_number + '.tif/full/1000,800/0/default.jpg'
+    return IMAGE_SERVER + '/' + '/'.join(pieces[0:4]) + '/TIFF/' + identifier_and_object_number + '.tif/full/1000,800/0/default.jpg'
 
 
 def get_image_info_url(identifier_and_object_number):
     pieces = re.split('[-_]', identifier_and_object_number)
     url_encoded_part = urllib.parse.quote(
         '/'.join(pieces) + '/TIFF/' + identifier_and_object_number + '.tif')
-    return 'https://iiif-server.lib.uchicago.edu/' + url_encoded_part + '/info.json'
+    return IMAGE_SERVER + '/' + url_encoded_part + '/info.json'
 
 # IIIF_Files/mvol/0004/1931/
 # IIIF_Files/mvol/0004/1931/mvol-0004-1931-0106.struct.txt
@@ -64,18 +85,202 @@ def get_page_numbers(oc, struct_txt_path):
     return page_numbers
 
 
+def check_url(url, timeout=30):
+    """HEAD one URL.
+
+    Returns:
+      dict: url and status, plus error if the request failed.
+    """
+    count('http.requests')
+    try:
+        with span('http'):
+            r = get_session().head(url, timeout=timeout)
+    except requests.RequestException as e:
+        return {'url': url, 'status': None, 'error': str(e)}
+    r.close()
+    return {'url': url, 'status': r.status_code}
+
+
+def _failure(result):
+    return result.get('error') is not None or result['status'] != 200
+
+
+async def verify_issue(oc, path, run, timeout=30):
+    """Read one issue's struct.txt and check its OCR, image and info.json
+       URLs.
+
+    Args:
+      oc: a WebDavListing, or an owncloud.Client.
+      path (str): the issue's date folder, e.g.
+        /IIIF_Files/mvol/0004/1931/0106/
+      run: schedules a blocking call, e.g. on a thread pool, and returns an
+        awaitable for its result.
+
+    Returns:
+      dict: the issue's entry in the output, with a list of failures.
+    """
+    path = path.rstrip('/')
+    identifier = get_identifier_from_path(path)
+    failures = []
+
+    ocr = run(check_url, get_ocr_url(identifier), timeout)
+
+    struct_txt_path = get_struct_txt_path(path)
+    try:
+        page_numbers = await run(get_page_numbers, oc, struct_txt_path)
+    except Exception as e:
+        failures.append({'path': struct_txt_path, 'error': str(e)})
+        page_numbers = []
+
+    # a missing or unlistable TIFF/ directory is this issue's failure, not
+    # the year's; the OCR check still gets awaited below.
+    tiff_path = path + '/TIFF'
+    try:
+        entries = await run(oc.list, tiff_path)
+    except Exception as e:
+        failures.append({'path': tiff_path, 'error': str(e)})
+        entries = []
+    image_files = sorted(
+        (entry for entry in entries if not entry.is_dir()),
+        key=lambda entry: entry.path
+    )
+    checks = []
+    for image_file in image_files:
+        identifier_and_object_number = image_file.path.split(
+            '/').pop().split('.')[0]
+        checks.append(run(check_url, get_image_url(identifier_and_object_number), timeout))
+        checks.append(run(check_url, get_image_info_url(identifier_and_object_number), timeout))
+    results = await asyncio.gather(ocr, *checks)
+
+    ocr = results[0]
+    if _failure(ocr):
+        failures.append(ocr)
+    pub = {
+        'identifier': identifier,
+        'ocr': {
+            'url': ocr['url'],
+            'status': ocr['status']
+        },
+        'pages': []
+    }
+
+    for n, image_file in enumerate(image_files):
+        image, info = results[1 + 2 * n], results[2 + 2 * n]
+        for result in (image, info):
+            if _failure(result):
+                failures.append(result)
+        if n < len(page_numbers):
+            page_number = page_numbers[n]
+        else:
+            page_number = None
+            failures.append({
+                'path': image_file.path,
+                'error': 'no page number in {}'.format(struct_txt_path)
+            })
+        pub['pages'].append({
+            'image': {
+                'url': image['url'],
+                'status': image['status']
+            },
+            'info': {
+                'url': info['url'],
+                'status': info['status']
+            },
+            'page_number': page_number
+        })
+
+    pub['failures'] = failures
+    return pub
+
+
+async def verify_year(oc, directory, concurrency=16, timeout=30, done=None,
+                      on_issue=None):
+    """Verify every issue in a year directory.
+
+    Args:
+      concurrency (int): requests in flight at once, which is also the
+        number of issues being verified at once.
+      done (dict): issues already verified, by identifier, e.g. from a
+        state file. These are not checked again.
+      on_issue: called with each issue's entry as it finishes.
+
+    Returns:
+      list: an entry for each issue, sorted by identifier.
+    """
+    pubs = dict(done or {})
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    issue_limit = asyncio.Semaphore(concurrency)
+
+    def run(fn, *args):
+        return loop.run_in_executor(executor, fn, *args)
+
+    async def verify(path):
+        async with issue_limit:
+            pub = await verify_issue(oc, path, run, timeout)
+        pubs[pub['identifier']] = pub
+        if on_issue:
+            on_issue(pub)
+
+    paths = []
+    for date_folder in oc.list(directory):
+        if not date_folder.file_type == 'dir':
+            continue
+        if not re.match(r'^.*[/]\d{4}[/]$', date_folder.path):
+            continue
+        identifier = get_identifier_from_path(date_folder.path)
+        if identifier in pubs:
+            continue
+        # don't verify an issue twice if it is listed twice.
+        pubs[identifier] = None
+        paths.append(date_folder.path)
+
+    try:
+        await asyncio.gather(*(verify(path) for path in paths))
+    finally:
+        executor.shutdown()
+    return [pubs[identifier] for identifier in sorted(pubs) if pubs[identifier]]
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, done):
+    write_if_changed(path, json.dumps(done, indent=4, sort_keys=True))
+
+
 if __name__ == '__main__':
     """ Produce an input file for a year's worth of mvol data.
         This checks to be sure that files are available via specific URLs, and it produces an input file for the OCR building script. 
     """
 
-    pubs = []
-
     parser = argparse.ArgumentParser()
     parser.add_argument("username", help="WebDAV username.")
     parser.add_argument("directory", help="e.g. IIIF_Files/mvol/0004/1931")
+    parser.add_argument(
+        "--concurrency", type=int, default=16,
+        help="Requests in flight at once.")
+    parser.add_argument(
+        "--timeout", type=float, default=30,
+        help="Timeout for each request, in seconds.")
+    parser.add_argument(
+        "--state",
+        help="JSON file of issues that passed, to resume an interrupted run.")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="Print a per-phase timing breakdown to stderr.")
+    parser.add_argument("--pstats", help="Write a cProfile/pstats file.")
+    parser.add_argument(
+        "--metrics-json", help="Write timings and counters as JSON.")
     args = parser.parse_args()
 
+    import owncloud
+
     try:
         oc = owncloud.Client(os.environ['WEBDAV_CLIENT'])
     except KeyError:
@@ -85,75 +290,39 @@ if __name__ == '__main__':
     password = getpass.getpass('WebDAV password: ')
     oc.login(args.username, password)
 
-    for date_folder in oc.list(args.directory):
-
-        if not date_folder.file_type == 'dir':
-            continue
-
-        if not re.match('^.*[/]\d{4}[/]$', date_folder.path):
-            continue
-
-        identifier = get_identifier_from_path(date_folder.path)
-
-        ocr_url = get_ocr_url(identifier)
-
-        r = requests.head(ocr_url)
-        ocr_url_status = r.status_code
-        try:
-            assert ocr_url_status == 200
-        except AssertionError:
-            print(ocr_url)
-            raise
-
-        pub = {
-            'identifier': identifier,
-            'ocr': {
-                'url': ocr_url,
-                'status': ocr_url_status
-            },
-            'pages': []
-        }
-
-        page_numbers = get_page_numbers(
-            oc, get_struct_txt_path(date_folder.path))
-
-        n = 0
-        for image_file in oc.list(date_folder.path + '/TIFF'):
-            identifier_and_object_number = image_file.path.split(
-                '/').pop().split('.')[0]
-            image_url = get_image_url(identifier_and_object_number)
-
-            r = requests.head(image_url)
-            image_url_status = r.status_code
-            try:
-                assert image_url_status == 200
-            except AssertionError:
-                print(image_url)
-                raise
-
-            image_info_url = get_image_info_url(identifier_and_object_number)
-
-            r = requests.head(image_url)
-            image_info_url_status = r.status_code
-            try:
-                assert image_info_url_status == 200
-            except AssertionError:
-                print(image_info_url)
-                raise
-
-            pub['pages'].append({
-                'image': {
-                    'url': image_url,
-                    'status': image_url_status
-                },
-                'info': {
-                    'url': image_info_url,
-                    'status': image_info_url_status
-                },
-                'page_number': page_numbers[n]
-            })
-            n = n + 1
-
-        pubs.append(pub)
-
-print(json.dumps(pubs, indent=4, sort_keys=True))
+    # one PROPFIND for the whole year, shared with the other mvol scripts.
+    oc = WebDavListing(oc, args.directory)
+
+    done = load_state(args.state) if args.state else {}
+
+    def checkpoint(pub):
+        if pub['failures']:
+            return
+        done[pub['identifier']] = pub
+        if args.state:
+            save_state(args.state, done)
+
+    with profile(args.profile, args.pstats, args.metrics_json):
+        pubs = asyncio.run(
+            verify_year(
+                oc,
+                args.directory,
+                concurrency=args.concurrency,
+                timeout=args.timeout,
+                done=done,
+                on_issue=checkpoint
+            )
+        )
+
+    print(json.dumps(pubs, indent=4, sort_keys=True))
+
+    failed = [pub for pub in pubs if pub['failures']]
+    if failed:
+        for pub in failed:
+            for failure in pub['failures']:
+                sys.stderr.write('{} {} {}\n'.format(
+                    pub['identifier'],
+                    failure.get('url') or failure.get('path'),
+                    failure.get('error') or failure.get('status')
+                ))
+        sys.exit(1)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Read the head version of OCFL inventories in the ARK pairtree.
+
+An inventory.json lists every version of an object, and every file in
+every version, but a manifest only needs the files in the head version.
+If ijson is installed the inventory is stream-parsed, keeping only the
+head version's state and stopping as soon as it has been read; otherwise
+the whole file is loaded with json.
+
+Parsed inventories are cached by path and re-read only if the file's
+mtime or size changes.
+
+e.g. load_inventory('ark:61001/b2hd4d25q389').get_objects()
+         -> ['00000001', '00000002', ...]
+     load_inventory('ark:61001/b2hd4d25q389').get_files('00000001')
+         -> ['file.dc.xml', 'file.tif']
+
+The pairtree root comes from the IIIF_TOOLS_PAIRTREE_ROOT environment
+variable, or can be set with set_pairtree_root() so tests can point at a
+fixture tree.
+"""
+
+import collections
+import json
+import os
+import threading
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from instrumentation import count, span
+
+PAIRTREE_ROOT = os.environ.get(
+    'IIIF_TOOLS_PAIRTREE_ROOT',
+    '/data/digital_collections/ark_data'
+)
+
+# number of parsed inventories to keep per process.
+CACHE_SIZE = 1024
+
+_pairtree_root = PAIRTREE_ROOT
+_cache = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+class Inventory:
+    """The head version of an OCFL object.
+
+    Args:
+      head (str): the head version, e.g. 'v2'.
+      state (dict): logical path -> digest for every file in the head
+        version, e.g. {'00000001/file.tif': 'a1b2...', ...}
+    """
+
+    def __init__(self, head, state):
+        self.head = head
+        self.state = state
+        # files by page object, e.g. {'00000001': {'file.tif': 'a1b2...'}}.
+        # Files that aren't in a page object, as in single image objects,
+        # are under None.
+        self.files = {}
+        for path, digest in state.items():
+            if '/' in path:
+                object_number, name = path.split('/', 1)
+            else:
+                object_number, name = None, path
+            self.files.setdefault(object_number, {})[name] = digest
+
+    def get_objects(self):
+        """Returns a sorted list of page objects with a file.tif,
+           e.g. ['00000001', '00000002', '00000003']"""
+        return sorted(
+            object_number for object_number, files in self.files.items()
+            if object_number is not None and 'file.tif' in files
+        )
+
+    def get_files(self, object_number=None):
+        """Returns the sorted file names in a page object, or at the top of
+           the object if object_number is None."""
+        return sorted(self.files.get(object_number, {}))
+
+
+def _read_streaming(f):
+    head = None
+    states = {}
+    for prefix, event, value in ijson.parse(f):
+        if prefix == 'head' and event == 'string':
+            head = value
+        elif event == 'string' and prefix.startswith('versions.'):
+            # versions.<version>.state.<digest>.item
+            parts = prefix.split('.')
+            if len(parts) == 5 and parts[2] == 'state' and \
+                    (head is None or parts[1] == head):
+                states.setdefault(parts[1], {})[value] = parts[3]
+        elif event == 'end_map' and head is not None and \
+                prefix == 'versions.{}.state'.format(head):
+            break
+    return Inventory(head, states.get(head, {}))
+
+
+def _read_json(f):
+    data = json.load(f)
+    head = data['head']
+    state = {}
+    for digest, paths in data['versions'][head]['state'].items():
+        for path in paths:
+            state[path] = digest
+    return Inventory(head, state)
+
+
+def read_inventory(path):
+    """Parse the head version of the inventory.json at path."""
+    with open(path, 'rb') as f, span('inventory'):
+        if ijson is not None:
+            return _read_streaming(f)
+        return _read_json(f)
+
+
+def set_pairtree_root(path):
+    """Read inventories from a different pairtree."""
+    global _pairtree_root
+    _pairtree_root = path
+
+
+def get_pairtree_root():
+    return _pairtree_root
+
+
+def get_inventory_path(ark):
+    # e.g. ark:61001/b2hd4d25q389 -> <root>/b2/hd/4d/25/q3/89/inventory.json
+    noid = ark.split('/')[-1]
+    return os.path.join(
+        _pairtree_root,
+        os.sep.join([noid[i:i+2] for i in range(0, len(noid), 2)]),
+        'inventory.json'
+    )
+
+
+def load_inventory(ark):
+    """Returns the Inventory for an ARK. Raises FileNotFoundError if it
+       has no inventory.json."""
+    path = get_inventory_path(ark)
+    st = os.stat(path)
+    signature = (st.st_mtime_ns, st.st_size)
+    with _lock:
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == signature:
+            _cache.move_to_end(path)
+            count('inventory_cache.hit')
+            return cached[1]
+    count('inventory_cache.miss')
+
+    inventory = read_inventory(path)
+
+    with _lock:
+        _cache[path] = (signature, inventory)
+        _cache.move_to_end(path)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return inventory
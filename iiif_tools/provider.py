@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Provider branding for manifests: the logo's size and MIME type.
+
+Every manifest's provider block includes the library logo, with its width,
+height and format. These are looked up once per process, and values that
+had to be fetched are kept in IIIF_TOOLS_LOGO_CACHE for IIIF_TOOLS_LOGO_TTL
+seconds so that new processes usually don't need the network either.
+Only the logo's header is downloaded, via image_probe.
+
+Logos can also be described statically, in a JSON file named by
+IIIF_TOOLS_LOGO_CONFIG, or with set_logo():
+
+    {"https://www.lib.uchicago.edu/static/base/images/color-logo.png":
+        {"width": 600, "height": 120, "mime_type": "image/png"}}
+
+With IIIF_TOOLS_OFFLINE set, or after set_offline(True), no requests are
+made at all: a cached value is used however old it is, and a logo whose
+size isn't known is returned without one.
+"""
+
+import collections
+import json
+import mimetypes
+import os
+import threading
+import time
+
+from build_state import write_if_changed
+from image_probe import probe_image
+from instrumentation import count
+
+LOGO_URL = 'https://www.lib.uchicago.edu/static/base/images/color-logo.png'
+
+LOGO_CACHE = os.environ.get(
+    'IIIF_TOOLS_LOGO_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'iiif_tools', 'logos.json')
+)
+LOGO_CONFIG = os.environ.get('IIIF_TOOLS_LOGO_CONFIG')
+LOGO_TTL = float(os.environ.get('IIIF_TOOLS_LOGO_TTL', 7 * 24 * 60 * 60))
+LOGO_TIMEOUT = 30
+
+Logo = collections.namedtuple('Logo', ['url', 'width', 'height', 'mime_type'])
+
+_logos = {}
+_lock = threading.Lock()
+_config_loaded = False
+_offline = bool(os.environ.get('IIIF_TOOLS_OFFLINE'))
+
+
+def set_offline(offline=True):
+    """Turn network access for logo lookups off or on."""
+    global _offline
+    _offline = offline
+
+
+def is_offline():
+    return _offline
+
+
+def set_logo(url, width, height, mime_type='image/png'):
+    """Describe a logo statically, so it is never fetched."""
+    with _lock:
+        _logos[url] = Logo(url, width, height, mime_type)
+
+
+def _load_config(path):
+    with open(path) as f:
+        for url, logo in json.load(f).items():
+            _logos[url] = Logo(
+                url,
+                logo['width'],
+                logo['height'],
+                logo.get('mime_type', 'image/png')
+            )
+
+
+def _read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_cache(path, cache):
+    write_if_changed(path, json.dumps(cache, indent=4, sort_keys=True))
+
+
+def _fetch(url, cache_path):
+    cache = _read_cache(cache_path) if cache_path else {}
+    entry = cache.get(url)
+    if entry is not None and (_offline or time.time() - entry['fetched'] < LOGO_TTL):
+        count('logo_cache.hit')
+        return Logo(url, entry['width'], entry['height'], entry['mime_type'])
+    if _offline:
+        return Logo(url, None, None, mimetypes.guess_type(url)[0])
+
+    count('logo_cache.miss')
+    width, height, mime_type = probe_image(url, LOGO_TIMEOUT)
+    if cache_path:
+        cache = _read_cache(cache_path)
+        cache[url] = {
+            'width': width,
+            'height': height,
+            'mime_type': mime_type,
+            'fetched': time.time()
+        }
+        _write_cache(cache_path, cache)
+    return Logo(url, width, height, mime_type)
+
+
+def get_logo(url=LOGO_URL, cache_path=LOGO_CACHE):
+    """Returns a Logo for url, from static config, this process's memo,
+       the on-disk cache or the network, in that order."""
+    global _config_loaded
+    with _lock:
+        if LOGO_CONFIG and not _config_loaded:
+            _load_config(LOGO_CONFIG)
+            _config_loaded = True
+        if url not in _logos:
+            _logos[url] = _fetch(url, cache_path)
+        return _logos[url]
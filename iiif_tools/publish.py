@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""Usage:
+   iiif_tools publish <output-dir> [<file>...] [--compact] [--no-compress]
+
+Publish IIIF documents to a directory for a static web server. Each
+document is written at the path of its URL (its id, or @id), e.g.
+
+    https://iiif-collection.lib.uchicago.edu/mvol/0004/1930.json
+        -> <output-dir>/mvol/0004/1930.json
+
+Documents are read from each <file>, or from standard input, so the
+builders that print to stdout can be piped straight into this command.
+
+Files are written to a temporary file and renamed into place, so the web
+server never sees a partly written document, and only files whose bytes
+have changed are touched. Next to each file go precompressed .gz and .br
+copies, for a server set up to send them as they are (e.g. nginx with
+gzip_static and brotli_static), and a .etag file with a strong ETag for
+each encoding. Brotli copies need the brotli package; without it, no .br
+copy is written.
+
+Options:
+  --compact       Write documents without indentation.
+  --no-compress   Don't write .gz, .br or .etag files.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+import urllib.parse
+
+from build_state import write_if_changed
+from docopt import docopt
+from instrumentation import count, span
+from json_writer import iterencode
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+def get_output_path(output_dir, url):
+    # e.g. https://iiif-manifest.lib.uchicago.edu/gms/0019/gms-0019.json
+    #      -> <output_dir>/gms/0019/gms-0019.json
+    return os.path.join(
+        output_dir,
+        urllib.parse.urlparse(url).path.lstrip('/')
+    )
+
+
+def get_etag(data):
+    """A strong ETag for a representation: a hash of its bytes."""
+    return '"{}"'.format(hashlib.sha256(data).hexdigest()[:32])
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def write_sidecars(path):
+    """Write path.gz, path.br and path.etag for the file at path. Sidecars
+       that already hold the right bytes aren't touched.
+
+    Returns:
+      bool: True if any sidecar was written.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    etags = {'identity': get_etag(data)}
+    written = False
+
+    with span('compress'):
+        # mtime=0, so that the same document always compresses to the
+        # same bytes.
+        compressed = gzip.compress(data, GZIP_LEVEL, mtime=0)
+    written |= write_if_changed(path + '.gz', compressed)
+    etags['gzip'] = get_etag(compressed)
+
+    if brotli is not None:
+        with span('compress'):
+            compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+        written |= write_if_changed(path + '.br', compressed)
+        etags['br'] = get_etag(compressed)
+    else:
+        # don't leave an old .br behind to be served for a new document.
+        _remove(path + '.br')
+
+    written |= write_if_changed(
+        path + '.etag',
+        json.dumps(etags, indent=4, sort_keys=True) + '\n'
+    )
+    return written
+
+
+def has_sidecars(path):
+    return all(
+        os.path.exists(path + extension)
+        for extension in ('.gz', '.etag') + (('.br',) if brotli else ())
+    )
+
+
+def publish_file(path, text, compress=True):
+    """Write a document atomically, unless the file already holds exactly
+       these bytes, and with compress, its sidecars.
+
+    Args:
+      text: a str or bytes, or an iterable of chunks of either, e.g. from
+        json_writer.iterencode().
+
+    Returns:
+      bool: True if the document was written.
+    """
+    written = write_if_changed(path, text)
+    if compress and (written or not has_sidecars(path)):
+        write_sidecars(path)
+    count('publish.' + ('written' if written else 'unchanged'))
+    return written
+
+
+def publish(output_dir, url, text, compress=True):
+    """Publish a document at the path of its URL below output_dir.
+
+    Returns:
+      tuple: (output path, True if the document was written)
+    """
+    path = get_output_path(output_dir, url)
+    return path, publish_file(path, text, compress)
+
+
+def main():
+    options = docopt(__doc__)
+
+    written = unchanged = 0
+    for name in options['<file>'] or ['-']:
+        if name == '-':
+            text = sys.stdin.read()
+        else:
+            with open(name) as f:
+                text = f.read()
+        data = json.loads(text)
+        url = data.get('id') or data.get('@id')
+        if not url:
+            sys.stderr.write('{}: no id or @id, skipped\n'.format(name))
+            continue
+        if options['--compact']:
+            text = iterencode(data, True)
+        elif not text.endswith('\n'):
+            text += '\n'
+        path, was_written = publish(
+            options['<output-dir>'],
+            url,
+            text,
+            not options['--no-compress']
+        )
+        if was_written:
+            written += 1
+            sys.stdout.write('{}\n'.format(path))
+        else:
+            unchanged += 1
+
+    sys.stderr.write('{} written, {} unchanged\n'.format(written, unchanged))
+
+
+if __name__ == '__main__':
+    main()
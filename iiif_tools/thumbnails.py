@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Thumbnail geometry for whole lists of images at once.
+
+e.g. fit([(5184, 7200), (8000, 6000)], 500) -> [(360, 500), (500, 375)]
+     fit_columns(array('I', [5184, 8000]), array('I', [7200, 6000]), 500)
+         -> ([360, 500], [500, 375])
+
+Sizes are computed for a batch of (width, height) pairs in one go- with
+NumPy if it is installed, otherwise in a single comprehension- so builders
+that list hundreds of items don't repeat the aspect ratio math per item.
+
+The image server renders any size, but sizes that match a level of its
+image pyramid (the full size divided by one of the scale factors in
+info.json) are cheapest to produce. Pass scale_factors to snap each
+thumbnail to the smallest pyramid level that still covers max_size. This
+changes the sizes, and so the URLs, in the output, so it is off unless
+asked for: the builders pass SCALE_FACTORS, which is only set if
+IIIF_TOOLS_THUMBNAIL_SCALE_FACTORS is, e.g. '1,2,4,8,16,32'.
+
+An image with no width or height gets a (0, 0) thumbnail.
+"""
+
+import math
+import os
+import urllib.parse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+IMAGE_SERVER = os.environ.get(
+    'IIIF_TOOLS_IMAGE_SERVER',
+    'https://iiif-server.lib.uchicago.edu'
+)
+
+if os.environ.get('IIIF_TOOLS_THUMBNAIL_SCALE_FACTORS'):
+    SCALE_FACTORS = [
+        int(s) for s in os.environ['IIIF_TOOLS_THUMBNAIL_SCALE_FACTORS'].split(',')
+    ]
+else:
+    SCALE_FACTORS = None
+
+
+def _fit_python(widths, heights, max_size):
+    fitted = [
+        (0, 0) if not w or not h
+        else (max_size, int(max_size * 1.0 / w * h)) if w > h
+        else (int(max_size * 1.0 / h * w), max_size)
+        for w, h in zip(widths, heights)
+    ]
+    return [w for w, h in fitted], [h for w, h in fitted]
+
+
+def _fit_numpy(widths, heights, max_size):
+    w = numpy.asarray(widths, dtype=numpy.float64)
+    h = numpy.asarray(heights, dtype=numpy.float64)
+    landscape = w > h
+    empty = (w == 0) | (h == 0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        fitted_widths = numpy.where(landscape, max_size, max_size / h * w)
+        fitted_heights = numpy.where(landscape, max_size / w * h, max_size)
+    fitted_widths = numpy.where(empty, 0, fitted_widths)
+    fitted_heights = numpy.where(empty, 0, fitted_heights)
+    return (
+        fitted_widths.astype(numpy.int64).tolist(),
+        fitted_heights.astype(numpy.int64).tolist()
+    )
+
+
+def _snap_python(widths, heights, max_size, scale_factors):
+    snapped_widths = []
+    snapped_heights = []
+    for w, h in zip(widths, heights):
+        if not w or not h:
+            snapped_widths.append(0)
+            snapped_heights.append(0)
+            continue
+        # the largest reduction whose long side still covers max_size.
+        scale = max([s for s in scale_factors if max(w, h) / s >= max_size] + [1])
+        snapped_widths.append(math.ceil(w / scale))
+        snapped_heights.append(math.ceil(h / scale))
+    return snapped_widths, snapped_heights
+
+
+def _snap_numpy(widths, heights, max_size, scale_factors):
+    w = numpy.asarray(widths, dtype=numpy.float64)
+    h = numpy.asarray(heights, dtype=numpy.float64)
+    factors = numpy.asarray(scale_factors, dtype=numpy.float64)
+    covers = numpy.maximum(w, h)[:, None] / factors[None, :] >= max_size
+    scale = numpy.where(covers, factors[None, :], 1.0).max(axis=1)
+    empty = (w == 0) | (h == 0)
+    return (
+        numpy.where(empty, 0, numpy.ceil(w / scale)).astype(numpy.int64).tolist(),
+        numpy.where(empty, 0, numpy.ceil(h / scale)).astype(numpy.int64).tolist()
+    )
+
+
+def fit_columns(widths, heights, max_size, scale_factors=None):
+    """Best-fit thumbnail sizes for columns of widths and heights, e.g. a
+       pair of array('I')s, which NumPy reads without copying.
+
+    Args:
+      widths (sequence): width of each full size image.
+      heights (sequence): height of each full size image.
+      max_size (int): the long side of each thumbnail.
+      scale_factors (list): if given, return the image server's pyramid
+        level nearest to max_size (without going under it) instead of the
+        exact size.
+
+    Returns:
+      tuple: (list of thumbnail widths, list of thumbnail heights)
+    """
+    if not len(widths):
+        return [], []
+    if scale_factors:
+        if numpy is not None:
+            return _snap_numpy(widths, heights, max_size, scale_factors)
+        return _snap_python(widths, heights, max_size, scale_factors)
+    if numpy is not None:
+        return _fit_numpy(widths, heights, max_size)
+    return _fit_python(widths, heights, max_size)
+
+
+def fit(sizes, max_size, scale_factors=None):
+    """Best-fit thumbnail sizes for a list of (width, height) pairs.
+
+    Returns:
+      list: (width, height) of each thumbnail, in the same order.
+    """
+    sizes = list(sizes)
+    widths, heights = fit_columns(
+        [w for w, h in sizes],
+        [h for w, h in sizes],
+        max_size,
+        scale_factors
+    )
+    return list(zip(widths, heights))
+
+
+def get_service_url(identifier, server=IMAGE_SERVER):
+    # e.g. ark:61001/b2hd4d25q389 ->
+    #      https://iiif-server.lib.uchicago.edu/ark%3A61001%2Fb2hd4d25q389
+    return '{}/{}'.format(server, urllib.parse.quote(identifier, safe=''))
+
+
+def get_thumbnail_url(service_url, size):
+    return '{}/full/{},{}/0/default.jpg'.format(service_url, size[0], size[1])
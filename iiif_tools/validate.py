@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+"""Usage:
+   iiif_tools validate <path>... [--processes=<processes>] [--cache=<path>] [--no-cache] [--json=<path>]
+
+Validate IIIF Presentation 3 manifests and collections against the schema
+in iiif_3_0.json. Each <path> is a JSON file or a directory to search for
+*.json files, e.g. the output directory of iiif_tools build. Documents
+that aren't Presentation 3, like the mvol manifests and collections, are
+skipped.
+
+Files are validated across a process pool, and the schema is compiled
+once per worker. Results are cached by a hash of each file's contents and
+of the schema, so files that haven't changed since they were last
+validated aren't validated again.
+
+Errors are printed with the JSON pointer of the value they are about:
+
+    gms/0019/gms-0019.json /items/0/width: 'x' is not of type 'integer'
+
+Needs jsonschema (pip install jsonschema). If fastjsonschema is installed
+too, the schema is also compiled to Python with it, and documents are
+checked with that first- about ten times faster- and only handed to
+jsonschema for a full list of errors if they fail.
+
+Options:
+  --processes=<processes>  Number of worker processes [default: 4].
+  --cache=<path>           Results cache, instead of $IIIF_TOOLS_VALIDATE_CACHE.
+  --no-cache               Validate every file, even if it hasn't changed.
+  --json=<path>            Write a JSON report.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from build_state import code_version, hash_inputs
+from concurrent.futures import ProcessPoolExecutor
+from docopt import docopt
+from instrumentation import span
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+SCHEMA_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'iiif_3_0.json'
+)
+
+VALIDATE_CACHE = os.environ.get(
+    'IIIF_TOOLS_VALIDATE_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'iiif_tools', 'validate.db')
+)
+
+# validate manifests and collections in the builders before writing them.
+VALIDATE = bool(os.environ.get('IIIF_TOOLS_VALIDATE'))
+
+# results are saved to the cache in batches of this many files.
+BATCH_SIZE = 1000
+
+
+class ValidationError(ValueError):
+    """A document doesn't match the IIIF schema. errors is a list of
+       (JSON pointer, message) pairs."""
+
+    def __init__(self, errors, name=None):
+        self.errors = errors
+        self.name = name
+        super().__init__('{} is not valid IIIF:\n{}'.format(
+            name or 'document',
+            '\n'.join('{}: {}'.format(p or '/', m) for p, m in errors)
+        ))
+
+
+_validator = None
+_fast_validator = None
+
+
+def get_validator():
+    """Returns the IIIF Presentation 3 schema, compiled. The schema is only
+       loaded and compiled once per process."""
+    global _validator, _fast_validator
+    if _validator is None:
+        if jsonschema is None:
+            raise ImportError(
+                'validating IIIF needs jsonschema: pip install jsonschema'
+            )
+        with open(SCHEMA_PATH) as f:
+            schema = json.load(f)
+        # the schema's $schema isn't a draft jsonschema knows; it is
+        # written for draft 7.
+        _validator = jsonschema.Draft7Validator(schema)
+        if fastjsonschema is not None:
+            # jsonschema doesn't check formats by default either.
+            _fast_validator = fastjsonschema.compile(schema, use_formats=False)
+    return _validator
+
+
+def json_pointer(path):
+    # e.g. ['items', 0, 'width'] -> '/items/0/width'
+    return ''.join(
+        '/' + str(p).replace('~', '~0').replace('/', '~1') for p in path
+    )
+
+
+def _leaves(error):
+    """The errors to report for one schema error. When a document fails
+       every branch of a oneOf- e.g. manifest, collection or annotation
+       page- report the errors from the branch for its type, not the
+       oneOf itself."""
+    if error.validator in ('oneOf', 'anyOf') and error.context:
+        branches = {}
+        for e in error.context:
+            branches.setdefault(e.schema_path[0], []).append(e)
+        type_path = list(error.absolute_path) + ['type']
+        matching = [
+            errors for errors in branches.values()
+            if not any(list(e.absolute_path) == type_path for e in errors)
+        ]
+        if len(matching) == 1:
+            for e in matching[0]:
+                yield from _leaves(e)
+            return
+        error = jsonschema.exceptions.best_match([error])
+    yield error
+
+
+def is_iiif3(data):
+    if not isinstance(data, dict):
+        return False
+    context = data.get('@context')
+    if isinstance(context, str):
+        context = [context]
+    return any(
+        isinstance(c, str) and 'iiif.io/api/presentation/3/' in c
+        for c in context or []
+    )
+
+
+def validate(data):
+    """Validate a manifest or collection.
+
+    Returns:
+      list: (JSON pointer, message) for each error, or [] if data is valid.
+    """
+    errors = []
+    with span('validate'):
+        validator = get_validator()
+        if _fast_validator is not None:
+            try:
+                _fast_validator(data)
+                return errors
+            except fastjsonschema.JsonSchemaValueException:
+                pass
+        for error in validator.iter_errors(data):
+            for leaf in _leaves(error):
+                errors.append((json_pointer(leaf.absolute_path), leaf.message))
+    return sorted(set(errors))
+
+
+def check(data, name=None):
+    """Raise ValidationError if data isn't a valid manifest or collection.
+       name, e.g. its URL, goes in the error message."""
+    errors = validate(data)
+    if errors:
+        raise ValidationError(errors, name)
+
+
+class ValidationCache:
+    """Validation results, keyed by a hash of a file's contents and the
+       schema."""
+
+    def __init__(self, path=VALIDATE_CACHE):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute(
+            '''CREATE TABLE IF NOT EXISTS results (
+                   digest TEXT PRIMARY KEY,
+                   status TEXT NOT NULL,
+                   errors TEXT NOT NULL
+               )'''
+        )
+        self.conn.commit()
+
+    def get(self, digest):
+        '''Returns (status, errors), or None on a miss.'''
+        with self.lock, span('sqlite'):
+            row = self.conn.execute(
+                'SELECT status, errors FROM results WHERE digest = ?',
+                (digest,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], [tuple(e) for e in json.loads(row[1])]
+
+    def set_many(self, rows):
+        '''Save [(digest, status, errors), ...] in one transaction.'''
+        with self.lock, span('sqlite'):
+            self.conn.executemany(
+                '''INSERT OR REPLACE INTO results (digest, status, errors)
+                   VALUES (?, ?, ?)''',
+                [(d, s, json.dumps(e)) for d, s, e in rows]
+            )
+            self.conn.commit()
+
+
+def find_files(paths):
+    """Returns every JSON file in paths, searching directories."""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for directory, subdirectories, names in os.walk(path):
+            subdirectories.sort()
+            files.extend(
+                os.path.join(directory, name)
+                for name in sorted(names) if name.endswith('.json')
+            )
+    return files
+
+
+_settings = {}
+
+
+def _init_worker(cache_path):
+    _settings['cache'] = ValidationCache(cache_path) if cache_path else None
+    _settings['schema_version'] = code_version(SCHEMA_PATH)
+    get_validator()
+
+
+def _validate_file(path):
+    """Returns (path, digest, status, errors, cached), where status is
+       'valid', 'invalid' or 'skipped'."""
+    with open(path, 'rb') as f:
+        contents = f.read()
+    digest = hash_inputs(_settings['schema_version'], contents)
+    if _settings['cache'] is not None:
+        cached = _settings['cache'].get(digest)
+        if cached is not None:
+            return (path, digest) + cached + (True,)
+
+    try:
+        data = json.loads(contents)
+    except ValueError as e:
+        return path, digest, 'invalid', [('', 'not JSON: {}'.format(e))], False
+    if not is_iiif3(data):
+        return path, digest, 'skipped', [], False
+    errors = validate(data)
+    return path, digest, 'invalid' if errors else 'valid', errors, False
+
+
+def validate_files(paths, processes=4, cache_path=VALIDATE_CACHE):
+    """Validate JSON files across a process pool.
+
+    Args:
+      paths (list): files to validate.
+      cache_path (str): the results cache, or None not to use one.
+
+    Returns:
+      dict: (status, errors, cached) by path.
+    """
+    results = {}
+    cache = ValidationCache(cache_path) if cache_path else None
+    pending = []
+    # enough files per task to keep inter-process traffic down, but enough
+    # tasks to keep every worker busy.
+    chunksize = max(1, min(64, len(paths) // (processes * 4)))
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_worker,
+        initargs=(cache_path,)
+    ) as executor:
+        for path, digest, status, errors, cached in executor.map(
+            _validate_file,
+            paths,
+            chunksize=chunksize
+        ):
+            results[path] = (status, errors, cached)
+            if cache is not None and not cached:
+                pending.append((digest, status, errors))
+                if len(pending) >= BATCH_SIZE:
+                    cache.set_many(pending)
+                    pending = []
+    if cache is not None and pending:
+        cache.set_many(pending)
+    return results
+
+
+def write_json_report(path, results):
+    with open(path, 'w') as f:
+        json.dump(
+            [
+                {
+                    'path': p,
+                    'status': status,
+                    'errors': [
+                        {'pointer': pointer, 'message': message}
+                        for pointer, message in errors
+                    ]
+                }
+                for p, (status, errors, cached) in sorted(results.items())
+            ],
+            f,
+            indent=4,
+            sort_keys=True
+        )
+
+
+def main():
+    options = docopt(__doc__)
+    if jsonschema is None:
+        sys.stderr.write('validate needs jsonschema: pip install jsonschema\n')
+        sys.exit(2)
+
+    start = time.perf_counter()
+    paths = find_files(options['<path>'])
+    results = validate_files(
+        paths,
+        int(options['--processes']),
+        None if options['--no-cache'] else options['--cache'] or VALIDATE_CACHE
+    )
+    seconds = time.perf_counter() - start
+
+    counts = {'valid': 0, 'invalid': 0, 'skipped': 0}
+    for path, (status, errors, cached) in sorted(results.items()):
+        counts[status] += 1
+        for pointer, message in errors:
+            sys.stdout.write('{} {}: {}\n'.format(path, pointer or '/', message))
+
+    if options['--json']:
+        write_json_report(options['--json'], results)
+
+    sys.stderr.write(
+        '{} files in {:.1f}s: {} valid, {} invalid, {} skipped, {} cached\n'.format(
+            len(results),
+            seconds,
+            counts['valid'],
+            counts['invalid'],
+            counts['skipped'],
+            sum(1 for status, errors, cached in results.values() if cached)
+        )
+    )
+    if counts['invalid']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""A cached listing of a WebDAV directory tree, for the mvol builders.
+
+Listing a year of mvol issues directory by directory takes hundreds of
+sequential PROPFIND requests. WebDavListing fetches the whole tree below a
+directory with a single depth-infinity PROPFIND and answers list() from
+memory, so it can stand in for an owncloud.Client wherever the builders
+only list directories and read small files:
+
+e.g. listing = WebDavListing(oc, '/IIIF_Files/mvol/0004/1931')
+     listing.list('/IIIF_Files/mvol/0004/1931/0106/TIFF')
+         -> [Entry('/IIIF_Files/mvol/0004/1931/0106/TIFF/mvol-0004-1931-0106_0001.tif'), ...]
+
+The tree is cached on disk, below IIIF_TOOLS_WEBDAV_CACHE, along with the
+ETag of its top directory. ownCloud changes a directory's ETag whenever
+anything below it changes, so on the next run a depth-0 PROPFIND is enough
+to tell whether the cached tree can be used as is. The year, month and
+pub-year scripts list the same year directory, so they share one cached
+tree. Files read with get_file_contents(), e.g. struct.txt, are cached by
+ETag the same way.
+
+Servers that refuse depth-infinity PROPFINDs are walked with depth-1
+PROPFINDs instead. Pass depth=<n> to walk n levels per request from the
+start.
+"""
+
+import collections
+import hashlib
+import json
+import os
+
+from build_state import write_if_changed
+from instrumentation import count, span
+
+WEBDAV_CACHE = os.environ.get(
+    'IIIF_TOOLS_WEBDAV_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'iiif_tools', 'webdav')
+)
+
+# status codes servers use to refuse depth-infinity PROPFINDs.
+REFUSED = (400, 403, 501)
+
+
+class Entry:
+    """One file or directory in a listing. Has the parts of
+       owncloud.FileInfo the builders use."""
+
+    __slots__ = ('path', 'file_type', 'etag', 'size')
+
+    def __init__(self, path, file_type, etag=None, size=None):
+        self.path = path
+        self.file_type = file_type
+        self.etag = etag
+        self.size = size
+
+    def __repr__(self):
+        return 'Entry({!r})'.format(self.path)
+
+    def get_name(self):
+        return os.path.basename(self.path.rstrip('/'))
+
+    def get_path(self):
+        return os.path.dirname(self.path.rstrip('/'))
+
+    def get_etag(self):
+        return self.etag
+
+    def get_size(self):
+        return self.size
+
+    def is_dir(self):
+        return self.file_type != 'file'
+
+
+def _normalize(path):
+    # e.g. 'IIIF_Files/mvol/0004/1931//0106/' -> '/IIIF_Files/mvol/0004/1931/0106'
+    return '/' + '/'.join(p for p in path.split('/') if p)
+
+
+def _entry(info):
+    size = info.attributes.get('{DAV:}getcontentlength')
+    return Entry(
+        info.path,
+        info.file_type,
+        info.attributes.get('{DAV:}getetag'),
+        int(size) if size is not None else None
+    )
+
+
+class WebDavListing:
+    """Every file and directory below one WebDAV directory.
+
+    Args:
+      client: an owncloud.Client, or anything with the same list(),
+        file_info() and get_file_contents().
+      directory (str): the top of the tree, e.g. /IIIF_Files/mvol/0004/1931
+      depth: 'infinity' to fetch the tree in one request, or the number of
+        levels to fetch per request.
+      cache_dir (str): where to keep listings and files between runs, or
+        None to keep them in memory only.
+    """
+
+    def __init__(self, client, directory, depth='infinity', cache_dir=WEBDAV_CACHE):
+        self.client = client
+        self.directory = _normalize(directory)
+        self.depth = depth
+        self.cache_dir = cache_dir
+        self.etag = None
+        self.children = None
+
+    def _cache_key(self, path):
+        return hashlib.sha1(
+            '{}\n{}'.format(getattr(self.client, 'url', ''), path).encode('utf-8')
+        ).hexdigest()
+
+    def _read_cache(self):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, self._cache_key(self.directory) + '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, etag, entries):
+        if not self.cache_dir:
+            return
+        write_if_changed(
+            os.path.join(self.cache_dir, self._cache_key(self.directory) + '.json'),
+            json.dumps({
+                'directory': self.directory,
+                'etag': etag,
+                'entries': [[e.path, e.file_type, e.etag, e.size] for e in entries]
+            }).encode('utf-8')
+        )
+
+    def _list(self, path, depth):
+        count('webdav.requests')
+        with span('webdav'):
+            return [_entry(info) for info in self.client.list(path, depth=depth)]
+
+    def _walk(self, depth):
+        """Fetch the tree with depth-limited PROPFINDs, starting again from
+           each directory at the edge of the last one."""
+        entries = []
+        pending = [self.directory]
+        while pending:
+            path = pending.pop()
+            for entry in self._list(path, depth):
+                entries.append(entry)
+                relative = entry.path.rstrip('/')[len(path):]
+                if entry.is_dir() and relative.count('/') >= depth:
+                    pending.append(entry.path.rstrip('/'))
+        return entries
+
+    def _fetch(self):
+        if self.depth != 'infinity':
+            return self._walk(self.depth)
+        try:
+            return self._list(self.directory, 'infinity')
+        except Exception as e:
+            if getattr(e, 'status_code', None) not in REFUSED:
+                raise
+            return self._walk(1)
+
+    def load(self):
+        """Read the tree from the cache if the top directory's ETag hasn't
+           changed, otherwise from the server."""
+        count('webdav.requests')
+        with span('webdav'):
+            etag = _entry(self.client.file_info(self.directory + '/')).etag
+
+        cached = self._read_cache()
+        if etag is not None and cached is not None and cached['etag'] == etag:
+            count('webdav_cache.hit')
+            entries = [Entry(*e) for e in cached['entries']]
+        else:
+            count('webdav_cache.miss')
+            entries = self._fetch()
+            self._write_cache(etag, entries)
+
+        self.etag = etag
+        self.children = {}
+        for entry in entries:
+            self.children.setdefault(entry.get_path(), []).append(entry)
+
+    def _in_tree(self, path):
+        return path == self.directory or path.startswith(self.directory + '/')
+
+    def find(self, path):
+        """Returns the Entry for a path in the tree, or None."""
+        path = _normalize(path)
+        if path == self.directory or not self._in_tree(path):
+            return None
+        for entry in self.list(os.path.dirname(path)):
+            if entry.path.rstrip('/') == path:
+                return entry
+        return None
+
+    def list(self, path, depth=1):
+        """Like owncloud.Client.list(): the entries below path, down to
+           depth levels. Paths outside the tree are listed by the client."""
+        path = _normalize(path)
+        if not self._in_tree(path):
+            return self.client.list(path, depth=depth)
+        if self.children is None:
+            self.load()
+
+        entries = []
+        pending = collections.deque([(path, 1)])
+        while pending:
+            directory, level = pending.popleft()
+            for entry in self.children.get(directory, []):
+                entries.append(entry)
+                if entry.is_dir() and (depth == 'infinity' or level < depth):
+                    pending.append((entry.path.rstrip('/'), level + 1))
+        return entries
+
+    def get_file_contents(self, path):
+        """Like owncloud.Client.get_file_contents(), but files whose ETag
+           hasn't changed since they were last read come from the cache."""
+        path = _normalize(path)
+        entry = self.find(path)
+        etag = entry.etag if entry is not None else None
+        if self.cache_dir and etag is not None:
+            cache_path = os.path.join(self.cache_dir, 'files', self._cache_key(path))
+            try:
+                with open(cache_path + '.etag') as f:
+                    if f.read() == etag:
+                        with open(cache_path, 'rb') as g:
+                            data = g.read()
+                        count('webdav_cache.hit')
+                        return data
+            except OSError:
+                pass
+
+        count('webdav_cache.miss')
+        count('webdav.requests')
+        with span('webdav'):
+            data = self.client.get_file_contents(path)
+        if data and self.cache_dir and etag is not None:
+            write_if_changed(cache_path, data)
+            write_if_changed(cache_path + '.etag', etag)
+        return data
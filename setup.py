@@ -9,6 +9,7 @@ setuptools.setup(
     description='Scripts to build IIIF records for digital collections at the University of Chicago.',
     entry_points={
         'console_scripts': [
+            'iiif_tools = iiif_tools.__main__:main',
             'cli_collection_browse = iiif_tools.cli_collection_browse:main',
             'soc_sci_maps_build_collection = iiif_tools.soc_sci_maps_build_collection:main',
             'soc_sci_maps_build_manifest = iiif_tools.soc_sci_maps_build_manifest:main',
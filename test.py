@@ -1,16 +1,41 @@
+import asyncio
+import contextlib
+import gzip
+import importlib.machinery
+import importlib.util
 import io
 import json
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import unittest
+import urllib.parse
 import urllib.request
 import os
-
-from mvol_collection_year import IIIFCollectionYear
-from mvol_collection_month import IIIFCollectionMonth
-from mvol_manifest import IIIFManifest
-from mvol_validator import _validate_dc_xml_file, _validate_mets_xml_file, _validate_file_notempty, _validate_struct_txt_file
+import xml.etree.ElementTree as ElementTree
 
 from pathlib import Path
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iiif_tools'))
+
+import ark_resolver
+import check_iiif_urls
+import cli_collection_browse
+import fixtures
+import mvol_pub_year
+import ocfl_inventory
+import publish
+import thumbnails
+from classes import IIIFManifest
+from image_probe import CHUNK_SIZE, ImageProbeError, _HttpReader, _tiff_size, probe_image
+from provider import LOGO_URL, set_logo
+from validate import main as validate_main
+from webdav_listing import WebDavListing
+
 def ordered(obj):
   if isinstance(obj, dict):
     return sorted((k, ordered(v)) for k, v in obj.items())
@@ -22,6 +47,11 @@ def ordered(obj):
 class TestIIIFTools(unittest.TestCase):
 
   '''
+  from mvol_collection_year import IIIFCollectionYear
+  from mvol_collection_month import IIIFCollectionMonth
+  from mvol_manifest import IIIFManifest
+  from mvol_validator import _validate_dc_xml_file, _validate_mets_xml_file, _validate_file_notempty, _validate_struct_txt_file
+
   def test_iiif_collection_year(self): 
     url = 'http://iiif-collection.lib.uchicago.edu/mvol/0004/mvol-0004-1930.json'
     live_data = json.load(urllib.request.urlopen(url))
@@ -60,5 +90,1040 @@ class TestIIIFTools(unittest.TestCase):
   '''
 
 
+def bigtiff_header(width, height, padding=0):
+  """A little-endian BigTIFF with padding bytes of image data before its
+     IFD."""
+  entries = ((256, width), (257, height))
+  ifd = struct.pack('<Q', len(entries))
+  for tag, value in entries:
+    ifd += struct.pack('<HHQQ', tag, 4, 1, value)
+  ifd += struct.pack('<Q', 0)
+  return b'II+\x00' + struct.pack('<HHQ', 8, 0, 16 + padding) + b'\x00' * padding + ifd
+
+
+def tiff_after_data(width, height, padding):
+  """A classic TIFF whose IFD follows padding bytes of image data, as
+     written by scanners that write the IFD last."""
+  header = fixtures.tiff_header(width, height)
+  return b'II*\x00' + struct.pack('<I', 8 + padding) + b'\x00' * padding + header[8:]
+
+
+def jp2(width, height):
+  ihdr = struct.pack('>I4sIIHBBBB', 22, b'ihdr', height, width, 3, 7, 7, 0, 0)
+  return (
+    b'\x00\x00\x00\x0cjP  \r\n\x87\n' +
+    struct.pack('>I4s4sI4s', 20, b'ftyp', b'jp2 ', 0, b'jp2 ') +
+    struct.pack('>I4s', 8 + len(ihdr), b'jp2h') + ihdr
+  )
+
+
+def png(width, height):
+  return (
+    b'\x89PNG\r\n\x1a\n' +
+    struct.pack('>I4sIIBBBBB', 13, b'IHDR', width, height, 8, 2, 0, 0, 0) +
+    b'\x00' * 4
+  )
+
+
+class TestImageProbe(unittest.TestCase):
+
+  def probe(self, data):
+    with tempfile.NamedTemporaryFile(suffix='.img') as f:
+      f.write(data)
+      f.flush()
+      return probe_image(f.name)
+
+  def test_tiff(self):
+    self.assertEqual(self.probe(fixtures.tiff_header(5184, 7200)), (5184, 7200, 'image/tiff'))
+
+  def test_tiff_ifd_after_data(self):
+    self.assertEqual(
+      self.probe(tiff_after_data(5184, 7200, 1024 * 1024)),
+      (5184, 7200, 'image/tiff')
+    )
+
+  def test_bigtiff(self):
+    self.assertEqual(self.probe(bigtiff_header(70000, 90000)), (70000, 90000, 'image/tiff'))
+    self.assertEqual(
+      self.probe(bigtiff_header(70000, 90000, 1024 * 1024)),
+      (70000, 90000, 'image/tiff')
+    )
+
+  def test_jpeg(self):
+    self.assertEqual(self.probe(fixtures.jpeg(640, 480)), (640, 480, 'image/jpeg'))
+
+  def test_jp2(self):
+    self.assertEqual(self.probe(jp2(4000, 3000)), (4000, 3000, 'image/jp2'))
+
+  def test_png(self):
+    self.assertEqual(self.probe(png(320, 200)), (320, 200, 'image/png'))
+
+  def test_truncated(self):
+    for data in (
+      fixtures.tiff_header(5184, 7200)[:12],
+      bigtiff_header(70000, 90000)[:30],
+      tiff_after_data(5184, 7200, 1024)[:512],
+      fixtures.jpeg(640, 480)[:8],
+      jp2(4000, 3000)[:44],
+      png(320, 200)[:20]
+    ):
+      with self.assertRaises(ImageProbeError):
+        self.probe(data)
+
+  def test_empty_range(self):
+    # a server that answers a Range request past the end of the file
+    # with 416, which reads as b''.
+    class EmptyReader:
+      def read(self, offset, length):
+        return b''
+    with self.assertRaises(ImageProbeError):
+      _tiff_size(EmptyReader(), fixtures.tiff_header(5184, 7200)[:8])
+
+
+def start_server(directory, handler=None):
+  """Serve a fixtures directory on a free port, on a background thread."""
+  server = fixtures.FixtureServer(directory, port=0)
+  if handler is not None:
+    server.RequestHandlerClass = handler
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+def stop_server(server):
+  server.shutdown()
+  server.server_close()
+
+
+class NoRangeHandler(fixtures.FixtureHandler):
+  # a server that ignores Range and always sends the whole file.
+  def respond(self, head):
+    del self.headers['Range']
+    super().respond(head)
+
+
+class RangeFileHandler(fixtures.FixtureHandler):
+  # a server that answers Range requests for the files it serves from
+  # <dir>/manifests, as well as for ARKs' TIFFs.
+  def send_file(self, body, content_type, head):
+    m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+    if not m:
+      return super().send_file(body, content_type, head)
+    start = int(m.group(1))
+    end = min(int(m.group(2) or len(body) - 1), len(body) - 1)
+    if start >= len(body):
+      return self.send_body(416, 'text/plain', b'', head)
+    self.send_body(206, content_type, body[start:end + 1], head, {
+      'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(body))
+    })
+
+
+class TestHttpReader(unittest.TestCase):
+
+  ark = 'ark:61001/b2hd4d25q389'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'objects.json'), 'w') as f:
+      json.dump({self.ark: {'identifier': 'gms-0019', 'sizes': {'': [5184, 7200]}}}, f)
+    os.makedirs(os.path.join(self.directory, 'manifests'))
+    for name, data in (
+      # the IFD is past the first CHUNK_SIZE bytes fetched.
+      ('late.tif', tiff_after_data(3000, 4000, 1024 * 1024)),
+      # the IFD offset points past the end of the file.
+      ('truncated.tif', tiff_after_data(3000, 4000, 1024 * 1024)[:512 * 1024]),
+      ('image.jpg', fixtures.jpeg(640, 480))
+    ):
+      with open(os.path.join(self.directory, 'manifests', name), 'wb') as f:
+        f.write(data)
+    self.server = None
+
+  def tearDown(self):
+    if self.server is not None:
+      stop_server(self.server)
+    shutil.rmtree(self.directory)
+
+  def test_range(self):
+    self.server = start_server(self.directory)
+    url = '{}/{}/file.tif'.format(self.server.base_url, self.ark)
+    self.assertEqual(probe_image(url, 5), (5184, 7200, 'image/tiff'))
+    # read the header through the reader itself: one Range request, a
+    # small part of the 4 MiB file.
+    reader = _HttpReader(url, 5)
+    _tiff_size(reader, reader.read(0, 32))
+    self.assertIsNone(reader.prefix)
+    self.assertEqual(reader.bytes_read, CHUNK_SIZE)
+
+  def test_range_ignored(self):
+    self.server = start_server(self.directory, NoRangeHandler)
+    url = '{}/{}/file.tif'.format(self.server.base_url, self.ark)
+    self.assertEqual(probe_image(url, 5), (5184, 7200, 'image/tiff'))
+    reader = _HttpReader(url, 5)
+    _tiff_size(reader, reader.read(0, 32))
+    # the response is streamed only until the header has arrived.
+    self.assertIsNotNone(reader.prefix)
+    self.assertLess(reader.bytes_read, fixtures.TIFF_SIZE)
+
+  def test_ifd_after_data(self):
+    for handler in (RangeFileHandler, fixtures.FixtureHandler):
+      self.server = start_server(self.directory, handler)
+      self.assertEqual(
+        probe_image(self.server.base_url + '/manifests/late.tif', 5),
+        (3000, 4000, 'image/tiff')
+      )
+      self.assertEqual(
+        probe_image(self.server.base_url + '/manifests/image.jpg', 5),
+        (640, 480, 'image/jpeg')
+      )
+      stop_server(self.server)
+      self.server = None
+
+  def test_truncated(self):
+    # with Range, the read past the end gets a 416; without it, the whole
+    # file arrives and is too short.
+    for handler in (RangeFileHandler, fixtures.FixtureHandler):
+      self.server = start_server(self.directory, handler)
+      with self.assertRaises(ImageProbeError):
+        probe_image(self.server.base_url + '/manifests/truncated.tif', 5)
+      stop_server(self.server)
+      self.server = None
+
+
+class NoHeadHandler(fixtures.FixtureHandler):
+  # a server that doesn't allow HEAD.
+  def do_HEAD(self):
+    self.send_body(405, 'text/plain', b'', True)
+
+
+class TestCheckIIIFUrls(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'objects.json'), 'w') as f:
+      json.dump({}, f)
+    for name in ('gms/gms-0019.json', 'gms/gms-0020.json', 'rac/rac-0001.json'):
+      path = os.path.join(self.directory, 'manifests', name)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'w') as f:
+        json.dump({'type': 'Manifest'}, f)
+    with open(os.path.join(self.directory, 'manifests', 'array.json'), 'w') as f:
+      json.dump([1, 2], f)
+    self.server = start_server(self.directory)
+
+  def tearDown(self):
+    stop_server(self.server)
+    shutil.rmtree(self.directory)
+
+  def crawl(self, path, state=None):
+    # a crawl that never finishes fails the test instead of hanging it.
+    return asyncio.run(asyncio.wait_for(
+      check_iiif_urls.crawl(
+        self.server.base_url + path,
+        concurrency=4,
+        timeout=5,
+        match='127.0.0.1',
+        state=state
+      ),
+      10
+    ))
+
+  def test_follows_v2_and_v3_collections(self):
+    results = self.crawl('/collections/top.json')
+    base = self.server.base_url
+    self.assertEqual(sorted(results), sorted([
+      base + '/collections/top.json',
+      base + '/collections/gms.json',
+      base + '/collections/rac.json',
+      base + '/manifests/gms/gms-0019.json',
+      base + '/manifests/gms/gms-0020.json',
+      base + '/manifests/rac/rac-0001.json'
+    ]))
+    self.assertTrue(all(r['status'] == 200 for r in results.values()))
+    manifest = results[base + '/manifests/rac/rac-0001.json']
+    self.assertEqual((manifest['method'], manifest['members']), ('GET', []))
+    self.assertEqual(manifest['parent'], base + '/collections/rac.json')
+
+  def write(self, name, data):
+    with open(os.path.join(self.directory, 'manifests', name), 'w') as f:
+      json.dump(data, f)
+
+  def test_head_falls_back_to_get(self):
+    # anything that isn't JSON is only checked, with HEAD where possible.
+    with open(os.path.join(self.directory, 'manifests', 'logo.png'), 'wb') as f:
+      f.write(png(10, 10))
+    self.write('images.json', {
+      'type': 'Collection',
+      'items': [{'id': self.server.base_url + '/manifests/logo.png', 'type': 'Image'}]
+    })
+    url = self.server.base_url + '/manifests/logo.png'
+    result = self.crawl('/manifests/images.json')[url]
+    self.assertEqual((result['status'], result['method']), (200, 'HEAD'))
+    self.server.RequestHandlerClass = NoHeadHandler
+    result = self.crawl('/manifests/images.json')[url]
+    self.assertEqual((result['status'], result['method']), (200, 'GET'))
+
+  def test_follows_mistyped_collections(self):
+    # like the ssmaps root and browse collections, which list their
+    # sub-collections as Manifests.
+    base = self.server.base_url + '/manifests/'
+    self.write('root.json', {
+      'type': 'Collection',
+      'items': [{'id': base + 'sub.json', 'type': 'Manifest'}]
+    })
+    self.write('sub.json', {
+      '@type': 'sc:Collection',
+      'manifests': [{'@id': base + 'm1.json', '@type': 'sc:Manifest'}]
+    })
+    self.write('m1.json', {
+      'type': 'Manifest',
+      'items': [{'id': base + 'canvas/1', 'type': 'Canvas'}]
+    })
+    results = self.crawl('/manifests/root.json')
+    self.assertEqual(
+      sorted(results),
+      [base + 'm1.json', base + 'root.json', base + 'sub.json']
+    )
+    self.assertEqual(results[base + 'sub.json']['members'], [(base + 'm1.json', False)])
+    self.assertEqual(results[base + 'm1.json']['status'], 200)
+    self.assertEqual(results[base + 'm1.json']['members'], [])
+
+  def test_not_modified_reuses_state(self):
+    state_path = os.path.join(self.directory, 'state.json')
+    first = self.crawl('/collections/top.json')
+    check_iiif_urls.save_state(state_path, first)
+    second = self.crawl('/collections/top.json', check_iiif_urls.load_state(state_path))
+    self.assertEqual(sorted(first), sorted(second))
+    for url, result in second.items():
+      self.assertTrue(result['not_modified'], url)
+      self.assertEqual(result['status'], 200)
+    top = second[self.server.base_url + '/collections/top.json']
+    self.assertEqual(len(top['members']), 2)
+
+  def test_collection_that_is_an_array(self):
+    results = self.crawl('/manifests/array.json')
+    self.assertEqual(len(results), 1)
+    result = results[self.server.base_url + '/manifests/array.json']
+    self.assertEqual((result['status'], result['members']), (200, []))
+
+  def test_get_members_skips_non_objects(self):
+    self.assertEqual(check_iiif_urls.get_members([1, 2]), [])
+    self.assertEqual(
+      check_iiif_urls.get_members({
+        'items': [1, 'x', None, {'id': 'https://a/b.json', 'type': 'Manifest'}],
+        'members': {'@id': 'https://a/c.json'},
+        'manifests': [{'@id': 'https://a/d.json', '@type': 'sc:Manifest'}],
+        'collections': [{'@id': ['https://a/e.json']}]
+      }),
+      [('https://a/b.json', False), ('https://a/d.json', False)]
+    )
+
+  def test_unexpected_error_is_recorded(self):
+    def check_url(*args):
+      raise KeyError('status')
+    original = check_iiif_urls.check_url
+    check_iiif_urls.check_url = check_url
+    try:
+      results = self.crawl('/collections/top.json')
+    finally:
+      check_iiif_urls.check_url = original
+    result = results[self.server.base_url + '/collections/top.json']
+    self.assertIsNone(result['status'])
+    self.assertEqual(result['error'], "KeyError: 'status'")
+
+
+class TestCollectionBrowse(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'objects.json'), 'w') as f:
+      json.dump({}, f)
+    os.makedirs(os.path.join(self.directory, 'manifests'))
+    self.server = start_server(self.directory)
+    base = self.server.base_url + '/manifests/'
+    self.write('root.json', {
+      'type': 'Collection',
+      'items': [
+        {'id': base + 'sub.json', 'type': 'Manifest', 'label': {'en': ['Sub']}},
+        {'id': base + 'array.json', 'type': 'Collection', 'label': {'en': ['Array']}}
+      ]
+    })
+    self.write('sub.json', {
+      '@type': 'sc:Collection',
+      'manifests': [{'@id': base + 'm1.json', '@type': 'sc:Manifest', 'label': 'M1'}]
+    })
+    self.write('m1.json', {
+      'type': 'Manifest',
+      'items': [{'id': base + 'canvas/1', 'type': 'Canvas'}]
+    })
+    self.write('array.json', [1, 2])
+
+  def tearDown(self):
+    stop_server(self.server)
+    shutil.rmtree(self.directory)
+
+  def write(self, name, data):
+    with open(os.path.join(self.directory, 'manifests', name), 'w') as f:
+      json.dump(data, f)
+
+  def browse(self, depth):
+    out = io.StringIO()
+    cli_collection_browse.Browser(workers=4, timeout=5).browse(
+      self.server.base_url + '/manifests/root.json', depth, out)
+    return out.getvalue()
+
+  def test_expands_mistyped_collections(self):
+    out = self.browse(3)
+    self.assertIn('|--- Sub\n', out)
+    self.assertIn('|--- M1\n', out)
+    self.assertNotIn('canvas/1', out)
+
+  def test_non_object_collection_is_unavailable(self):
+    out = self.browse(2)
+    self.assertIn('|--- UNAVAILABLE Array\n', out)
+    self.assertIn('|--- M1\n', out)
+
+  def test_get_members_rejects_non_objects(self):
+    with self.assertRaises(ValueError):
+      cli_collection_browse.get_members([1, 2])
+    with self.assertRaises(ValueError):
+      cli_collection_browse.get_members({'items': {'id': 'x'}})
+    self.assertEqual(
+      cli_collection_browse.get_members({'collections': [1, {'@id': 'a'}], 'manifests': [{'@id': 'b'}]}),
+      [{'@id': 'a'}, {'@id': 'b'}]
+    )
+
+
+class TestArkResolver(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'ark_data.db')
+    conn = sqlite3.connect(self.path)
+    conn.execute('CREATE TABLE arks (ark TEXT, original_identifier TEXT)')
+    conn.executemany(
+      'INSERT INTO arks VALUES (?, ?)',
+      [('ark:61001/b{:04d}'.format(n), 'gms-{:04d}'.format(n)) for n in range(1500)] +
+      [('ark:61001/c0001', 'gms_0001'), ('ark:61001/c0002', 'rac-0001')]
+    )
+    conn.commit()
+    conn.close()
+    self.resolver = ark_resolver.ArkResolver(self.path, cache_size=2)
+
+  def tearDown(self):
+    self.resolver.close()
+    shutil.rmtree(self.directory)
+
+  def delete_all(self):
+    conn = sqlite3.connect(self.path)
+    conn.execute('DELETE FROM arks')
+    conn.commit()
+    conn.close()
+
+  def test_lookups(self):
+    self.assertEqual(self.resolver.get_ark('gms-0019'), 'ark:61001/b0019')
+    self.assertEqual(self.resolver.get_original_identifier('ark:61001/b0020'), 'gms-0020')
+    with self.assertRaises(KeyError):
+      self.resolver.get_ark('gms-9999')
+    with self.assertRaises(KeyError):
+      self.resolver.get_original_identifier('ark:61001/x')
+
+  def test_resolve_many_chunks_parameters(self):
+    resolver = ark_resolver.ArkResolver(self.path, cache_size=2000)
+    queries = []
+    fetchall = resolver._fetchall
+    def _fetchall(sql, parameters):
+      queries.append(len(parameters))
+      return fetchall(sql, parameters)
+    resolver._fetchall = _fetchall
+    identifiers = ['gms-{:04d}'.format(n) for n in range(1500)] + ['gms-9999']
+    results = resolver.resolve_many(identifiers)
+    self.assertEqual(queries, [ark_resolver.MAX_PARAMETERS, 1501 - ark_resolver.MAX_PARAMETERS])
+    # a second pass is answered from the cache.
+    self.assertEqual(resolver.resolve_many(identifiers[:1000]), {i: results[i] for i in identifiers[:1000]})
+    self.assertEqual(len(queries), 2)
+    resolver.close()
+    self.assertEqual(len(results), 1500)
+    self.assertEqual(results['gms-1234'], 'ark:61001/b1234')
+    self.assertNotIn('gms-9999', results)
+
+  def test_get_arks_with_prefix(self):
+    self.assertEqual(
+      self.resolver.get_arks_with_prefix('gms-000'),
+      ['ark:61001/b{:04d}'.format(n) for n in range(10)]
+    )
+    # _ and % are matched literally.
+    self.assertEqual(self.resolver.get_arks_with_prefix('gms_'), ['ark:61001/c0001'])
+    self.assertEqual(self.resolver.get_arks_with_prefix('%'), [])
+
+  def test_lru(self):
+    self.resolver.get_ark('gms-0001')
+    self.resolver.get_ark('gms-0002')
+    self.resolver.get_ark('gms-0001')
+    self.resolver.get_ark('gms-0003')
+    self.delete_all()
+    # gms-0002 was the least recently used, so it was evicted.
+    self.assertEqual(self.resolver.get_ark('gms-0001'), 'ark:61001/b0001')
+    self.assertEqual(self.resolver.get_original_identifier('ark:61001/b0003'), 'gms-0003')
+    with self.assertRaises(KeyError):
+      self.resolver.get_ark('gms-0002')
+
+  def test_set_database(self):
+    original = ark_resolver.get_database()
+    try:
+      ark_resolver.set_database(self.path)
+      self.assertEqual(ark_resolver.get_database(), self.path)
+      resolver = ark_resolver.get_resolver()
+      self.assertIs(ark_resolver.get_resolver(), resolver)
+      self.assertEqual(resolver.get_ark('rac-0001'), 'ark:61001/c0002')
+      ark_resolver.set_database(self.path)
+      self.assertIsNot(ark_resolver.get_resolver(), resolver)
+      resolver.close()
+      ark_resolver.get_resolver().close()
+    finally:
+      ark_resolver.set_database(original)
+
+
+class TestOcflInventory(unittest.TestCase):
+
+  ARK = 'ark:61001/b2hd4d25q389'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.original_root = ocfl_inventory.get_pairtree_root()
+    ocfl_inventory.set_pairtree_root(self.directory)
+    self.path = ocfl_inventory.get_inventory_path(self.ARK)
+
+  def tearDown(self):
+    ocfl_inventory.set_pairtree_root(self.original_root)
+    shutil.rmtree(self.directory)
+
+  def write(self, head, mtime_ns):
+    versions = {}
+    for n in range(1, int(head[1:]) + 1):
+      version = 'v{}'.format(n)
+      versions[version] = {'state': {
+        'd{}{}'.format(version, page): ['{:08d}/file.tif'.format(page)]
+        for page in range(1, n + 1)
+      }}
+      versions[version]['state']['dc' + version] = ['file.dc.xml']
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    with open(self.path, 'w') as f:
+      json.dump({'head': head, 'versions': versions}, f)
+    os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+  def test_pairtree_path(self):
+    self.assertEqual(ocfl_inventory.get_pairtree_root(), self.directory)
+    self.assertEqual(
+      self.path,
+      os.path.join(self.directory, 'b2', 'hd', '4d', '25', 'q3', '89', 'inventory.json')
+    )
+
+  def check_head(self):
+    self.write('v2', 10 ** 18)
+    inventory = ocfl_inventory.load_inventory(self.ARK)
+    self.assertEqual(inventory.head, 'v2')
+    self.assertEqual(inventory.get_objects(), ['00000001', '00000002'])
+    self.assertEqual(inventory.get_files(), ['file.dc.xml'])
+    self.assertEqual(inventory.get_files('00000002'), ['file.tif'])
+    self.assertEqual(inventory.state['00000002/file.tif'], 'dv22')
+    self.assertIs(ocfl_inventory.load_inventory(self.ARK), inventory)
+
+    # a rewritten inventory is read again.
+    self.write('v3', 2 * 10 ** 18)
+    inventory = ocfl_inventory.load_inventory(self.ARK)
+    self.assertEqual(inventory.head, 'v3')
+    self.assertEqual(inventory.get_objects(), ['00000001', '00000002', '00000003'])
+
+  def test_json(self):
+    ijson = ocfl_inventory.ijson
+    ocfl_inventory.ijson = None
+    try:
+      self.check_head()
+    finally:
+      ocfl_inventory.ijson = ijson
+
+  @unittest.skipUnless(ocfl_inventory.ijson, 'ijson is not installed')
+  def test_streaming(self):
+    self.check_head()
+
+  def test_missing_inventory(self):
+    with self.assertRaises(FileNotFoundError):
+      ocfl_inventory.load_inventory(self.ARK)
+
+
+class MvolHandler(fixtures.FixtureHandler):
+  # an image server and OCR service for any mvol page, except paths
+  # containing one of server.missing, and recording every path asked for.
+  def respond(self, head):
+    path = urllib.parse.urlparse(self.path).path
+    self.server.paths.append(path)
+    if any(missing in path for missing in self.server.missing):
+      return self.send_not_found(head)
+    self.send_body(200, 'image/jpeg', fixtures.jpeg(1, 1), head)
+
+
+class TestMvolPubYear(unittest.TestCase):
+
+  DIRECTORY = '/IIIF_Files/mvol/0004/1930'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'objects.json'), 'w') as f:
+      json.dump({}, f)
+    self.server = start_server(self.directory, MvolHandler)
+    self.server.paths = []
+    self.server.missing = []
+    # the script lists the year through a WebDavListing.
+    self.listing = WebDavListing(
+      fixtures.MvolListing(self.DIRECTORY, 3, pages=2),
+      self.DIRECTORY,
+      cache_dir=None
+    )
+
+    self.original = mvol_pub_year.IMAGE_SERVER, mvol_pub_year.get_ocr_url
+    mvol_pub_year.IMAGE_SERVER = self.server.base_url
+    mvol_pub_year.get_ocr_url = lambda identifier: \
+      self.server.base_url + '/projects/' + identifier + '/ocr'
+
+  def tearDown(self):
+    mvol_pub_year.IMAGE_SERVER, mvol_pub_year.get_ocr_url = self.original
+    stop_server(self.server)
+    shutil.rmtree(self.directory)
+
+  def verify(self, done=None, on_issue=None):
+    return asyncio.run(asyncio.wait_for(
+      mvol_pub_year.verify_year(
+        self.listing,
+        self.DIRECTORY,
+        concurrency=4,
+        timeout=5,
+        done=done,
+        on_issue=on_issue
+      ),
+      10
+    ))
+
+  def test_all_issues_pass(self):
+    pubs = self.verify()
+    self.assertEqual(
+      [pub['identifier'] for pub in pubs],
+      ['mvol-0004-1930-0101', 'mvol-0004-1930-0102', 'mvol-0004-1930-0103']
+    )
+    for pub in pubs:
+      self.assertEqual(pub['failures'], [])
+      self.assertEqual(pub['ocr']['status'], 200)
+      self.assertEqual([page['page_number'] for page in pub['pages']], ['1', '2'])
+    # OCR, and an image and info.json for each page, of each issue.
+    self.assertEqual(len(self.server.paths), 3 * 5)
+
+  def test_failures_are_collected_per_issue(self):
+    self.server.missing = ['0102_0002']
+    pubs = {pub['identifier']: pub for pub in self.verify()}
+    self.assertEqual(pubs['mvol-0004-1930-0101']['failures'], [])
+    failures = pubs['mvol-0004-1930-0102']['failures']
+    self.assertEqual([failure['status'] for failure in failures], [404, 404])
+    self.assertEqual(pubs['mvol-0004-1930-0102']['pages'][1]['image']['status'], 404)
+
+  def test_failed_tiff_listing(self):
+    listing = self.listing.list
+    def list(path, depth=1):
+      if path.endswith('0103/TIFF'):
+        raise fixtures.MvolListing.Refused(path)
+      return listing(path, depth)
+    self.listing.list = list
+    pubs = {pub['identifier']: pub for pub in self.verify()}
+    pub = pubs['mvol-0004-1930-0103']
+    self.assertEqual(pub['pages'], [])
+    self.assertEqual(pub['ocr']['status'], 200)
+    self.assertEqual(
+      [failure['path'] for failure in pub['failures']],
+      [self.DIRECTORY + '/0103/TIFF']
+    )
+    self.assertEqual(pubs['mvol-0004-1930-0101']['failures'], [])
+
+  def test_resume_from_checkpoint(self):
+    state_path = os.path.join(self.directory, 'state.json')
+    done = mvol_pub_year.load_state(state_path)
+    self.assertEqual(done, {})
+
+    def checkpoint(pub):
+      if not pub['failures']:
+        done[pub['identifier']] = pub
+        mvol_pub_year.save_state(state_path, done)
+
+    self.server.missing = ['mvol-0004-1930-0102']
+    self.verify(done, checkpoint)
+    self.assertEqual(
+      sorted(mvol_pub_year.load_state(state_path)),
+      ['mvol-0004-1930-0101', 'mvol-0004-1930-0103']
+    )
+
+    # only the issue that failed is checked again.
+    self.server.missing = []
+    self.server.paths = []
+    pubs = self.verify(mvol_pub_year.load_state(state_path), checkpoint)
+    self.assertEqual(len(pubs), 3)
+    self.assertTrue(all('0102' in path for path in self.server.paths))
+    self.assertEqual(len(self.server.paths), 5)
+    self.assertEqual(len(mvol_pub_year.load_state(state_path)), 3)
+
+
+class TestValidate(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.directory, 'gms', '0019'))
+    # an mvol-style Presentation 2 document, which is skipped.
+    self.write('mvol.json', {
+      '@context': 'http://iiif.io/api/presentation/2/context.json',
+      '@id': 'https://iiif-manifest.lib.uchicago.edu/mvol.json',
+      '@type': 'sc:Manifest'
+    })
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write(self, name, data):
+    with open(os.path.join(self.directory, name), 'w') as f:
+      json.dump(data, f)
+
+  def validate(self):
+    argv = sys.argv
+    sys.argv = ['iiif_tools', 'validate', self.directory, '--no-cache', '--processes=1']
+    out, err = io.StringIO(), io.StringIO()
+    try:
+      with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        validate_main()
+    except SystemExit as e:
+      return e.code, out.getvalue()
+    finally:
+      sys.argv = argv
+    return 0, out.getvalue()
+
+  def test_skipped_documents_pass(self):
+    self.assertEqual(self.validate(), (0, ''))
+
+  def test_invalid_manifest_fails(self):
+    self.write(os.path.join('gms', '0019', 'gms-0019.json'), {
+      '@context': 'http://iiif.io/api/presentation/3/context.json',
+      'id': 'https://iiif-manifest.lib.uchicago.edu/gms/0019/gms-0019.json',
+      'type': 'Manifest',
+      'label': 'not a language map',
+      'items': []
+    })
+    status, out = self.validate()
+    self.assertEqual(status, 1)
+    self.assertIn(os.path.join('gms', '0019', 'gms-0019.json'), out)
+
+
+class TestPublish(unittest.TestCase):
+
+  URL = 'https://iiif-manifest.lib.uchicago.edu/gms/0019/gms-0019.json'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def mtimes(self, path):
+    return {
+      p: os.stat(p).st_mtime_ns
+      for p in [path] + [path + e for e in ('.gz', '.br', '.etag')]
+      if os.path.exists(p)
+    }
+
+  def test_writes_sidecars(self):
+    text = json.dumps({'id': self.URL, 'type': 'Manifest'}) + '\n'
+    path, written = publish.publish(self.directory, self.URL, text)
+    self.assertTrue(written)
+    self.assertEqual(path, os.path.join(self.directory, 'gms', '0019', 'gms-0019.json'))
+    with open(path, 'rb') as f:
+      data = f.read()
+    self.assertEqual(data, text.encode('utf-8'))
+    with open(path + '.gz', 'rb') as f:
+      compressed = f.read()
+    self.assertEqual(gzip.decompress(compressed), data)
+    with open(path + '.etag') as f:
+      etags = json.load(f)
+    self.assertEqual(etags['identity'], publish.get_etag(data))
+    self.assertEqual(etags['gzip'], publish.get_etag(compressed))
+    if publish.brotli is None:
+      self.assertFalse(os.path.exists(path + '.br'))
+      self.assertNotIn('br', etags)
+    else:
+      with open(path + '.br', 'rb') as f:
+        self.assertEqual(publish.brotli.decompress(f.read()), data)
+      self.assertIn('br', etags)
+
+  def test_skips_unchanged_files(self):
+    text = json.dumps({'id': self.URL, 'type': 'Manifest'}) + '\n'
+    path, written = publish.publish(self.directory, self.URL, text)
+    # make any rewrite show up, whatever the file system's resolution.
+    for p in self.mtimes(path):
+      os.utime(p, ns=(0, 0))
+    before = self.mtimes(path)
+    self.assertEqual(publish.publish(self.directory, self.URL, text), (path, False))
+    self.assertEqual(self.mtimes(path), before)
+
+    # a missing sidecar is written again, without touching the document.
+    os.remove(path + '.gz')
+    self.assertEqual(publish.publish(self.directory, self.URL, text), (path, False))
+    self.assertTrue(os.path.exists(path + '.gz'))
+    self.assertEqual(os.stat(path).st_mtime_ns, 0)
+
+    path, written = publish.publish(self.directory, self.URL, text.replace('Manifest', 'Collection'))
+    self.assertTrue(written)
+    self.assertNotEqual(self.mtimes(path), before)
+
+
+class TestThumbnails(unittest.TestCase):
+
+  SIZES = [(5184, 7200), (8000, 6000), (300, 200)]
+
+  def paths(self):
+    # the NumPy path, where it is installed, and the pure Python one.
+    yield
+    if thumbnails.numpy is not None:
+      numpy = thumbnails.numpy
+      thumbnails.numpy = None
+      try:
+        yield
+      finally:
+        thumbnails.numpy = numpy
+
+  def test_exact_sizes_by_default(self):
+    for _ in self.paths():
+      self.assertEqual(
+        thumbnails.fit(self.SIZES, 500),
+        [(360, 500), (500, 375), (500, 333)]
+      )
+
+  def test_snap_to_scale_factors(self):
+    for _ in self.paths():
+      self.assertEqual(
+        thumbnails.fit(self.SIZES, 500, [1, 2, 4, 8, 16]),
+        [(648, 900), (500, 375), (300, 200)]
+      )
+
+  def test_zero_sizes(self):
+    for _ in self.paths():
+      for scale_factors in (None, [1, 2, 4]):
+        self.assertEqual(
+          thumbnails.fit([(0, 0), (0, 100), (100, 0), (1000, 500)], 500, scale_factors),
+          [(0, 0), (0, 0), (0, 0), (500, 250)]
+        )
+
+
+def load_script(path):
+  """Import an extensionless script as a module."""
+  loader = importlib.machinery.SourceFileLoader(os.path.basename(path), path)
+  spec = importlib.util.spec_from_loader(loader.name, loader)
+  module = importlib.util.module_from_spec(spec)
+  loader.exec_module(module)
+  return module
+
+
+split_marcxml = load_script(os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), 'utils', 'split_soc_sci_maps_marcxml'))
+
+
+class TestSplitMarcXml(unittest.TestCase):
+
+  IDENTIFIERS = ['G4104-C6-2N3E51-1908-S2', 'G4104-C6-1933-U5-a']
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    records = ''.join(
+      '<record><controlfield tag="001">{}</controlfield>'
+      '<datafield tag="856" ind1="4" ind2="1"><subfield code="u">'
+      'http://pi.lib.uchicago.edu/1001/maps/chisoc/{}</subfield></datafield>'
+      '<datafield tag="245"><subfield code="a">Caf\u00e9 {}</subfield></datafield>'
+      '</record>'.format(n, identifier, n)
+      for n, identifier in enumerate(self.IDENTIFIERS)
+    )
+    # a record with no 856$u, which is skipped.
+    records += '<record><controlfield tag="001">2</controlfield></record>'
+    self.marcxml = (
+      '<?xml version="1.0" encoding="UTF-8"?>'
+      '<collection xmlns="http://www.loc.gov/MARC21/slim">{}</collection>'.format(records)
+    ).encode('utf-8')
+    self.path = os.path.join(self.directory, 'export.xml')
+    with open(self.path, 'wb') as f:
+      f.write(self.marcxml)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def split(self, *args, stdin=None):
+    argv, original_stdin = sys.argv, sys.stdin
+    sys.argv = ['split_soc_sci_maps_marcxml'] + list(args)
+    if stdin is not None:
+      sys.stdin = io.TextIOWrapper(io.BytesIO(stdin))
+    err = io.StringIO()
+    try:
+      with contextlib.redirect_stderr(err):
+        split_marcxml.main()
+    finally:
+      sys.argv, sys.stdin = argv, original_stdin
+    return err.getvalue()
+
+  def test_iter_records(self):
+    records = list(split_marcxml.iter_records(io.BytesIO(self.marcxml)))
+    self.assertEqual([i for i, r in records], self.IDENTIFIERS + [None])
+    for identifier, record in records[:2]:
+      self.assertIn(identifier, record)
+      self.assertTrue(record.startswith('<record xmlns="http://www.loc.gov/MARC21/slim">'))
+
+  def check_files(self, output_dir):
+    for n, identifier in enumerate(self.IDENTIFIERS):
+      path = split_marcxml.get_shard_path(output_dir, identifier)
+      with open(path, 'rb') as f:
+        data = f.read()
+      self.assertTrue(data.startswith(split_marcxml.XML_DECLARATION.encode('utf-8')))
+      record = ElementTree.fromstring(data)
+      self.assertEqual(record.find('.//{http://www.loc.gov/MARC21/slim}controlfield').text, str(n))
+      self.assertIn('Caf\u00e9'.encode('utf-8'), data)
+    self.assertEqual(
+      sum(len(names) for directory, subdirectories, names in os.walk(output_dir)),
+      2
+    )
+
+  def test_directory_from_path(self):
+    output_dir = os.path.join(self.directory, 'records')
+    err = self.split(self.path, '--output-dir=' + output_dir)
+    self.check_files(output_dir)
+    self.assertIn('1 records without an 856$u skipped', err)
+
+  def test_directory_from_stdin(self):
+    output_dir = os.path.join(self.directory, 'records')
+    self.split('--output-dir=' + output_dir, stdin=self.marcxml)
+    self.check_files(output_dir)
+
+  def check_sqlite(self, path):
+    conn = sqlite3.connect(path)
+    rows = dict(conn.execute('SELECT identifier, marcxml FROM records'))
+    conn.close()
+    self.assertEqual(sorted(rows), sorted(self.IDENTIFIERS))
+    for identifier, record in rows.items():
+      self.assertEqual(
+        ElementTree.fromstring(record)
+          .find(split_marcxml.MARC_856U).text.split('/').pop(),
+        identifier
+      )
+
+  def test_sqlite_from_path(self):
+    path = os.path.join(self.directory, 'records.db')
+    self.split(self.path, '--sqlite=' + path)
+    self.check_sqlite(path)
+
+  def test_sqlite_from_stdin(self):
+    path = os.path.join(self.directory, 'records.db')
+    self.split('-', '--sqlite=' + path, stdin=self.marcxml)
+    self.check_sqlite(path)
+
+
+class TestManifestIds(unittest.TestCase):
+
+  def make_manifest(self, random_ids=False):
+    # builders supply the metadata; the logo is described statically, so
+    # nothing is fetched.
+    class Manifest(IIIFManifest):
+      def _get_metadata(self):
+        return []
+
+    set_logo(LOGO_URL, 600, 120)
+    manifest = Manifest(
+      'https://iiif-manifest.lib.uchicago.edu',
+      'gms-0019',
+      'ark:61001/b2hd4d25q389',
+      'Title',
+      'Summary',
+      'Attribution',
+      random_ids=random_ids
+    )
+    for n in range(20):
+      manifest.pages.append(3000 + n, 4000 + n)
+    return manifest
+
+  def write(self, manifest):
+    f = io.StringIO()
+    manifest.write(f)
+    return f.getvalue().encode('utf-8')
+
+  def test_write_is_deterministic(self):
+    manifest = self.make_manifest()
+    first = self.write(manifest)
+    self.assertEqual(first, self.write(manifest))
+    self.assertEqual(first, self.write(self.make_manifest()))
+    self.assertEqual(len(json.loads(first)['items']), 20)
+
+  def test_random_ids(self):
+    manifest = self.make_manifest(random_ids=True)
+    self.assertNotEqual(self.write(manifest), self.write(manifest))
+    self.assertNotEqual(self.write(manifest), self.write(self.make_manifest()))
+
+
+class TestWebDavListing(unittest.TestCase):
+
+  directory = '/IIIF_Files/mvol/0004/1930'
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def read_year(self, client):
+    """List the year and read every issue's struct.txt, as mvol_pub_year
+       does. Returns the contents and the requests it took."""
+    start = client.requests
+    listing = WebDavListing(client, self.directory, cache_dir=self.cache_dir)
+    contents = {}
+    for entry in listing.list(self.directory):
+      issue = entry.get_name()
+      path = '{}/{}/mvol-0004-1930-{}.struct.txt'.format(self.directory, issue, issue)
+      contents[path] = listing.get_file_contents(path)
+    return contents, client.requests - start
+
+  def test_cached_between_runs(self):
+    client = fixtures.MvolListing(self.directory, 100, pages=2)
+    first, requests = self.read_year(client)
+    self.assertEqual(len(first), 100)
+    # one depth-0 PROPFIND, one depth-infinity PROPFIND, 100 struct.txt.
+    self.assertEqual(requests, 102)
+    second, requests = self.read_year(client)
+    self.assertEqual(second, first)
+    self.assertEqual(requests, 1)
+
+  def test_changed_file_is_fetched_again(self):
+    client = fixtures.MvolListing(self.directory, 100, pages=2)
+    first, requests = self.read_year(client)
+    path = sorted(first)[0]
+    client.add_file(path, b'object\tpage\tmilestone\n00000001\t1\tCover\n')
+    second, requests = self.read_year(client)
+    self.assertEqual(second[path], b'object\tpage\tmilestone\n00000001\t1\tCover\n')
+    self.assertEqual(
+      {p: d for p, d in second.items() if p != path},
+      {p: d for p, d in first.items() if p != path}
+    )
+    # the depth-0 and depth-infinity PROPFINDs, and the changed file.
+    self.assertEqual(requests, 3)
+
+  def test_refused_depth_infinity_walks_the_tree(self):
+    expected = WebDavListing(
+      fixtures.MvolListing(self.directory, 10, pages=2),
+      self.directory,
+      cache_dir=None
+    ).list(self.directory, depth='infinity')
+    client = fixtures.MvolListing(self.directory, 10, pages=2, max_depth=1)
+    listing = WebDavListing(client, self.directory, cache_dir=None)
+    entries = listing.list(self.directory, depth='infinity')
+    self.assertEqual(
+      sorted(e.path for e in entries),
+      sorted(e.path for e in expected)
+    )
+    self.assertEqual(len(entries), 10 * (1 + 1 + 1 + 2))
+
+
 if __name__ == '__main__':
   unittest.main()